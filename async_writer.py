@@ -0,0 +1,167 @@
+"""
+async_writer.py
+
+Producer/consumer machinery for the asyncio run mode (ASYNC_PIPELINE).
+A producer pulls batches from one of the pipeline's batch generators -
+on a worker thread, so parsing doesn't block the event loop - and puts
+them on a bounded queue; a set of writer tasks, each with its own
+psycopg 3 AsyncConnection, drain the queue and load the batches. While
+one batch is being written, the next ones are being read and parsed,
+and the queue's bound (ASYNC_IN_FLIGHT) applies backpressure, so the
+readers never get more than that many batches ahead of the writers.
+
+Rows are loaded the same way as in the synchronous pipeline: with COPY
+(through the staging tables of bulk_load_targets) when a COPY batch size
+is set, and with the insert queries otherwise - sent with executemany,
+which psycopg 3 pipelines into a single round trip. Each batch is its
+own transaction. A batch the DB rejects for its data is logged and
+rolled back, and loading carries on with the next one; any other DB
+error (a deadlock, a lost connection) fails the run.
+
+psycopg 3 is optional: without it, the asyncio run mode is unavailable.
+"""
+
+import asyncio
+import logging
+import metrics
+from sql_queries import bulk_load_targets
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+DEF_ASYNC_WRITERS = 4
+DEF_ASYNC_IN_FLIGHT = 8
+
+
+async def copy_rows(cur, table, columns, rows):
+    """COPY a list of row tuples into a table.
+    Args:       cur: psycopg 3 async cursor
+                table: name of the table to COPY into
+                columns: column names, in row tuple order
+                rows: list of row tuples
+    Returns:    None
+    """
+    async with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+        for row in rows:
+            await copy.write_row(row)
+    metrics.count('db_round_trips')
+
+
+async def load_rows(conn, table, rows, insert_query=None, batch_size=None):
+    """Load rows into a table, one transaction per batch: through COPY
+    when batch_size is set (or there is no insert query), otherwise all
+    in one batch, with the insert query.
+    Args:       conn: psycopg 3 AsyncConnection
+                table: name of the target table (a key of bulk_load_targets)
+                rows: iterable of row tuples, in the target's column order
+                insert_query: the table's row insert query
+                batch_size: if set, COPY rows in batches of this size
+    Returns:    number of rows loaded
+    Raises:     psycopg.Error for a DB error other than rejected data
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    use_copy = bool(batch_size) or insert_query is None
+    size = batch_size or len(rows) or 1
+    loaded = 0
+    for start in range(0, len(rows), size):
+        batch = rows[start:start + size]
+        try:
+            async with conn.transaction():
+                async with conn.cursor() as cur:
+                    if use_copy:
+                        await _copy_batch(cur, table, batch)
+                    else:
+                        await cur.executemany(insert_query, batch)
+                        metrics.count('db_round_trips')
+            # the commit
+            metrics.count('db_round_trips')
+            metrics.count('rows_out', len(batch))
+            loaded += len(batch)
+        except (psycopg.DataError, psycopg.IntegrityError) as e:
+            logging.warning(f'caught psycopg exception loading {table} batch!')
+            logging.warning(str(e))
+            metrics.count('rows_rejected', len(batch))
+        except psycopg.Error as e:
+            logging.error(f'failed to load {table} batch: {str(e)}')
+            raise
+    return loaded
+
+
+async def _copy_batch(cur, table, rows):
+    """COPY a batch into a table, via its staging table where it has
+    one, as bulk_loader.load_batch() does."""
+    target = bulk_load_targets[table]
+    if target['upsert_key'] is not None:
+        rows = list({row[target['upsert_key']]: row for row in rows}.values())
+    if target['staging']:
+        await cur.execute(target['staging_create'])
+        await copy_rows(cur, target['staging'], target['columns'], rows)
+        await cur.execute(target['merge'])
+        metrics.count('db_round_trips', 2)
+        if target['clear']:
+            await cur.execute(target['clear'])
+            metrics.count('db_round_trips')
+    else:
+        await copy_rows(cur, table, target['columns'], rows)
+
+
+async def produce(batches, queue, writers):
+    """Feed batches from a (blocking) batch generator to the queue,
+    then one None per writer to tell them there is no more work.
+    Args:       batches: iterable of batches
+                queue: bounded asyncio.Queue
+                writers: number of writer tasks draining the queue
+    Returns:    None
+    """
+    batches = iter(batches)
+    while True:
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            break
+        # blocks while the queue is full - the backpressure on the readers
+        await queue.put(batch)
+    for _ in range(writers):
+        await queue.put(None)
+
+
+async def write(conninfo, queue, handler):
+    """Writer task: drain batches from the queue on its own connection.
+    Args:       conninfo: DB connect string
+                queue: asyncio.Queue of batches
+                handler: coroutine function taking (conn, batch)
+    Returns:    None
+    """
+    async with await psycopg.AsyncConnection.connect(conninfo) as conn:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            await handler(conn, batch)
+
+
+async def run_queue(conninfo, batches, handler, writers=DEF_ASYNC_WRITERS,
+                    in_flight=DEF_ASYNC_IN_FLIGHT):
+    """Read batches and write them concurrently, with at most in_flight
+    batches read but not yet picked up by a writer.
+    Args:       conninfo: DB connect string
+                batches: iterable of batches (read on a worker thread)
+                handler: coroutine function taking (conn, batch), loading one batch
+                writers: number of writer tasks (and DB connections)
+                in_flight: bound of the batch queue
+    Returns:    None
+    Raises:     the first exception raised by the producer or a writer;
+                the other tasks are cancelled
+    """
+    queue = asyncio.Queue(maxsize=in_flight)
+    tasks = [asyncio.create_task(produce(batches, queue, writers))]
+    tasks += [asyncio.create_task(write(conninfo, queue, handler)) for _ in range(writers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,47 @@
+"""
+backfill.py
+
+Re-resolution of songplays loaded without a song match, once their song
+turns up. A songplay whose (title, artist name, duration) matches no
+song is loaded with NULL song and artist IDs, and its song lookup key
+is kept in songplays_unmatched. A trigger on songs records every song
+actually inserted in songs_pending, whichever way it was loaded.
+
+After a run has loaded its songs and artists, the backfill matches the
+pending songs against the unmatched keys - driven by the new songs, and
+probing the unmatched keys by index - fills in the matched songplays
+through the partial index over the unmatched ones, drops their keys
+from songplays_unmatched, and marks their days' rollups stale, all in
+one transaction. A late-arriving song costs time in proportion to the
+new songs and the plays waiting for them, not to the songplay history.
+"""
+
+import logging
+from sql_queries import (backfill_songs_create, backfill_songs_clear, backfill_matches_create,
+                         backfill_songplay_count, backfill_songplay_update, backfill_unmatched_clear)
+
+
+def backfill_songplays(conn, cur):
+    """Re-resolve the unmatched songplays that songs inserted since the
+    last backfill now match.
+    Args:       conn: DB connection
+                cur:  DB cursor
+    Returns:    number of songplays re-resolved
+    """
+    cur.execute(backfill_songs_create)
+    songs = cur.rowcount
+    if not songs:
+        conn.commit()
+        logging.info('Backfill: no new songs - nothing to re-resolve')
+        return 0
+
+    cur.execute(backfill_matches_create)
+    cur.execute(backfill_songplay_count)
+    matched = cur.fetchone()[0]
+    if matched:
+        cur.execute(backfill_songplay_update)
+        cur.execute(backfill_unmatched_clear)
+    cur.execute(backfill_songs_clear)
+    conn.commit()
+    logging.info(f'Backfill: {songs} new songs re-resolved {matched} songplays')
+    return matched
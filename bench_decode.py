@@ -0,0 +1,95 @@
+"""
+bench_decode.py benchmarks the decoding of log event files: the
+original full json.loads of every line, against the pre-filtered,
+projected decoding of log_decoder.py with each JSON backend installed.
+
+Every decoder is run over the same files, its output is checked against
+the full decode, and lines/sec and NextSong events/sec are reported.
+
+Usage:      python3 bench_decode.py [--data ./data/log_data] [--repeat 3]
+"""
+
+import sys
+import json
+import time
+import argparse
+from etl import get_files
+from input_files import iter_json_streams
+from log_decoder import BACKENDS, LOG_FIELDS, NEXT_SONG, maybe_next_song, project_event
+
+
+def decode_full(lines):
+    """The original decoding: parse every line, keep the NextSong events."""
+    events = []
+    for line in lines:
+        data = json.loads(line)
+        if data['page'] == NEXT_SONG:
+            events.append({key: data[field] for key, field in LOG_FIELDS})
+    return events
+
+
+def make_prefiltered(loads):
+    """Build a pre-filtered, projected decoder using the given parse function."""
+    def decode(lines):
+        events = []
+        for line in lines:
+            if maybe_next_song(line):
+                data = loads(line)
+                if data['page'] == NEXT_SONG:
+                    events.append(project_event(data))
+        return events
+    return decode
+
+
+def read_lines(files):
+    """Read all the lines of the files into memory, as bytes, so the
+    benchmark times decoding rather than I/O."""
+    lines = []
+    for file in files:
+        for _, f in iter_json_streams(file):
+            lines.extend(line for line in f if line.strip())
+    return lines
+
+
+def time_decoder(decode, lines, repeat):
+    """Run a decoder repeat times; return its output and best time."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        events = decode(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return events, best
+
+
+def main():
+    """Run each decoder and print a lines/sec comparison.
+    Args:       None
+    Returns:    0 for success; 1 if a decoder's output differs
+    """
+    parser = argparse.ArgumentParser(description='Benchmark log event decoding.')
+    parser.add_argument('--data', default='./data/log_data', help='log data directory')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per decoder (best is kept)')
+    args = parser.parse_args()
+
+    lines = read_lines(get_files(args.data))
+    decoders = [('full json', decode_full)]
+    decoders += [(f'prefilter {name}', make_prefiltered(loads)) for name, loads in BACKENDS.items()]
+
+    expected = None
+    ret_val = 0
+    print(f"{'decoder':<18} {'lines':>9} {'events':>8} {'seconds':>9} {'lines/s':>10} {'speedup':>8}")
+    for name, decode in decoders:
+        events, elapsed = time_decoder(decode, lines, args.repeat)
+        if expected is None:
+            expected, base = events, elapsed
+        elif events != expected:
+            print(f'{name}: output differs from the full decode')
+            ret_val = 1
+        print(f"{name:<18} {len(lines):>9} {len(events):>8} {elapsed:>9.3f} "
+              f"{len(lines) / elapsed:>10.0f} {base / elapsed:>7.1f}x")
+    return ret_val
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+bench_etl.py is an end-to-end benchmark of the ETL pipeline. It
+recreates the sparkifydb database, then runs the stages of etl.main()
+one at a time against a data directory (e.g. one written by
+generate_data.py), recording for each stage its wall time, rows in and
+out, rows/sec, and the peak RSS of the process so far.
+
+Each run is appended as one JSON line to a results file, tagged with
+the git commit and the load settings, so results can be compared
+across commits.
+
+Usage:      python3 bench_etl.py --data /tmp/sparkify_data [--load-mode copy]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import datetime
+import subprocess
+import create_tables
+from config_mgr import ConfigMgr
+from bulk_loader import DEF_BATCH_SIZE
+from parallel_parser import DEF_PARSE_WORKERS, DEF_PARSE_CHUNK_SIZE
+from song_index import build_song_index, fetch_song_index
+from etl import (get_files, get_song_and_artist_data, get_all_log_data,
+                 insert_song_data, insert_artist_data, insert_time_data,
+                 insert_user_data, insert_songplay_data)
+
+DEF_RESULTS_FILE = './bench_results.jsonl'
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    """The current git commit, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def count_rows(cur, table):
+    """Count the rows in a table."""
+    cur.execute(f"SELECT count(*) FROM {table}")
+    return cur.fetchone()[0]
+
+
+class StageTimer:
+    def __init__(self, cur):
+        """
+        Initialize an empty list of stage results; cur is used to
+        count the rows loaded by each stage.
+        """
+        self.cur = cur
+        self.stages = []
+
+    def run(self, name, func, rows_in=None, table=None, count=len):
+        """Run and time one stage.
+        Args:       name: stage name
+                    func: callable running the stage
+                    rows_in: number of records going into the stage
+                    table: table loaded by the stage, if any
+                    count: callable counting the records in the
+                    stage's return value, for stages with no table
+        Returns:    the stage's return value
+        """
+        before = count_rows(self.cur, table) if table else None
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if table:
+            rows_out = count_rows(self.cur, table) - before
+        else:
+            rows_out = count(result) if result is not None else None
+        # loads are rated on the records going in; other stages on what they produce
+        rows = rows_in if table else rows_out
+        self.stages.append(dict(stage=name,
+                                seconds=round(elapsed, 4),
+                                rows_in=rows_in,
+                                rows_out=rows_out,
+                                rows_per_sec=round(rows / elapsed) if rows and elapsed else None,
+                                peak_rss_mb=round(peak_rss_mb(), 1)))
+        return result
+
+
+def run_benchmark(cfg, data_dir, batch_size, workers, chunk_size, song_index_source):
+    """Recreate the DB and run each pipeline stage in turn.
+    Args:       cfg: ConfigMgr instance
+                data_dir: directory holding song_data and log_data
+                batch_size: COPY batch size, or None for row-by-row inserts
+                workers: number of parser processes
+                chunk_size: number of files handed to a parser at a time
+                song_index_source: "data", "db", "sql" to enrich songplays in
+                the DB, or None for per-event queries
+    Returns:    list of stage result dicts
+    """
+    cur, conn = create_tables.create_database(cfg)
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+    timer = StageTimer(cur)
+
+    song_files = timer.run('discover_songs', lambda: get_files(os.path.join(data_dir, 'song_data')))
+    song_data, artist_data = timer.run('parse_songs',
+                                       lambda: get_song_and_artist_data(song_files, workers,
+                                                                        chunk_size),
+                                       rows_in=len(song_files), count=lambda r: len(r[0]))
+    timer.run('songs', lambda: insert_song_data(song_data, conn, cur, batch_size),
+              rows_in=len(song_data), table='songs')
+    timer.run('artists', lambda: insert_artist_data(artist_data, conn, cur, batch_size),
+              rows_in=len(artist_data), table='artists')
+    song_index = None
+    if song_index_source == 'data':
+        song_index = timer.run('song_index', lambda: build_song_index(song_data, artist_data),
+                               rows_in=len(song_data))
+    elif song_index_source == 'db':
+        song_index = timer.run('song_index', lambda: fetch_song_index(cur))
+    del song_data, artist_data
+
+    log_files = timer.run('discover_logs', lambda: get_files(os.path.join(data_dir, 'log_data')))
+    all_log_data = timer.run('parse_logs',
+                             lambda: get_all_log_data(log_files, workers, chunk_size),
+                             rows_in=len(log_files))
+    timer.run('time', lambda: insert_time_data(all_log_data, conn, cur, batch_size),
+              rows_in=len(all_log_data), table='time')
+    timer.run('users', lambda: insert_user_data(all_log_data, conn, cur, batch_size),
+              rows_in=len(all_log_data), table='users')
+    timer.run('songplays',
+              lambda: insert_songplay_data(all_log_data, conn, cur, batch_size, song_index,
+                                           song_index_source == 'sql'),
+              rows_in=len(all_log_data), table='songplays')
+    conn.close()
+    return timer.stages
+
+
+def main():
+    """Run the benchmark, print a summary, and append it to the results file.
+    Args:       None
+    Returns:    0 for success
+    """
+    cfg = ConfigMgr(env='DB')
+    parser = argparse.ArgumentParser(description='Benchmark the ETL pipeline stages.')
+    parser.add_argument('--data', default='./data', help='directory with song_data and log_data')
+    parser.add_argument('--load-mode', default=cfg.get("LOAD_MODE"), choices=['insert', 'copy'])
+    parser.add_argument('--batch-size', type=int,
+                        default=cfg.get("COPY_BATCH_SIZE") or DEF_BATCH_SIZE)
+    parser.add_argument('--workers', type=int,
+                        default=cfg.get("PARSE_WORKERS") or DEF_PARSE_WORKERS)
+    parser.add_argument('--chunk-size', type=int,
+                        default=cfg.get("PARSE_CHUNK_SIZE") or DEF_PARSE_CHUNK_SIZE)
+    parser.add_argument('--song-index', default=cfg.get("SONG_INDEX"),
+                        choices=['data', 'db', 'sql', 'none'])
+    parser.add_argument('--label', default=None, help='free-form label stored with the results')
+    parser.add_argument('--results', default=DEF_RESULTS_FILE, help='JSON lines results file')
+    args = parser.parse_args()
+
+    batch_size = args.batch_size if args.load_mode == 'copy' else None
+    stages = run_benchmark(cfg, args.data, batch_size, args.workers, args.chunk_size,
+                           args.song_index)
+    result = dict(commit=git_commit(),
+                  run_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                  label=args.label,
+                  data=os.path.abspath(args.data),
+                  load_mode=args.load_mode,
+                  batch_size=batch_size,
+                  workers=args.workers,
+                  chunk_size=args.chunk_size,
+                  song_index=args.song_index,
+                  total_seconds=round(sum(stage['seconds'] for stage in stages), 4),
+                  stages=stages)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    print(f"{'stage':<15} {'seconds':>9} {'rows in':>10} {'rows out':>10} {'rows/s':>10} {'peak MB':>8}")
+    for stage in stages:
+        print(f"{stage['stage']:<15} {stage['seconds']:>9.3f} {str(stage['rows_in'] or ''):>10} "
+              f"{str(stage['rows_out'] or ''):>10} {str(stage['rows_per_sec'] or ''):>10} "
+              f"{stage['peak_rss_mb']:>8.1f}")
+    print(f"total: {result['total_seconds']:.3f}s - appended to {args.results}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
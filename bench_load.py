@@ -0,0 +1,85 @@
+"""
+bench_load.py benchmarks the two ways of loading the star schema
+tables: row-by-row INSERTs, and batched COPY through the bulk loader.
+
+For each load mode the sparkifydb database is dropped and recreated,
+the song and log data are read once, and each insert stage is timed;
+rows/sec are reported per table.
+
+Usage:      python3 bench_load.py [batch size]
+"""
+
+import sys
+import time
+import logging
+import create_tables
+from config_mgr import ConfigMgr
+from bulk_loader import DEF_BATCH_SIZE
+from etl import (get_files, get_song_and_artist_data, get_all_log_data,
+                 insert_song_data, insert_artist_data, insert_time_data,
+                 insert_user_data, insert_songplay_data)
+
+
+def count_rows(cur, table):
+    """Count the rows in a table.
+    Args:       cur: DB cursor
+                table: table name
+    Returns:    row count
+    """
+    cur.execute(f"SELECT count(*) FROM {table}")
+    return cur.fetchone()[0]
+
+
+def run_load(cfg, song_data, artist_data, all_log_data, batch_size):
+    """Recreate the DB and time each insert stage.
+    Args:       cfg: ConfigMgr instance
+                song_data, artist_data, all_log_data: parsed input data
+                batch_size: COPY batch size, or None for row-by-row inserts
+    Returns:    list of (table, rows, seconds) tuples
+    """
+    cur, conn = create_tables.create_database(cfg)
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+
+    stages = [('songs', insert_song_data, song_data),
+              ('artists', insert_artist_data, artist_data),
+              ('time', insert_time_data, all_log_data),
+              ('users', insert_user_data, all_log_data),
+              ('songplays', insert_songplay_data, all_log_data)]
+    results = []
+    for table, insert_func, data in stages:
+        start = time.perf_counter()
+        insert_func(data, conn, cur, batch_size)
+        elapsed = time.perf_counter() - start
+        results.append((table, count_rows(cur, table), elapsed))
+    conn.close()
+    return results
+
+
+def main():
+    """Run both load modes and print a rows/sec comparison.
+    Args:       None
+    Returns:    0 for success
+    """
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else DEF_BATCH_SIZE
+    cfg = ConfigMgr(env='DB')
+
+    song_data, artist_data = get_song_and_artist_data(get_files(cfg.get("SONG_DATA")))
+    all_log_data = get_all_log_data(get_files(cfg.get("LOG_DATA")))
+
+    insert_results = run_load(cfg, song_data, artist_data, all_log_data, None)
+    copy_results = run_load(cfg, song_data, artist_data, all_log_data, batch_size)
+
+    print(f"{'table':<10} {'rows':>8} {'insert rows/s':>14} {'copy rows/s':>12} {'speedup':>8}")
+    for (table, rows, ins_secs), (_, copy_rows, copy_secs) in zip(insert_results, copy_results):
+        if rows != copy_rows:
+            logging.warning(f'bench_load: {table} row counts differ: {rows} vs {copy_rows}')
+        ins_rate = rows / ins_secs if ins_secs else 0
+        copy_rate = copy_rows / copy_secs if copy_secs else 0
+        speedup = copy_rate / ins_rate if ins_rate else 0
+        print(f"{table:<10} {rows:>8} {ins_rate:>14.0f} {copy_rate:>12.0f} {speedup:>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""
+bench_queries.py benchmarks analytical reads against the star schema:
+plays per hour from the time dimension, plays per weekday and hour over
+a recent start_time range, the top songs per level, and per-user
+session stats joined across songplays, users, songs and artists.
+
+With --load, the sparkifydb database is first recreated - optionally
+with songplays partitioned by month - and loaded through the pipeline
+from a data directory (e.g. one written by generate_data.py at the
+scale to test). Each query is then run --warmup times untimed and
+--repeat times timed, and its latency percentiles are recorded, along
+with the EXPLAIN (ANALYZE, BUFFERS) of one more run: planning and
+execution time, the shared buffers hit and read, and the full plan,
+which --plans writes out as text.
+
+Each run is appended as one JSON line to a results file, tagged with
+the git commit, the schema variant, a free-form label and the table
+row counts, so variants - partitioned or not, with or without the
+songplays indexes, before and after a DDL change - can be compared.
+
+Usage:      python3 bench_queries.py --load /tmp/sparkify_data --variant partitioned
+            python3 bench_queries.py --variant no-indexes --repeat 50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import psycopg2
+import metrics
+import validation
+import create_tables
+from config_mgr import ConfigMgr
+from etl import run_pipeline
+from bench_etl import git_commit, count_rows
+from songplay_partitions import drop_indexes, build_indexes
+from sql_queries import (workload_plays_by_hour, workload_plays_in_range,
+                         workload_top_songs_per_level, workload_user_sessions,
+                         workload_range_select)
+
+DEF_RESULTS_FILE = './bench_query_results.jsonl'
+DEF_REPEAT = 20
+DEF_WARMUP = 2
+DEF_TOP = 10
+DEF_RANGE_DAYS = 7
+
+# schema variants: partitioned needs a --load, as the layout is set when
+# songplays is created; no-indexes drops the songplays secondary indexes
+VARIANTS = ('default', 'partitioned', 'no-indexes')
+TABLES = ('songplays', 'users', 'songs', 'artists', 'time')
+
+
+def workload(cur, top, range_days):
+    """The benchmark queries, with their parameters.
+    Args:       cur: DB cursor, to find the recent start_time range
+                top: number of rows the top-N queries return
+                range_days: number of days the range query covers
+    Returns:    list of (name, query, params) tuples
+    """
+    cur.execute(workload_range_select, (range_days,))
+    range_start, range_end = cur.fetchone()
+    return [('plays_by_hour', workload_plays_by_hour, None),
+            ('plays_in_range', workload_plays_in_range, (range_start, range_end)),
+            ('top_songs_per_level', workload_top_songs_per_level, (top,)),
+            ('user_sessions', workload_user_sessions, (top,))]
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list of values."""
+    rank = max(int(-(-p * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def time_query(cur, query, params, repeat, warmup):
+    """Run a query warmup times untimed, then repeat times timed.
+    Args:       cur: DB cursor
+                query: SQL query
+                params: query parameters, or None
+                repeat: number of timed runs
+                warmup: number of untimed runs first
+    Returns:    dict of latency stats, in ms, and the number of rows returned
+    """
+    latencies = []
+    rows = 0
+    for run in range(warmup + repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        rows = len(cur.fetchall())
+        elapsed = (time.perf_counter() - start) * 1000
+        if run >= warmup:
+            latencies.append(elapsed)
+    latencies.sort()
+    return dict(rows=rows,
+                min_ms=round(latencies[0], 3),
+                p50_ms=round(percentile(latencies, 50), 3),
+                p95_ms=round(percentile(latencies, 95), 3),
+                p99_ms=round(percentile(latencies, 99), 3),
+                max_ms=round(latencies[-1], 3),
+                mean_ms=round(sum(latencies) / len(latencies), 3))
+
+
+def explain_query(cur, query, params):
+    """EXPLAIN (ANALYZE, BUFFERS) a query.
+    Args:       cur: DB cursor
+                query: SQL query
+                params: query parameters, or None
+    Returns:    dict of the plan's summary, with the JSON plan; the plan as text
+    """
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0][0]
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+    text = '\n'.join(line for line, in cur.fetchall())
+    top = plan['Plan']
+    return dict(planning_ms=plan.get('Planning Time'),
+                execution_ms=plan.get('Execution Time'),
+                top_node=top['Node Type'],
+                shared_hit_blocks=top.get('Shared Hit Blocks'),
+                shared_read_blocks=top.get('Shared Read Blocks'),
+                plan=plan), text
+
+
+def load_data(cfg, data_dir, partitioned):
+    """Recreate the DB and load a data directory through the pipeline,
+    with COPY loads.
+    Args:       cfg: ConfigMgr instance
+                data_dir: directory holding song_data and log_data
+                partitioned: True to partition songplays by month
+    Returns:    0 for success; -1 for failure
+    """
+    cur, conn = create_tables.create_database(cfg)
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn, partitioned)
+    conn.close()
+    cfg.set("SONG_DATA", os.path.join(data_dir, 'song_data'))
+    cfg.set("LOG_DATA", os.path.join(data_dir, 'log_data'))
+    cfg.set("LOAD_MODE", 'copy')
+    cfg.set("PARTITION_SONGPLAYS", partitioned)
+    for label in ("CHECKPOINT", "METRICS_JSON", "METRICS_PROM"):
+        cfg.set(label, None)
+    validation.configure(cfg)
+    ret_val = run_pipeline(cfg, metrics.RunMetrics(), incremental=False)
+    validation.close()
+    return ret_val
+
+
+def run_benchmark(cfg, variant, repeat, warmup, top, range_days, plans_dir=None):
+    """Run every query of the workload against the DB.
+    Args:       cfg: ConfigMgr instance
+                variant: schema variant (see VARIANTS)
+                repeat: number of timed runs per query
+                warmup: number of untimed runs per query
+                top: number of rows the top-N queries return
+                range_days: number of days the range query covers
+                plans_dir: directory to write the text plans to, or None
+    Returns:    dict of table row counts; list of query result dicts
+    """
+    conn = psycopg2.connect(cfg.get_db_connect_string())
+    cur = conn.cursor()
+    if variant == 'no-indexes':
+        drop_indexes(conn, cur)
+    else:
+        build_indexes(conn, cur)
+    # fresh statistics, so every variant is planned on the same footing
+    cur.execute('ANALYZE')
+    conn.commit()
+    counts = {table: count_rows(cur, table) for table in TABLES}
+
+    results = []
+    for name, query, params in workload(cur, top, range_days):
+        result = dict(query=name, **time_query(cur, query, params, repeat, warmup))
+        result['explain'], text = explain_query(cur, query, params)
+        if plans_dir:
+            os.makedirs(plans_dir, exist_ok=True)
+            with open(os.path.join(plans_dir, f'{variant}-{name}.txt'), 'w') as f:
+                f.write(text + '\n')
+        conn.rollback()
+        results.append(result)
+    if variant == 'no-indexes':
+        build_indexes(conn, cur)
+    conn.close()
+    return counts, results
+
+
+def main():
+    """Run the benchmark, print a summary, and append it to the results file.
+    Args:       None
+    Returns:    0 for success; 1 if the load failed
+    """
+    cfg = ConfigMgr(env='DB')
+    parser = argparse.ArgumentParser(description='Benchmark analytical queries on the star schema.')
+    parser.add_argument('--load', default=None, metavar='DATA',
+                        help='recreate the DB and load this data directory first')
+    parser.add_argument('--variant', default='default', choices=VARIANTS)
+    parser.add_argument('--repeat', type=int, default=DEF_REPEAT, help='timed runs per query')
+    parser.add_argument('--warmup', type=int, default=DEF_WARMUP, help='untimed runs per query')
+    parser.add_argument('--top', type=int, default=DEF_TOP, help='rows of the top-N queries')
+    parser.add_argument('--range-days', type=int, default=DEF_RANGE_DAYS,
+                        help='days covered by the range query')
+    parser.add_argument('--plans', default=None, metavar='DIR', help='write the text plans here')
+    parser.add_argument('--label', default=None, help='free-form label stored with the results')
+    parser.add_argument('--results', default=DEF_RESULTS_FILE, help='JSON lines results file')
+    args = parser.parse_args()
+
+    if args.variant == 'partitioned' and not args.load:
+        parser.error('--variant partitioned needs --load, to create songplays partitioned')
+    if args.load and load_data(cfg, args.load, args.variant == 'partitioned') != 0:
+        print('load failed - check the pipeline log')
+        return 1
+
+    counts, queries = run_benchmark(cfg, args.variant, args.repeat, args.warmup, args.top,
+                                    args.range_days, args.plans)
+    result = dict(commit=git_commit(),
+                  run_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                  label=args.label,
+                  variant=args.variant,
+                  data=os.path.abspath(args.load) if args.load else None,
+                  repeat=args.repeat,
+                  warmup=args.warmup,
+                  rows=counts,
+                  queries=queries)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result, default=str) + '\n')
+
+    print(f"{'query':<20} {'rows':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'exec ms':>9} {'hit':>8} {'read':>8}")
+    for query in queries:
+        explain = query['explain']
+        print(f"{query['query']:<20} {query['rows']:>6} {query['p50_ms']:>9.2f} "
+              f"{query['p95_ms']:>9.2f} {query['p99_ms']:>9.2f} "
+              f"{explain['execution_ms'] or 0:>9.2f} {str(explain['shared_hit_blocks']):>8} "
+              f"{str(explain['shared_read_blocks']):>8}")
+    print(f"songplays: {counts['songplays']} rows - appended to {args.results}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
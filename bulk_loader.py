@@ -0,0 +1,118 @@
+"""
+bulk_loader.py
+
+The bulk loader streams rows into the DB with COPY ... FROM STDIN,
+rather than paying one INSERT round trip per row. Rows are sent in
+batches: tables with ON CONFLICT rules are COPY'd into a temporary
+staging table, which is then merged into the target table using the
+same conflict rules as the row-by-row inserts in sql_queries.py.
+Enriched songplays are COPY'd into a staging table with their song
+lookup keys, and merged into songplays and - the keys of those without
+a song match - songplays_unmatched, so both land in the same batch.
+Raw NextSong events can also be COPY'd into the songplays staging
+table, from where one INSERT ... SELECT enriches them into songplays.
+"""
+
+import io
+import logging
+import psycopg2
+import metrics
+from sql_queries import bulk_load_targets
+
+DEF_BATCH_SIZE = 10000
+
+
+def format_copy_value(value):
+    """Format a single value for the COPY text format: None becomes
+    the NULL marker, and backslashes, tabs and line breaks are escaped.
+    Args:       value: any value to be loaded
+    Returns:    COPY text representation of the value
+    """
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
+
+
+def copy_rows(cur, table, columns, rows):
+    """COPY a list of row tuples into a table in a single round trip.
+    Args:       cur: DB cursor
+                table: name of the table to COPY into
+                columns: column names, in row tuple order
+                rows: list of row tuples
+    Returns:    None
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(format_copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+
+
+def load_batch(target, rows, conn, cur):
+    """Load one batch of rows into a target table, via its staging
+    table where it has one, and commit the batch.
+    Args:       target: bulk load target dict from sql_queries.py
+                rows: list of row tuples
+                conn: DB connection
+                cur:  DB cursor
+    Returns:    None
+    """
+    if target['upsert_key'] is not None:
+        # keep only the last row for each key, as the row-by-row
+        # upserts would - ON CONFLICT DO UPDATE can't touch a row twice
+        rows = list({row[target['upsert_key']]: row for row in rows}.values())
+    if target['staging']:
+        cur.execute(target['staging_create'])
+        copy_rows(cur, target['staging'], target['columns'], rows)
+        cur.execute(target['merge'])
+        if target['clear']:
+            cur.execute(target['clear'])
+    else:
+        copy_rows(cur, target['table'], target['columns'], rows)
+    conn.commit()
+
+
+def bulk_load(table, rows, conn, cur, batch_size=DEF_BATCH_SIZE):
+    """Stream rows into a table through COPY, in batches of batch_size.
+    A batch that fails is logged and rolled back, and loading carries
+    on with the next batch.
+    Args:       table: name of the target table (a key of bulk_load_targets)
+                rows: iterable of row tuples, in the target's column order
+                conn: DB connection
+                cur:  DB cursor
+                batch_size: number of rows per COPY batch
+    Returns:    number of rows sent to the DB
+    """
+    target = dict(bulk_load_targets[table], table=table)
+    loaded = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            loaded += _load_or_log(target, batch, conn, cur)
+            batch = []
+    if batch:
+        loaded += _load_or_log(target, batch, conn, cur)
+    logging.debug(f'Bulk loader: {loaded} rows loaded into {table}')
+    return loaded
+
+
+def _load_or_log(target, batch, conn, cur):
+    """Load a batch, logging and rolling back on a DB error.
+    Returns:    number of rows loaded (0 if the batch failed)
+    """
+    try:
+        load_batch(target, batch, conn, cur)
+        metrics.count('rows_out', len(batch))
+        return len(batch)
+    except psycopg2.Error as e:
+        logging.warning(f"caught psycopg2 exception loading {target['table']} batch!")
+        logging.warning(e.pgerror)
+        logging.warning(e.diag.message_primary)
+        conn.rollback()
+        metrics.count('rows_rejected', len(batch))
+        return 0
@@ -0,0 +1,149 @@
+"""
+checkpoint.py
+
+Checkpoints for resumable runs (CHECKPOINT). Each batch of a stage
+(songs, artists, time, users, songplays) is committed together with the
+stage's position - the last input file, and the line within it, that
+the batch covered - in the etl_checkpoint table: the loaders' own
+commits are held back for the length of the batch, and the position is
+saved and committed with it, in one transaction. A batch is therefore
+either loaded and checkpointed, or neither. If the run dies, the next
+run reads the checkpoint and resumes: input is re-read from the earliest
+position of any stage, and each stage skips the records it has already
+committed. A run that completes clears the checkpoint.
+
+A batch the DB rejects any part of is rolled back whole, and fails the
+run, leaving the checkpoint where it was - so the rerun, once the
+problem is fixed, picks up at that batch rather than skipping it.
+
+Positions are compared by the file's place in the run's file list, so
+a checkpoint only carries over to a run over the same input files; a
+checkpointed file that is no longer found is logged, and its stage
+starts over.
+"""
+
+import logging
+from contextlib import contextmanager
+import metrics
+from sql_queries import (checkpoint_table_create, checkpoint_select, checkpoint_upsert,
+                         checkpoint_clear)
+
+NO_POSITION = (-1, -1)
+
+
+class CheckpointConnection(metrics.CountingConnection):
+    """Connection whose commits can be held back for the length of a
+    checkpointed batch (see Checkpoint.batch), and which notes any
+    rollback made meanwhile. Pass as psycopg2.connect(connection_factory=...)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.held = False
+        self.rolled_back = False
+
+    def commit(self):
+        if not self.held:
+            return super().commit()
+
+    def rollback(self):
+        if self.held:
+            self.rolled_back = True
+        return super().rollback()
+
+
+class Checkpoint:
+    def __init__(self, conn, cur):
+        """
+        Initialize the checkpoint from the etl_checkpoint table (created
+        if missing): a dict of stage name -> [file, line].
+        """
+        cur.execute(checkpoint_table_create)
+        cur.execute(checkpoint_select)
+        self.positions = {stage: [file, line] for stage, file, line in cur.fetchall()}
+        conn.commit()
+        self.resumed = bool(self.positions)
+        self.missing = set()
+        if self.resumed:
+            logging.info(f'Checkpoint: resuming from {self.positions}')
+
+    def position(self, stage, file_index):
+        """A stage's position, as (index in the file list, line number).
+        Args:       stage: stage name
+                    file_index: dict of file path -> index in the run's file list
+        Returns:    position tuple; NO_POSITION if the stage has none
+        """
+        if stage not in self.positions:
+            return NO_POSITION
+        file, line = self.positions[stage]
+        if file not in file_index:
+            if stage not in self.missing:
+                self.missing.add(stage)
+                logging.warning(f'Checkpoint: {file} not found - stage {stage} starts over')
+            return NO_POSITION
+        return file_index[file], line
+
+    def start(self, stages, file_index):
+        """Index of the first file any of the stages still needs.
+        Args:       stages: stage names
+                    file_index: dict of file path -> index in the run's file list
+        Returns:    index into the run's file list
+        """
+        return max(min(self.position(stage, file_index)[0] for stage in stages), 0)
+
+    def done(self, stage, file_index, file, line=0):
+        """Whether a stage has already committed up to a position.
+        Args:       stage: stage name
+                    file_index: dict of file path -> index in the run's file list
+                    file: input file
+                    line: line of that file
+        Returns:    bool
+        """
+        return self.position(stage, file_index) >= (file_index[file], line)
+
+    def keep(self, stage, file_index, records):
+        """Drop the records a stage has already committed.
+        Args:       stage: stage name
+                    file_index: dict of file path -> index in the run's file list
+                    records: list of (file, line, record) tuples
+        Returns:    list of the records still to load
+        """
+        done = self.position(stage, file_index)
+        if done == NO_POSITION:
+            return [record for _, _, record in records]
+        return [record for file, line, record in records
+                if (file_index[file], line) > done]
+
+    @contextmanager
+    def batch(self, conn, cur, stage, file, line=0):
+        """Load a batch of a stage and save the stage's position, in one
+        transaction: the commits made by the load are held back, and
+        the position is saved and committed once it has finished.
+        Args:       conn: CheckpointConnection
+                    cur:  DB cursor
+                    stage: stage name
+                    file: last input file covered by the batch
+                    line: last line of that file covered by the batch
+        Returns:    context manager
+        Raises:     RuntimeError if the DB rejected any of the batch, which
+                    is then rolled back whole, leaving the position as it was
+        """
+        conn.held, conn.rolled_back = True, False
+        try:
+            yield
+            if conn.rolled_back:
+                raise RuntimeError(f'{stage} batch up to {file}:{line} rejected by the DB - '
+                                   f'checkpoint left at {self.positions.get(stage)}')
+            cur.execute(checkpoint_upsert, (stage, file, line))
+        except BaseException:
+            conn.held = False
+            conn.rollback()
+            raise
+        conn.held = False
+        conn.commit()
+        self.positions[stage] = [file, line]
+
+    def clear(self, conn, cur):
+        """Clear the checkpoint, once a run has completed."""
+        cur.execute(checkpoint_clear)
+        conn.commit()
+        self.positions = {}
+        logging.debug('Checkpoint: cleared')
@@ -0,0 +1,284 @@
+"""
+columnar_cache.py
+
+A columnar cache of parsed input files, so that reloads, backfills and
+replays over the same files skip JSON decoding. The input files are
+grouped into partitions - a song_data/X/ directory, or a single log
+file - and the parsed records of each partition are written to one
+cache file, tagged with the path, size and mtime of every file they
+were parsed from. While those still match, later runs memory-map the
+cache file instead of parsing the JSON again.
+
+A cache file holds one or more tables (e.g. songs and artists) of
+records with the same keys, stored column by column:
+
+    int / float     int64 / float64 array, plus a null mask if needed
+    str             dictionary-encoded: int32 codes (-1 for null) into
+                    a dictionary of distinct strings, stored as UTF-8
+                    bytes and an int64 offsets array
+    json            anything else (mixed types, big ints, ...), as the
+                    json.dumps of each value, in a str column
+
+so the records read back are exactly the records that were parsed -
+as the same record type (see records.py), when the caller names one.
+Read back, each distinct string of a column is decoded once and shared
+by all the records holding it.
+
+Layout: an 8 byte magic, the length of a JSON header (uint64), the
+header, then each array's raw bytes, aligned to 64 bytes. The header
+holds the source files, and the name, kind and array offsets of every
+column. The arrays are mapped from the file rather than read into
+memory, but reading a table is not zero-copy: each column is decoded
+into a list of Python values, a whole array at a time, and the records
+are rebuilt from those lists. What the cache saves is the JSON parsing
+and per-record field extraction, not the building of the records.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import metrics
+
+MAGIC = b'SPKCOL1\n'
+ALIGN = 64
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+
+def source_stats(files):
+    """Path, size and mtime of each source file, as stored in a cache
+    file's header.
+    Args:       files: list of file paths
+    Returns:    list of [path, size, mtime_ns]
+    """
+    stats = []
+    for path in files:
+        st = os.stat(path)
+        stats.append([path, st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def cache_path(cache_dir, name, partition):
+    """Path of the cache file of a partition.
+    Args:       cache_dir: cache directory
+                name: name of the parsed data (e.g. "songs", "logs")
+                partition: partition path (directory or file)
+    Returns:    cache file path
+    """
+    digest = hashlib.sha1(os.path.abspath(partition).encode()).hexdigest()
+    return os.path.join(cache_dir, f'{name}-{digest}.cols')
+
+
+def _column_kind(values):
+    """Pick the encoding of a column from the types of its values."""
+    types = {type(v) for v in values if v is not None}
+    if not types:
+        return 'null'
+    if types == {int} and all(INT64_MIN <= v <= INT64_MAX for v in values if v is not None):
+        return 'int'
+    if types == {float}:
+        return 'float'
+    if types == {str}:
+        return 'str'
+    return 'json'
+
+
+def _encode_strings(values):
+    """Dictionary-encode a list of str/None values.
+    Returns:    codes, offsets and blob arrays
+    """
+    positions = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        codes[i] = -1 if v is None else positions.setdefault(v, len(positions))
+    encoded = [s.encode('utf-8', 'surrogatepass') for s in positions]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return codes, offsets, blob
+
+
+def _decode_strings(codes, offsets, blob):
+    """Decode a dictionary-encoded column back to a list of str/None."""
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    # code -1 (null) picks the trailing None
+    strings = [data[bounds[i]:bounds[i + 1]].decode('utf-8', 'surrogatepass')
+               for i in range(len(bounds) - 1)] + [None]
+    return [strings[c] for c in codes.tolist()]
+
+
+def encode_column(values):
+    """Encode a column.
+    Args:       values: list of the column's values
+    Returns:    kind; dict of array name -> NumPy array
+    """
+    kind = _column_kind(values)
+    arrays = {}
+    if kind in ('int', 'float'):
+        nulls = [v is None for v in values]
+        if any(nulls):
+            arrays['nulls'] = np.array(nulls, dtype=np.bool_)
+            values = [0 if v is None else v for v in values]
+        arrays['data'] = np.array(values, dtype=np.int64 if kind == 'int' else np.float64)
+    elif kind in ('str', 'json'):
+        if kind == 'json':
+            values = [json.dumps(v) for v in values]
+        arrays['codes'], arrays['offsets'], arrays['blob'] = _encode_strings(values)
+    return kind, arrays
+
+
+def decode_column(kind, arrays, n_rows):
+    """Decode a column back to a list of values.
+    Args:       kind: column kind
+                arrays: dict of array name -> NumPy array
+                n_rows: number of rows
+    Returns:    list of values
+    """
+    if kind == 'null':
+        return [None] * n_rows
+    if kind in ('int', 'float'):
+        values = arrays['data'].tolist()
+        if 'nulls' in arrays:
+            values = [None if null else v for v, null in zip(values, arrays['nulls'].tolist())]
+        return values
+    values = _decode_strings(arrays['codes'], arrays['offsets'], arrays['blob'])
+    if kind == 'json':
+        values = [json.loads(v) for v in values]
+    return values
+
+
+def write_tables(path, sources, tables):
+    """Write parsed tables to a cache file.
+    Args:       path: cache file path
+                sources: source_stats() of the files they were parsed from
+                tables: tuple of lists of records (dicts, or Records)
+    Returns:    None
+    """
+    header = dict(sources=sources, tables=[])
+    buffers = []
+    offset = 0
+    for records in tables:
+        keys = list(records[0]) if records else []
+        columns = []
+        for key in keys:
+            kind, arrays = encode_column([record[key] for record in records])
+            layout = {}
+            for name, array in arrays.items():
+                layout[name] = [offset, array.dtype.str, len(array)]
+                buffers.append((offset, array))
+                offset += -(-array.nbytes // ALIGN) * ALIGN
+            columns.append(dict(key=key, kind=kind, arrays=layout))
+        header['tables'].append(dict(rows=len(records), columns=columns))
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # parser worker processes may write cache files at the same time
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for buf_offset, array in buffers:
+            f.seek(data_start + buf_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_tables(path, sources, record_types=None):
+    """Read parsed tables from a cache file, if it was written from
+    the same source files.
+    Args:       path: cache file path
+                sources: source_stats() of the current files
+                record_types: Record subclass of each table's records,
+                or None to read them as dicts
+    Returns:    tuple of lists of records; or None if there is no
+                usable cache file
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        mm = np.memmap(path, dtype=np.uint8, mode='r')
+        if mm[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('not a columnar cache file')
+        header_len = int(mm[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header_end = len(MAGIC) + 8 + header_len
+        header = json.loads(mm[len(MAGIC) + 8:header_end].tobytes())
+        if header['sources'] != sources:
+            return None
+        data_start = -(-header_end // ALIGN) * ALIGN
+
+        tables = []
+        for index, table in enumerate(header['tables']):
+            keys, columns = [], []
+            for column in table['columns']:
+                arrays = {}
+                for name, (offset, dtype, length) in column['arrays'].items():
+                    dtype = np.dtype(dtype)
+                    start = data_start + offset
+                    arrays[name] = mm[start:start + length * dtype.itemsize].view(dtype)
+                keys.append(column['key'])
+                columns.append(decode_column(column['kind'], arrays, table['rows']))
+            record_type = record_types[index] if record_types else None
+            if record_type is not None and tuple(keys) == record_type._fields:
+                tables.append([record_type(*row) for row in zip(*columns)])
+            elif keys:
+                tables.append([dict(zip(keys, row)) for row in zip(*columns)])
+            else:
+                tables.append([{} for _ in range(table['rows'])])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f'Columnar cache: cannot read {path}: {str(e)}')
+        return None
+    metrics.count('bytes_read', os.path.getsize(path))
+    return tuple(tables)
+
+
+def load_or_parse(partition, files, cache_dir, name, parse_func, record_types=None):
+    """Get the parsed records of a partition: from its cache file if
+    that is still current, or else by parsing the files and writing the
+    cache file.
+    Args:       partition: partition path (directory or file)
+                files: list of the partition's files
+                cache_dir: cache directory
+                name: name of the parsed data (e.g. "songs", "logs")
+                parse_func: function parsing a list of files into a tuple
+                of lists of records
+                record_types: Record subclass of each table's records,
+                or None for dicts
+    Returns:    tuple of lists of records
+    """
+    path = cache_path(cache_dir, name, partition)
+    sources = source_stats(files)
+    tables = read_tables(path, sources, record_types)
+    if tables is not None:
+        metrics.count('rows_out', len(tables[0]))
+        return tables
+
+    tables = parse_func(files)
+    try:
+        write_tables(path, sources, tables)
+    except OSError as e:
+        logging.warning(f'Columnar cache: cannot write {path}: {str(e)}')
+    return tables
+
+
+def partition_files(files, key):
+    """Group consecutive files into partitions.
+    Args:       files: iterable of file paths
+                key: function mapping a file to its partition
+    Returns:    generator of lists of file paths
+    """
+    partition, current = [], None
+    for file in files:
+        part = key(file)
+        if partition and part != current:
+            yield partition
+            partition = []
+        partition.append(file)
+        current = part
+    if partition:
+        yield partition
@@ -59,6 +59,14 @@ class ConfigMgr:
             logging.warning(f'Config Mgr->get(): label: {label} not configured')
             return None
 
+    def set(self, label, value):
+        """Set a config value for this run, overriding config.json.
+        Args:       label: key to json dict for config value
+                    value: the value to set
+        Returns:    None
+        """
+        self.config[self.env][label] = value
+
     def get_db_connect_string(self):
         """ Return a fully-formatted connect string for     
         psycopg2.connect using the config paramters.
@@ -66,10 +74,15 @@ class ConfigMgr:
         Returns:    Fully-formmatted psycopg2.connect string
         """
         template_string = "host={} dbname={} user={} password={}"
-        return template_string.format(self.get("DB_HOST"),
-                                      self.get("DB_NAME"),
-                                      self.get("DB_USER"),
-                                      self.get("DB_PASSWORD"))
+        connect_string = template_string.format(self.get("DB_HOST"),
+                                                self.get("DB_NAME"),
+                                                self.get("DB_USER"),
+                                                self.get("DB_PASSWORD"))
+        # DB_SEARCH_PATH points every connection at other tables,
+        # e.g. a shard's
+        if self.config[self.env].get("DB_SEARCH_PATH"):
+            connect_string += " options='-c search_path={}'".format(self.get("DB_SEARCH_PATH"))
+        return connect_string
 
     def get_db_landing_connect_string(self):
         """ Returns a formatted connect string to connect to the 
@@ -10,7 +10,8 @@ I have added logging and configuration.
 """
 
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import (create_table_queries, drop_table_queries, songplay_table_create,
+                         songplay_table_create_partitioned)
 import sys
 import logging
 import config_mgr
@@ -74,15 +75,19 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False):
     """Iterate over list of "drop table" queries and invoke
     the create table commands on each table.
     Args:       cur: DB cursor
                 conn: DB connection
+                partitioned: True to create songplays range-partitioned
+                by month on start_time (see songplay_partitions.py)
     Returns:    None.
     """
     logging.debug('Running create table queries')
     for query in create_table_queries:
+        if partitioned and query == songplay_table_create:
+            query = songplay_table_create_partitioned
         logging.debug(query)
         cur.execute(query)
         conn.commit()
@@ -93,10 +98,11 @@ def main():
     Args:       None
     Returns:    0 for success
     """
-    cur, conn = create_database(config_mgr.ConfigMgr(env='DB'))
+    cfg = config_mgr.ConfigMgr(env='DB')
+    cur, conn = create_database(cfg)
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, bool(cfg.get("PARTITION_SONGPLAYS")))
 
     conn.close()
     # success
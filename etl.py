@@ -9,156 +9,493 @@ data, and then insert data.
 
 import os
 import sys
-import glob
+import asyncio
 import psycopg2
 from sql_queries import *
 from psycopg2.errors import UniqueViolation
 import json
 from json import JSONDecodeError
 import datetime
+import functools
+from contextlib import contextmanager
 import re
 import logging
+import metrics
 from config_mgr import ConfigMgr
+from bulk_loader import bulk_load, DEF_BATCH_SIZE
+from song_index import (SongIndexBuilder, song_key, build_song_index, fetch_song_index,
+                        files_fingerprint, load_song_index, save_song_index)
+from records import SongRecord, ArtistRecord, LogEvent
+from log_decoder import get_loads, maybe_next_song, project_event, NEXT_SONG
+from columnar_cache import load_or_parse, partition_files
+from input_files import iter_json_streams, is_archive, READ_ERRORS
+from file_discovery import iter_files, load_listing, save_listing, DateRange
+from manifest import get_new_files, record_files, file_entries
+from songplay_partitions import ensure_partitions, deferred_indexes
+from user_dimension import UserDimensionBuilder, build_user_dimension
+from log_fanout import LogFanOut, DEF_FANOUT_BUFFER_SIZE, FANOUT_TABLES
+import async_writer
+from async_writer import load_rows, run_queue, DEF_ASYNC_WRITERS, DEF_ASYNC_IN_FLIGHT
+import create_tables
+from psycopg2.pool import ThreadedConnectionPool
+from stage_scheduler import Stage, run_stages
+from time_dimension import to_ts_array, time_columns, time_column_rows, timestamp_strings
+from parallel_parser import parse_chunks, chunk_files, DEF_PARSE_WORKERS, DEF_PARSE_CHUNK_SIZE
+from checkpoint import Checkpoint, CheckpointConnection
+import validation
+from rollups import refresh_rollups
+from backfill import backfill_songplays
+import sharding
+from validation import validate_rows
+
+DEF_STREAM_BATCH_SIZE = 5000
+DEF_DB_POOL_SIZE = 4
 
 
 
 def get_files(filepath):
     """Given a file path, walk the directory hierarchy
-    and collect the absolute path of all JSON files.
+    and collect the absolute path of all JSON files (compressed or
+    not, and tar bundles of them).
     NOTE:  This file was provided in the etl.ipynb template!
 
     Args:       file path
     Returns:    list of JSON files
     """
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
-    
-    return all_files
+    return list(iter_files(filepath))
 
 
-def get_song_and_artist_data(song_files):
-    """Iterate over the song files and collect data for both
+def batched(iterable, batch_size):
+    """Group an iterable into lists of at most batch_size items.
+    Args:       iterable: any iterable
+                batch_size: maximum number of items per batch
+    Returns:    generator of lists
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_song(f):
+    """Parse a single song document and extract its song and artist data.
+    Args:       f: binary file object of the song JSON
+    Returns:    song data record, artist data record (see records.py);
+                or None, None if the song can't be parsed
+    """
+    metrics.count('rows_in')
+    try:
+        data = json.load(f)
+        song = SongRecord(data['song_id'],
+                          data['title'],
+                          data['artist_id'],
+                          data['year'],
+                          data['duration'])
+        artist = ArtistRecord(data['artist_id'],
+                              data['artist_name'],
+                              data['artist_location'],
+                              data['artist_latitude'],
+                              data['artist_longitude'])
+        metrics.count('rows_out')
+        return song, artist
+
+    except KeyError as e:
+        logging.critical(f'Key Error:  {str(e)}')
+    except JSONDecodeError as e:
+        logging.critical('Msg: {e.msg}, Doc: {e.doc}, Pos: {e.pos}, LineNo: {e.lineno}, ColNo: {e.colno}')
+    metrics.count('rows_rejected')
+    return None, None
+
+
+def read_song_file(file):
+    """Read a song file - a single song, compressed or not, or a tar
+    bundle of them (see input_files.py) - and extract its song and
+    artist data.
+    Args:       song file
+    Returns:    list of (song data record, artist data record) tuples
+    """
+    metrics.count('bytes_read', os.path.getsize(file))
+    songs = []
+    try:
+        for _, f in iter_json_streams(file):
+            song, artist = read_song(f)
+            if song:
+                songs.append((song, artist))
+    except READ_ERRORS as e:
+        logging.critical(f'Failed to read {file}: {str(e)}')
+        metrics.count('rows_rejected')
+    return songs
+
+
+def read_song_files(song_files):
+    """Read a list of song files and collect data for both
     songs and artists.
     Args:       List of song files
-    Returns:    list of song data dicts, list of artist data dicts
+    Returns:    list of song data records, list of artist data records
     """
     song_data = []
     artist_data = []
     for file in song_files:
-        with open(file) as f:
-            try:
-                data = json.load(f)
-                song_data.append(dict(song_id=data['song_id'],
-                                      title=data['title'],
-                                      artist_id=data['artist_id'],
-                                      year=data['year'],
-                                      duration=data['duration']))
-                artist_data.append(dict(artist_id=data['artist_id'],
-                                        artist_name=data['artist_name'],
-                                        artist_location=data['artist_location'],
-                                        artist_latitude=data['artist_latitude'],
-                                        artist_longitude=data['artist_longitude']))
+        for song, artist in read_song_file(file):
+            song_data.append(song)
+            artist_data.append(artist)
+    return song_data, artist_data
 
-            except KeyError as e:
-                logging.critical(f'Key Error:  {str(e)}')
-                continue   
-            except JSONDecodeError as e:
-                logging.critical('Msg: {e.msg}, Doc: {e.doc}, Pos: {e.pos}, LineNo: {e.lineno}, ColNo: {e.colno}')
-                continue
+
+def song_partition(file):
+    """Cache partition of a song file: song files are stored under
+    song_data/X/Y/Z/, and single song files are tiny, so they are
+    cached a whole song_data/X/ directory at a time. A tar bundle of
+    songs is cached on its own."""
+    if is_archive(file):
+        return file
+    return os.path.dirname(os.path.dirname(os.path.dirname(file)))
+
+
+def read_cached_song_files(partitions, cache_dir):
+    """Read song_data/X/ directories through the columnar cache (see
+    columnar_cache.py), parsing only those whose files have changed.
+    Args:       partitions: list of lists of song files, one per song_data/X/
+                cache_dir: columnar cache directory
+    Returns:    list of song data records, list of artist data records
+    """
+    song_data = []
+    artist_data = []
+    for files in partitions:
+        songs, artists = load_or_parse(song_partition(files[0]), files, cache_dir,
+                                       'songs', read_song_files, (SongRecord, ArtistRecord))
+        song_data.extend(songs)
+        artist_data.extend(artists)
     return song_data, artist_data
 
 
-def insert_song_data(song_data, conn, cur):
-    """Insert data from the list of song data dicts into the song table.
-    Args:       song_data: List of song data dicts
-                conn: DB connection
-                cur:  DB cursor
+def song_parser(song_files, cache_dir=None):
+    """Pick the parse function for the song files: straight from JSON,
+    or, with a columnar cache directory, through the cache - in which
+    case the files are handed out grouped by song_data/X/ directory.
+    Args:       song_files: iterable of song files
+                cache_dir: columnar cache directory, or None
+    Returns:    parse function; iterable of its inputs
+    """
+    if not cache_dir:
+        return read_song_files, song_files
+    return (functools.partial(read_cached_song_files, cache_dir=cache_dir),
+            partition_files(song_files, song_partition))
+
+
+def iter_song_and_artist_data(song_files, batch_size, workers=DEF_PARSE_WORKERS,
+                              cache_dir=None):
+    """Stream song and artist data from the song files, in batches.
+    Args:       song_files: iterable of song files
+                batch_size: number of song files (song_data/X/ directories, when
+                cached) per batch
+                workers: number of parser processes
+                cache_dir: columnar cache directory, or None
+    Returns:    generator of (list of song data records, list of artist data records)
+    """
+    parse_func, inputs = song_parser(song_files, cache_dir)
+    return parse_chunks(parse_func, inputs, workers, batch_size)
+
+
+def iter_positioned_song_data(song_files, batch_size, workers=DEF_PARSE_WORKERS,
+                              cache_dir=None):
+    """Stream song and artist data from the song files, in batches, each
+    with the last song file it covers - for checkpointed runs.
+    Args:       song_files: list of song files
+                batch_size: number of song files (song_data/X/ directories, when
+                cached) per batch
+                workers: number of parser processes
+                cache_dir: columnar cache directory, or None
+    Returns:    generator of (list of song data records, list of artist data records,
+                last song file)
+    """
+    parse_func, inputs = song_parser(song_files, cache_dir)
+    inputs = list(inputs)
+    # parse_chunks() chunks its inputs exactly as chunk_files() does
+    for chunk, (songs, artists) in zip(chunk_files(inputs, batch_size),
+                                       parse_chunks(parse_func, inputs, workers, batch_size)):
+        last = chunk[-1] if cache_dir is None else chunk[-1][-1]
+        yield songs, artists, last
+
+
+def get_song_and_artist_data(song_files, workers=DEF_PARSE_WORKERS,
+                             chunk_size=DEF_PARSE_CHUNK_SIZE, cache_dir=None):
+    """Iterate over the song files and collect data for both
+    songs and artists.
+    Args:       List of song files
+                workers: number of parser processes
+                chunk_size: number of files (song_data/X/ directories, when
+                cached) handed to a parser at a time
+                cache_dir: columnar cache directory, or None
+    Returns:    list of song data records, list of artist data records
+    """
+    song_data = []
+    artist_data = []
+    parse_func, inputs = song_parser(song_files, cache_dir)
+    for songs, artists in parse_chunks(parse_func, inputs, workers, chunk_size):
+        song_data.extend(songs)
+        artist_data.extend(artists)
+    return song_data, artist_data
+
+
+def insert_rows(query, rows, conn, cur):
+    """Insert rows one by one with an insert query, logging and
+    skipping the rows the DB rejects, then commit.
+    Args:       query: insert query
+                rows: iterable of row tuples
+                conn:  DB connection
+                cur:   DB cursor
     Returns:    None
     """
-    for song in song_data:
+    rows_out = rejected = 0
+    for insert_vals in rows:
         try:
-            song_data = (song['song_id'], 
-                         song['title'],
-                         song['artist_id'],
-                         song['year'],
-                         song['duration'])
-            cur.execute(song_table_insert, song_data)
+            cur.execute(query, insert_vals)
+            rows_out += 1
         except psycopg2.Error as e:
             logging.warning('caught psycopg2 exception!')
             logging.warning(e.pgerror)
             logging.warning(e.diag.message_primary)
+            rejected += 1
             continue
+    # end of for loop
+    metrics.count('rows_out', rows_out)
+    metrics.count('rows_rejected', rejected)
+    conn.commit()
+
+
+def song_rows(song_data):
+    """Build the song table rows from the list of song data records.
+    Args:       song_data: List of song data records
+    Returns:    generator of song row tuples
+    """
+    for song in song_data:
+        try:
+            yield (song['song_id'],
+                   song['title'],
+                   song['artist_id'],
+                   song['year'],
+                   song['duration'])
         except KeyError as e:
-            logging.warrning(f'Key Error:  {str(e)}')
-            continue   
-    # end of for loop            
-    conn.commit()    
+            logging.warning(f'Key Error:  {str(e)}')
+            metrics.count('rows_rejected')
+            continue
 
 
-def insert_artist_data(artist_data, conn, cur):
-    """Insert data from the list of artist data dicts.
-    Args:       artist_data: list of artist data dicts
-                conn:  DB connection
-                cur:   DB cursor
+def insert_song_data(song_data, conn, cur, batch_size=None):
+    """Insert data from the list of song data records into the song table.
+    Args:       song_data: List of song data records
+                conn: DB connection
+                cur:  DB cursor
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
     Returns:    None
     """
+    metrics.count('rows_in', len(song_data))
+    rows = validate_rows('songs', song_rows(song_data))
+    if batch_size:
+        bulk_load('songs', rows, conn, cur, batch_size)
+        return
+    insert_rows(song_table_insert, rows, conn, cur)
+
+
+def artist_rows(artist_data):
+    """Build the artist table rows from the list of artist data records,
+    skipping artists without an ID.
+    Args:       artist_data: list of artist data records
+    Returns:    generator of artist row tuples
+    """
     for artist in artist_data:
         artist_id = artist['artist_id']
         if artist_id:
-            artist_data = (artist_id, 
-                           artist['artist_name'],
-                           artist['artist_location'],
-                           artist['artist_latitude'],
-                           artist['artist_longitude'])
-            try:
-                cur.execute(artist_table_insert, artist_data)
-            except psycopg2.Error as e:
-                    logging.warning('caught psycopg2 exception!')
-                    logging.warning(e.pgerror)
-                    logging.warning(e.diag.message_primary)
-                    continue
-    # end of for loop                    
-    conn.commit()
+            yield (artist_id, 
+                   artist['artist_name'],
+                   artist['artist_location'],
+                   artist['artist_latitude'],
+                   artist['artist_longitude'])
 
 
-def get_all_log_data(log_files):
-    """Read all log event data and build up a list of dictionaries
-    containing all the relevant data fields we are interested in using
-    for our DB inserts.
-    Args:       list of all log event JSON files
-    Returns:    list of log data dicts
+def insert_artist_data(artist_data, conn, cur, batch_size=None):
+    """Insert data from the list of artist data records.
+    Args:       artist_data: list of artist data records
+                conn:  DB connection
+                cur:   DB cursor
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
+    Returns:    None
     """
-    all_log_data = []
-    for file in log_files:
-        with open(file, 'r') as f:
+    metrics.count('rows_in', len(artist_data))
+    rows = validate_rows('artists', artist_rows(artist_data))
+    if batch_size:
+        bulk_load('artists', rows, conn, cur, batch_size)
+        return
+    insert_rows(artist_table_insert, rows, conn, cur)
+
+
+def read_log_lines(file):
+    """Read a single log event file, yielding a dictionary of the relevant
+    data fields for each NextSong event, with the number of the line it
+    was read from. Lines that can't be NextSong events are skipped before
+    parsing (see log_decoder.py). The file may be compressed, or a tar
+    bundle of log files (see input_files.py), whose lines are numbered
+    on from one member to the next.
+    Args:       log event JSON file
+    Returns:    generator of (line number, log data record)
+    """
+    loads = get_loads()
+    lines = rows_out = rejected = 0
+    # a log file appended to since it was loaded is read from where
+    # that load stopped (see manifest.py)
+    offset = getattr(file, 'offset', 0)
+    metrics.count('bytes_read', os.path.getsize(file) - offset)
+    try:
+        for _, f in iter_json_streams(file):
+            if offset:
+                f.seek(offset)
             for line in f:
+                lines += 1
+                if not maybe_next_song(line):
+                    continue
                 try:
-                    data = json.loads(line)
+                    data = loads(line)
                 except JSONDecodeError as e:
                     logging.warning('Msg: {e.msg}, Doc: {e.doc}, Pos: {e.pos}, LineNo: {e.lineno}, ColNo: {e.colno}')
+                    rejected += 1
                     continue
-                    
-                if data['page'] == 'NextSong':
+
+                if data['page'] == NEXT_SONG:
                     try:
-                        all_log_data.append(dict(ts=data['ts'],
-                                                 user_id=data['userId'],
-                                                 first_name=data['firstName'],
-                                                 last_name=data['lastName'],
-                                                 gender=data['gender'],
-                                                 level=data['level'],
-                                                 song_title=data['song'],
-                                                 artist_name=data['artist'],
-                                                 length=data['length'],
-                                                 session_id=data['sessionId'],
-                                                 location=data['location'],
-                                                 user_agent=data['userAgent']
-                                                ))
+                        entry = project_event(data)
                     except KeyError as e:
                         logging.warning(f'Key Error:  {str(e)}')
+                        rejected += 1
                         continue
+                    rows_out += 1
+                    yield lines, entry
+    except READ_ERRORS as e:
+        # a damaged compressed file or archive: keep what was read of it
+        logging.critical(f'Failed to read {file}: {str(e)}')
+        rejected += 1
+    metrics.count('rows_in', lines)
+    metrics.count('rows_out', rows_out)
+    metrics.count('rows_rejected', rejected)
+
+
+def read_log_file(file):
+    """Read a single log event file, yielding a dictionary of the relevant
+    data fields for each NextSong event.
+    Args:       log event JSON file
+    Returns:    generator of log data records
+    """
+    for _, entry in read_log_lines(file):
+        yield entry
+
+
+def read_log_files(log_files):
+    """Read a list of log event files.
+    Args:       list of log event JSON files
+    Returns:    list of log data records
+    """
+    log_data = []
+    for file in log_files:
+        log_data.extend(read_log_file(file))
+    return log_data
+
+
+def read_positioned_log_files(log_files):
+    """Read a list of log event files, keeping the file and line number
+    each NextSong event was read from - for checkpointed runs.
+    Args:       list of log event JSON files
+    Returns:    list of (file, line number, log data record)
+    """
+    return [(file, line, entry)
+            for file in log_files
+            for line, entry in read_log_lines(file)]
+
+
+def read_cached_log_files(log_files, cache_dir):
+    """Read log event files through the columnar cache (see
+    columnar_cache.py), parsing only those that have changed.
+    Args:       log_files: list of log event JSON files
+                cache_dir: columnar cache directory
+    Returns:    list of log data records
+    """
+    log_data = []
+    for file in log_files:
+        # the cache holds whole files, not what was appended to one
+        if getattr(file, 'offset', 0):
+            log_data.extend(read_log_file(file))
+            continue
+        events, = load_or_parse(file, [file], cache_dir, 'logs',
+                                lambda files: (read_log_files(files),), (LogEvent,))
+        log_data.extend(events)
+    return log_data
+
+
+def log_parser(cache_dir=None):
+    """Pick the parse function for the log files: straight from JSON,
+    or through the columnar cache.
+    Args:       cache_dir: columnar cache directory, or None
+    Returns:    parse function
+    """
+    if not cache_dir:
+        return read_log_files
+    return functools.partial(read_cached_log_files, cache_dir=cache_dir)
+
+
+def iter_log_data(log_files, batch_size, workers=DEF_PARSE_WORKERS,
+                  chunk_size=DEF_PARSE_CHUNK_SIZE, cache_dir=None):
+    """Stream log event data from the log files, in batches of
+    NextSong events (batches may span files).
+    Args:       log_files: iterable of log event JSON files
+                batch_size: number of log data records per batch
+                workers: number of parser processes
+                chunk_size: number of files handed to a parser at a time
+                cache_dir: columnar cache directory, or None
+    Returns:    generator of lists of log data records
+    """
+    events = (entry
+              for log_data in parse_chunks(log_parser(cache_dir), log_files, workers, chunk_size)
+              for entry in log_data)
+    return batched(events, batch_size)
+
+
+def iter_positioned_log_data(log_files, batch_size, workers=DEF_PARSE_WORKERS,
+                             chunk_size=DEF_PARSE_CHUNK_SIZE):
+    """Stream log event data from the log files, in batches of NextSong
+    events, each event with the file and line it was read from. (The
+    columnar cache doesn't keep line numbers, so it isn't used.)
+    Args:       log_files: iterable of log event JSON files
+                batch_size: number of events per batch
+                workers: number of parser processes
+                chunk_size: number of files handed to a parser at a time
+    Returns:    generator of lists of (file, line number, log data record)
+    """
+    events = (event
+              for log_data in parse_chunks(read_positioned_log_files, log_files, workers,
+                                           chunk_size)
+              for event in log_data)
+    return batched(events, batch_size)
+
+
+def get_all_log_data(log_files, workers=DEF_PARSE_WORKERS,
+                     chunk_size=DEF_PARSE_CHUNK_SIZE, cache_dir=None):
+    """Read all log event data and build up a list of dictionaries
+    containing all the relevant data fields we are interested in using
+    for our DB inserts.
+    Args:       list of all log event JSON files
+                workers: number of parser processes
+                chunk_size: number of files handed to a parser at a time
+                cache_dir: columnar cache directory, or None
+    Returns:    list of log data records
+    """
+    all_log_data = []
+    for log_data in parse_chunks(log_parser(cache_dir), log_files, workers, chunk_size):
+        all_log_data.extend(log_data)
     return all_log_data
 
 
@@ -173,83 +510,142 @@ def get_timestamp(ts):
     return dt, dt.strftime('%Y-%m-%d %H:%M:%S.%f')
 
 
-def insert_time_data(all_log_data, conn, cur):
-    """Take time data from the list of log event data dicts
+def log_timestamps(all_log_data):
+    """Collect the distinct timestamps of the log events, as a
+    sorted NumPy int64 array of milliseconds.
+    Args:       all_log_data: list of log data records
+    Returns:    NumPy int64 array
+    """
+    def ts_values():
+        for entry in all_log_data:
+            try:
+                yield entry['ts']
+            except KeyError as e:
+                logging.warning(f'Key Error:  {str(e)}')
+                metrics.count('rows_rejected')
+    return to_ts_array(ts_values())
+
+
+def time_rows(all_log_data):
+    """Build the time table rows from the list of log event data records,
+    one row per distinct timestamp. The time attributes are derived a
+    whole column at a time (see time_dimension.py).
+    Args:       all_log_data: list of log data records
+    Returns:    iterator of time row tuples
+    """
+    return time_column_rows(time_columns(log_timestamps(all_log_data)))
+
+
+def insert_time_data(all_log_data, conn, cur, batch_size=None):
+    """Take time data from the list of log event data records
     and prepare the insert values, then insert into the
     time table.
-    Args:       all_log_data: list of log data dicts
+    Args:       all_log_data: list of log data records
                 conn:  DB connection
                 cur:   DB cursor
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
     Returns:    None
     """
-    seen_timestamps = set()
-    for entry in all_log_data:
-        ts = None
-        try:
-            ts = entry['ts']
-        except KeyError as e:
-            logging.warning(f'Key Error:  {str(e)}')
-            continue
-        if ts and ts not in seen_timestamps:
-            seen_timestamps.add(ts)
-            dt, timestamp = get_timestamp(ts)
-            hour = dt.hour
-            day = dt.day
-            year, week, weekday = dt.isocalendar()
-            month = dt.month
-            insert_vals = (timestamp, hour, day, week, month, year, weekday)
-            try:
-                cur.execute(time_table_insert , insert_vals)
-            except psycopg2.Error as e:
-                    logging.warning('caught psycopg2 exception!')
-                    logging.warning(e.pgerror)
-                    logging.warning(e.diag.message_primary)
-                    continue
-    # end of for loop
-    conn.commit()
+    metrics.count('rows_in', len(all_log_data))
+    rows = validate_rows('time', time_rows(all_log_data))
+    if batch_size:
+        bulk_load('time', rows, conn, cur, batch_size)
+        return
+    insert_rows(time_table_insert, rows, conn, cur)
 
 
-def insert_user_data(all_log_data, conn, cur):
-    """Extract user data from the lost of log event data dicts
-    and insert into the user table.
-    Args:       all_log_data: list of log event data dicts
+def user_rows(all_log_data):
+    """Build the user table rows from the list of log event data records,
+    skipping events with missing user attributes: one row per user, with
+    its latest state by ts (see user_dimension.py).
+    Args:       all_log_data: list of log event data records
+    Returns:    list of user row tuples
+    """
+    return build_user_dimension(all_log_data).rows()
+
+
+def load_user_dimension(users, conn, cur, batch_size=None, history=False):
+    """Load a user dimension into the user table - one upsert per user,
+    rather than one per event - and, optionally, its level changes into
+    the user_levels table.
+    Args:       users: UserDimensionBuilder instance
                 conn:  DB connection
                 cur:   DB cursor
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
+                history: True to load the user level history too
     Returns:    None
     """
-    for entry in all_log_data:
-        user_id = first_name = last_name = gender = level = None
-        try:
-            user_id = entry['user_id']
-            first_name = entry['first_name']
-            last_name = entry['last_name']
-            gender = entry['gender']
-            level = entry['level']
-        except KeyError as e:
-            logging.warning(f'Key Error:  {str(e)}')
-            continue
-        if user_id and first_name and last_name and gender and level: 
-            insert_vals = (user_id, first_name, last_name, gender, level)
-            try:
-                cur.execute(user_table_insert, insert_vals)
-            except psycopg2.Error as e:
-                    logging.warning('caught psycopg2 exception!')
-                    logging.warning(e.pgerror)
-                    logging.warning(e.diag.message_primary)
-                    continue    
-    # end of for loop
-    conn.commit()    
+    rows = validate_rows('users', users.rows())
+    if batch_size:
+        bulk_load('users', rows, conn, cur, batch_size)
+    else:
+        insert_rows(user_table_insert, rows, conn, cur)
+    if not history:
+        return
+    rows = validate_rows('user_levels', users.history_rows())
+    if batch_size:
+        bulk_load('user_levels', rows, conn, cur, batch_size)
+    else:
+        insert_rows(user_level_table_insert, rows, conn, cur)
 
 
-def insert_songplay_data(all_log_data, conn, cur):
-    """Extract all songplay data attributes from list of
-    log event data dicts, as well as fetch associated song_ids and artist_ids 
-    (when they exist!) to enrich fields to insert into the main songplay table.
-    Args:       all_log_data: list of log data dicts
+def insert_user_data(all_log_data, conn, cur, batch_size=None, history=False):
+    """Extract user data from the lost of log event data records
+    and insert into the user table.
+    Args:       all_log_data: list of log event data records
                 conn:  DB connection
-                cur:   DB cursor                    
+                cur:   DB cursor
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
+                history: True to load the user level history too
     Returns:    None
     """
+    metrics.count('rows_in', len(all_log_data))
+    load_user_dimension(build_user_dimension(all_log_data), conn, cur, batch_size, history)
+
+
+def lookup_song(song_title, artist_name, duration, cur, song_index=None):
+    """Find the song ID and artist ID of a song, based on its title,
+    artist name, and duration - either by probing the in-memory song
+    index, or by running the song select query.
+    Args:       song_title: song title
+                artist_name: artist name
+                duration: song duration
+                cur:  DB cursor
+                song_index: optional song index dict (see song_index.py)
+    Returns:    (song_id, artist_id), or (None, None) if there is no match
+    """
+    if song_index is not None:
+        return song_index.get(song_key(song_title, artist_name, duration), (None, None))
+    # escape apostrophes in song titles
+    song_title = re.sub("'", "''", song_title)
+    # and escape apostrophes in artist names
+    artist_name = re.sub("'", "''", artist_name)            
+    cur.execute(song_select_qry.format(song_title, artist_name, duration))
+    row = cur.fetchone()
+    if row:
+        return row
+    return None, None
+
+
+def songplay_rows(all_log_data, cur, song_index=None):
+    """Extract all songplay data attributes from list of
+    log event data records, as well as fetch associated song_ids and artist_ids 
+    (when they exist!) to enrich fields for the main songplay table.
+    Each row ends with the song lookup key (title, artist name, duration),
+    kept in songplays_unmatched, by the same load, for the songplays
+    without a song match.
+    Args:       all_log_data: list of log data records
+                cur:   DB cursor used for the song lookups
+                song_index: optional song index dict; if given, lookups
+                probe the index rather than querying the DB
+    Returns:    generator of songplay row tuples
+    """
+    # format all start times up front, a whole array at a time
+    ts = to_ts_array(entry.get('ts') for entry in all_log_data)
+    start_times = dict(zip(ts.tolist(), timestamp_strings(ts).tolist()))
     for entry in all_log_data:
         # find the song ID and artist ID based on the title, artist name, and duration of a song.
         #  timestamp, user ID, level, song ID, artist ID, session ID, location, and user agent 
@@ -258,128 +654,980 @@ def insert_songplay_data(all_log_data, conn, cur):
         artist_name = entry['artist_name']
         duration = entry['length']
         if song_title and artist_name and duration:
-            # escape apostrophes in song titles
-            song_title = re.sub("'", "''", song_title)
-            # and escape apostrophes in artist names
-            artist_name = re.sub("'", "''", artist_name)            
-            query = song_select_qry.format(song_title, artist_name, duration)
             try:
-                song_id = artist_id = None
-                cur.execute(query)
-                row = cur.fetchone()
-                if row:
-                    song_id, artist_id = row
+                song_id, artist_id = lookup_song(song_title, artist_name, duration,
+                                                 cur, song_index)
                 
-                _, timestamp = get_timestamp(entry['ts'])
+                timestamp = start_times[entry['ts']]
                 user_id = entry['user_id']
                 level = entry['level']
                 session_id = entry['session_id']
                 location = entry['location']
                 user_agent = entry['user_agent']
-                insert_vals = (timestamp, user_id, level, song_id, artist_id, 
-                               session_id, location, duration)
-                cur.execute(songplay_table_insert, insert_vals)
+                yield (timestamp, user_id, level, song_id, artist_id, 
+                       session_id, location, user_agent,
+                       song_title, artist_name, duration)
 
             except psycopg2.Error as e:
                 logging.warning('caught psycopg2 exception!')
                 logging.warning(e.pgerror)
                 logging.warning(e.diag.message_primary)
+                metrics.count('rows_rejected')
                 continue     
             except KeyError as e:
                 logging.warning(f'Key Error:  {str(e)}')
+                metrics.count('rows_rejected')
                 continue
-    # end of for loop                
-    conn.commit()    
 
 
+def songplay_event_rows(all_log_data):
+    """Extract the raw songplay attributes - with the song title, artist
+    name and duration in place of the song and artist IDs - from the list
+    of log event data records, for enrichment in the DB.
+    Args:       all_log_data: list of log data records
+    Returns:    generator of songplay staging row tuples
+    """
+    ts = to_ts_array(entry.get('ts') for entry in all_log_data)
+    start_times = dict(zip(ts.tolist(), timestamp_strings(ts).tolist()))
+    for entry in all_log_data:
+        try:
+            song_title = entry['song_title']
+            artist_name = entry['artist_name']
+            duration = entry['length']
+            if song_title and artist_name and duration:
+                yield (start_times[entry['ts']], entry['user_id'], entry['level'],
+                       song_title, artist_name, duration,
+                       entry['session_id'], entry['location'], entry['user_agent'])
+        except KeyError as e:
+            logging.warning(f'Key Error:  {str(e)}')
+            metrics.count('rows_rejected')
+            continue
+
 
-def main():
-    """Main routine to drive all the work for the ETP pipeline.
-    Args:       None
+def insert_songplay_data(all_log_data, conn, cur, batch_size=None, song_index=None,
+                         sql_join=False):
+    """Insert the enriched songplay rows into the main songplay table.
+    Args:       all_log_data: list of log data records
+                conn:  DB connection
+                cur:   DB cursor                    
+                batch_size: if set, stream rows through COPY in batches
+                of this size, rather than inserting row by row
+                song_index: optional song index dict used for enrichment
+                sql_join: if True, COPY the raw events into the songplays
+                staging table and enrich them with one join in the DB
+                (in batches of batch_size, or DEF_BATCH_SIZE)
+    Returns:    None
+    """
+    metrics.count('rows_in', len(all_log_data))
+    # create any monthly partitions these songplays need (if partitioned)
+    ensure_partitions(conn, cur, to_ts_array(entry.get('ts') for entry in all_log_data))
+    if sql_join:
+        bulk_load('songplay_events',
+                  validate_rows('songplay_events', songplay_event_rows(all_log_data)),
+                  conn, cur, batch_size or DEF_BATCH_SIZE)
+        return
+    # the unmatched songplays' song lookup keys are kept for the backfill
+    # by the same inserts, so only for the songplays actually loaded
+    rows = validate_rows('songplays', songplay_rows(all_log_data, cur, song_index))
+    if batch_size:
+        bulk_load('songplays', rows, conn, cur, batch_size)
+    else:
+        insert_rows(songplay_table_insert, rows, conn, cur)
+
+
+
+def log_fanout(cfg, conn, cur, batch_size, song_index, stage):
+    """Set up the fused log stage (see log_fanout.py): one pass over the
+    log events, fanning them out to the time, user and songplay loads,
+    each buffer loaded as soon as it holds FANOUT_BUFFER_SIZE rows.
+    Args:       cfg: ConfigMgr instance
+                conn: DB connection
+                cur:  DB cursor
+                batch_size: COPY batch size, or None for row-by-row inserts
+                song_index: song index dict used for enrichment, or None
+                stage: function taking a table name and returning the
+                context manager to load its buffer in (e.g. RunMetrics.stage)
+    Returns:    LogFanOut instance; its users are loaded by the caller
+    """
+    def flush_time(ts, events):
+        metrics.count('rows_in', events)
+        rows = validate_rows('time', time_column_rows(time_columns(to_ts_array(ts))))
+        if batch_size:
+            bulk_load('time', rows, conn, cur, batch_size)
+        else:
+            insert_rows(time_table_insert, rows, conn, cur)
+
+    def flush_songplays(log_data, events):
+        insert_songplay_data(log_data, conn, cur, batch_size, song_index, enrich_in_db(cfg))
+
+    return LogFanOut(flush_time, flush_songplays, UserDimensionBuilder(),
+                     cfg.get("FANOUT_BUFFER_SIZE") or DEF_FANOUT_BUFFER_SIZE, stage)
+
+
+def discover_files(cfg, conn, cur, label, incremental=False):
+    """Collect the input files under a configured data path, reusing
+    the directory listings cached in DISCOVERY_CACHE for directories
+    that haven't changed. Log files are limited to the LOG_DATE_FROM -
+    LOG_DATE_TO window, if one is set. The files are returned along with
+    the manifest entries to record once they have been loaded; for
+    incremental runs, only the files that are new or changed since they
+    were last loaded are (log files only if they were appended to - see
+    manifest.py).
+    Args:       cfg: ConfigMgr instance
+                conn: DB connection
+                cur:  DB cursor
+                label: config label of the data path (SONG_DATA or LOG_DATA)
+                incremental: True to filter files through the manifest
+    Returns:    list of files; list of manifest entries
+    """
+    root = cfg.get(label)
+    cache_file = cfg.get("DISCOVERY_CACHE")
+    date_range = None
+    if label == "LOG_DATA" and (cfg.get("LOG_DATE_FROM") or cfg.get("LOG_DATE_TO")):
+        date_range = DateRange(cfg.get("LOG_DATE_FROM"), cfg.get("LOG_DATE_TO"))
+
+    listing = load_listing(cache_file, root) if cache_file else None
+    files = list(iter_files(root, listing, date_range))
+    if cache_file:
+        try:
+            save_listing(cache_file, root, listing)
+        except OSError as e:
+            logging.warning(f"Failed to save listing cache {cache_file}: {str(e)}")
+    logging.info(f"Discovery: found {len(files)} files under {root}")
+    # every shard needs all the songs to enrich its songplays,
+    # so only the log files are split between the shards
+    if label == "LOG_DATA" and cfg.get("SHARD"):
+        files = sharding.shard_files(files, root, cfg.get("SHARD"))
+        logging.info(f"Discovery: {len(files)} files in shard {cfg.get('SHARD')}")
+    if not incremental:
+        return files, file_entries(files)
+    return get_new_files(conn, cur, files, append_only=label == "LOG_DATA")
+
+
+def song_index_builder(cfg, song_files, incremental=False):
+    """For the streaming modes, which see the parsed song data a batch at
+    a time: look the song index up in SONG_INDEX_CACHE before the songs
+    are read, and only collect them into a SongIndexBuilder if the index
+    is to be built from them - SONG_INDEX "data", on a full run, with no
+    cached index built from the same song files. Otherwise the builder
+    would hold every song, for an index that is never used.
+    Args:       cfg: ConfigMgr instance
+                song_files: list of song files read this run
+                incremental: True for incremental runs (see get_song_index())
+    Returns:    SongIndexBuilder, or None; the cached song index, or None
+    """
+    if cfg.get("SONG_INDEX") != 'data' or incremental:
+        return None, None
+    song_index = load_song_index(cfg.get("SONG_INDEX_CACHE"), files_fingerprint(song_files))
+    if song_index is not None:
+        return None, song_index
+    return SongIndexBuilder(), None
+
+
+def get_song_index(cfg, song_files, build_index, cur, incremental=False, looked_up=False):
+    """Get the song index used to enrich songplays, according to the
+    SONG_INDEX config: "data" builds it from the parsed song data (or
+    loads it from SONG_INDEX_CACHE, if that was built from the same song
+    files); "db" bulk-fetches it from the DB; anything else disables the
+    index, so each songplay runs the song select query ("sql" enriches
+    songplays in the DB instead, with no index).
+    Args:       cfg: ConfigMgr instance
+                song_files: list of song files read this run
+                build_index: callable returning the index built from
+                the parsed song data
+                cur:  DB cursor
+                incremental: True for incremental runs, where songs loaded
+                by earlier runs aren't in the parsed data, so a "data"
+                index is fetched from the DB instead
+                looked_up: True if SONG_INDEX_CACHE was already looked up,
+                and missed (see song_index_builder())
+    Returns:    song index dict, or None
+    """
+    source = cfg.get("SONG_INDEX")
+    if source == 'sql':
+        # songplays are enriched in the DB - see enrich_in_db()
+        return None
+    if source == 'data' and incremental:
+        source = 'db'
+    if source == 'db':
+        return fetch_song_index(cur)
+    if source != 'data':
+        return None
+    cache_file = cfg.get("SONG_INDEX_CACHE")
+    fingerprint = files_fingerprint(song_files)
+    song_index = None if looked_up else load_song_index(cache_file, fingerprint)
+    if song_index is None:
+        song_index = build_index()
+        if cache_file:
+            save_song_index(song_index, cache_file, fingerprint)
+    return song_index
+
+
+def enrich_in_db(cfg):
+    """Whether songplays are enriched in the DB, by COPYing the raw
+    events into a staging table and joining it to songs and artists
+    (SONG_INDEX "sql"), rather than event by event in Python.
+    Args:       cfg: ConfigMgr instance
+    Returns:    bool
+    """
+    return cfg.get("SONG_INDEX") == 'sql'
+
+
+def run_streaming(cfg, conn, cur, batch_size, run_metrics, incremental=False, checkpoint=None):
+    """Streaming version of the pipeline: song and log event data are
+    read in batches of STREAM_BATCH_SIZE records, and each batch is
+    inserted as soon as it has been read, so memory use doesn't grow
+    with the size of the input. (Users are the exception: they are
+    reduced to one row per user across all batches, and loaded once.)
+
+    With a checkpoint (see checkpoint.py), each stage's batch is instead
+    committed on its own - so no transaction grows with the size of the
+    input - together with the stage's position. A run resuming from a
+    checkpoint re-reads input from the earliest position of any stage,
+    and each stage skips what it has already committed. In COPY mode, a
+    batch is COPY'd in one go. Users are loaded batch by batch too, in
+    the order the events are read, so that a resumed run needn't re-read
+    the logs from the start.
+    Args:       cfg: ConfigMgr instance
+                conn: DB connection (a CheckpointConnection, with a checkpoint)
+                cur:  DB cursor
+                batch_size: COPY batch size, or None for row-by-row inserts
+                run_metrics: RunMetrics instance for this run
+                incremental: True to load only new or changed files
+                checkpoint: Checkpoint instance, or None
+    Returns:    0 for success; -1 for failure.
+    """
+    stream_batch_size = cfg.get("STREAM_BATCH_SIZE") or DEF_STREAM_BATCH_SIZE
+    workers = cfg.get("PARSE_WORKERS") or DEF_PARSE_WORKERS
+    chunk_size = cfg.get("PARSE_CHUNK_SIZE") or DEF_PARSE_CHUNK_SIZE
+    # one commit per stage per batch, so a checkpoint never falls mid-batch
+    if checkpoint is not None and batch_size:
+        batch_size = max(batch_size, stream_batch_size)
+
+    @contextmanager
+    def stage(name, position=None):
+        # the checkpoint hook: a stage's batch is timed and, with a
+        # checkpoint, committed along with the position it covers
+        with run_metrics.stage(name) as stage_metrics:
+            if checkpoint is None:
+                yield stage_metrics
+                return
+            with checkpoint.batch(conn, cur, name, *position):
+                yield stage_metrics
+
+    # read song and artist data in batches, inserting each batch as it
+    # comes - skipping, with a checkpoint, those already committed
+    try:
+        logging.info("Pipeline: streaming song and artist data")
+        with run_metrics.stage('discover_songs'):
+            song_files, song_entries = discover_files(cfg, conn, cur, "SONG_DATA", incremental)
+        # songs committed by an earlier attempt aren't read this time round,
+        # so a resumed run fetches a "data" song index from the DB
+        resumed = checkpoint is not None and checkpoint.resumed
+        builder, song_index = song_index_builder(cfg, song_files, incremental or resumed)
+        if checkpoint is None:
+            song_batches = ((song_data, artist_data, None) for song_data, artist_data in
+                            iter_song_and_artist_data(song_files, stream_batch_size, workers,
+                                                      cfg.get("PARSE_CACHE")))
+        else:
+            song_file_index = {file: i for i, file in enumerate(song_files)}
+            start = checkpoint.start(('songs', 'artists'), song_file_index)
+            song_batches = iter_positioned_song_data(song_files[start:], stream_batch_size,
+                                                     workers, cfg.get("PARSE_CACHE"))
+        while True:
+            with run_metrics.stage('parse_songs'):
+                song_batch = next(song_batches, None)
+            if song_batch is None:
+                break
+            song_data, artist_data, last_file = song_batch
+            if checkpoint is None or not checkpoint.done('songs', song_file_index, last_file):
+                with stage('songs', (last_file,)):
+                    insert_song_data(song_data, conn, cur, batch_size)
+            if checkpoint is None or not checkpoint.done('artists', song_file_index, last_file):
+                with stage('artists', (last_file,)):
+                    insert_artist_data(artist_data, conn, cur, batch_size)
+            if builder is not None:
+                with run_metrics.stage('song_index'):
+                    builder.add(song_data, artist_data)
+        if song_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, song_entries)
+    except Exception as e:
+        logging.critical(f"Failed to stream song and artist data - aborting: {str(e)}")
+        return -1
+
+    try:
+        logging.info("Pipeline: building song index")
+        with run_metrics.stage('song_index'):
+            if song_index is None:
+                song_index = get_song_index(cfg, song_files, lambda: builder.index, cur,
+                                            incremental or resumed, looked_up=True)
+    except Exception as e:
+        logging.critical(f"Failed to build song index - aborting: {str(e)}")
+        return -1
+
+    # read log event data in batches, inserting time, user and
+    # songplay data for each batch as it comes
+    try:
+        logging.info("Pipeline: streaming log event data")
+        with run_metrics.stage('discover_logs'):
+            log_files, log_entries = discover_files(cfg, conn, cur, "LOG_DATA", incremental)
+        history = bool(cfg.get("USER_LEVEL_HISTORY"))
+        position = None
+        # each batch is fanned out to the time, user and songplay buffers
+        # in one pass; each buffer is loaded whenever it fills up - or,
+        # with a checkpoint, at the end of each batch
+        fanout = log_fanout(cfg, conn, cur, batch_size, song_index,
+                            lambda name: stage(name, position))
+        if checkpoint is None:
+            log_batches = iter_log_data(log_files, stream_batch_size, workers, chunk_size,
+                                        cfg.get("PARSE_CACHE"))
+        else:
+            log_file_index = {file: i for i, file in enumerate(log_files)}
+            start = checkpoint.start(FANOUT_TABLES, log_file_index)
+            log_batches = iter_positioned_log_data(log_files[start:], stream_batch_size,
+                                                   workers, chunk_size)
+            if resumed and history:
+                # the level history carries on from the levels already loaded
+                cur.execute(user_level_select)
+                fanout.users.set_levels(cur.fetchall())
+                conn.commit()
+        with deferred_indexes(conn, cur, bool(cfg.get("DEFER_INDEXES"))):
+            while True:
+                with run_metrics.stage('parse_logs'):
+                    log_data = next(log_batches, None)
+                if log_data is None:
+                    break
+                if checkpoint is None:
+                    with run_metrics.stage('log_fanout'):
+                        fanout.route(log_data)
+                    fanout.flush_full()
+                    continue
+                last_file, last_line, _ = log_data[-1]
+                position = (last_file, last_line)
+                kept = {table: checkpoint.keep(table, log_file_index, log_data)
+                        for table in FANOUT_TABLES}
+                with run_metrics.stage('log_fanout'):
+                    if all(len(records) == len(log_data) for records in kept.values()):
+                        fanout.route(kept['time'])
+                    else:
+                        for table, records in kept.items():
+                            fanout.route(records, (table,))
+                fanout.close()
+                if kept['users']:
+                    with stage('users', position):
+                        load_user_dimension(fanout.users, conn, cur, batch_size, history)
+                    fanout.users.clear_rows()
+            fanout.close()
+        # users are reduced across all batches, and loaded once
+        if checkpoint is None:
+            with run_metrics.stage('users'):
+                load_user_dimension(fanout.users, conn, cur, batch_size, history)
+        if log_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, log_entries)
+        if checkpoint is not None:
+            checkpoint.clear(conn, cur)
+    except Exception as e:
+        logging.critical(f"Failed to stream log event data - aborting: {str(e)}")
+        return -1
+
+    return 0
+
+
+def run_async(cfg, conn, cur, batch_size, run_metrics, incremental=False):
+    """Asyncio version of the pipeline: the same stages, in the same order,
+    as the streaming pipeline, but reading and writing overlap. Batches of
+    STREAM_BATCH_SIZE records are read and parsed on a worker thread and
+    queued - at most ASYNC_IN_FLIGHT batches ahead - for ASYNC_WRITERS
+    writer tasks, each loading batches on its own psycopg 3 async
+    connection (see async_writer.py). Discovery, the manifest, the song
+    index and the user dimension use the synchronous connection.
+    Args:       cfg: ConfigMgr instance
+                conn: DB connection
+                cur:  DB cursor
+                batch_size: COPY batch size, or None for batched inserts
+                run_metrics: RunMetrics instance for this run
+                incremental: True to load only new or changed files
+    Returns:    0 for success; -1 for failure.
+    """
+    if async_writer.psycopg is None:
+        logging.critical("ASYNC_PIPELINE needs psycopg 3 (pip install psycopg) - aborting")
+        return -1
+    return asyncio.run(_run_async(cfg, conn, cur, batch_size, run_metrics, incremental))
+
+
+async def _run_async(cfg, conn, cur, batch_size, run_metrics, incremental):
+    """The body of run_async(), run on the event loop."""
+    stream_batch_size = cfg.get("STREAM_BATCH_SIZE") or DEF_STREAM_BATCH_SIZE
+    workers = cfg.get("PARSE_WORKERS") or DEF_PARSE_WORKERS
+    chunk_size = cfg.get("PARSE_CHUNK_SIZE") or DEF_PARSE_CHUNK_SIZE
+    writers = cfg.get("ASYNC_WRITERS") or DEF_ASYNC_WRITERS
+    in_flight = cfg.get("ASYNC_IN_FLIGHT") or DEF_ASYNC_IN_FLIGHT
+    conninfo = cfg.get_db_connect_string()
+
+    def parsed(batches, stage):
+        # run by the producer, on a worker thread: each batch's parsing is
+        # timed under the parse stage, apart from the writers' loads
+        batches = iter(batches)
+        while True:
+            with run_metrics.stage(stage):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+    # read song and artist data in batches, loading each batch as it comes;
+    # the rows are built under each stage's timer, and loaded outside it:
+    # the loads of the concurrent writers overlap, so timing them would
+    # count the same wall time once per writer
+    async def load_song_batch(writer_conn, song_batch):
+        song_data, artist_data = song_batch
+        with run_metrics.stage('songs'):
+            metrics.count('rows_in', len(song_data))
+            songs = list(validate_rows('songs', song_rows(song_data)))
+        with run_metrics.stage('artists'):
+            metrics.count('rows_in', len(artist_data))
+            artists = list(validate_rows('artists', artist_rows(artist_data)))
+        if builder is not None:
+            with run_metrics.stage('song_index'):
+                builder.add(song_data, artist_data)
+        with run_metrics.stage('songs', timed=False):
+            await load_rows(writer_conn, 'songs', songs, song_table_insert, batch_size)
+        with run_metrics.stage('artists', timed=False):
+            await load_rows(writer_conn, 'artists', artists, artist_table_insert, batch_size)
+
+    try:
+        logging.info("Pipeline: streaming song and artist data (async)")
+        with run_metrics.stage('discover_songs'):
+            song_files, song_entries = discover_files(cfg, conn, cur, "SONG_DATA", incremental)
+        builder, song_index = song_index_builder(cfg, song_files, incremental)
+        song_batches = iter_song_and_artist_data(song_files, stream_batch_size, workers,
+                                                 cfg.get("PARSE_CACHE"))
+        await run_queue(conninfo, parsed(song_batches, 'parse_songs'), load_song_batch,
+                        writers, in_flight)
+        if song_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, song_entries)
+    except Exception as e:
+        logging.critical(f"Failed to stream song and artist data - aborting: {str(e)}")
+        return -1
+
+    try:
+        logging.info("Pipeline: building song index")
+        with run_metrics.stage('song_index'):
+            if song_index is None:
+                song_index = get_song_index(cfg, song_files, lambda: builder.index, cur,
+                                            incremental, looked_up=True)
+            # songplays are built on the writer tasks, which can't run the
+            # per-event select query - so without an index, fetch one
+            if song_index is None and not enrich_in_db(cfg):
+                song_index = fetch_song_index(cur)
+    except Exception as e:
+        logging.critical(f"Failed to build song index - aborting: {str(e)}")
+        return -1
+
+    # read log event data in batches, loading time and songplay data
+    # for each batch as it comes
+    users = UserDimensionBuilder()
+
+    def partitioned(log_batches):
+        # run by the producer too: the songplays partitions each batch
+        # needs are created on the sync connection before it is queued,
+        # so the writers never wait on it
+        for log_data in log_batches:
+            with run_metrics.stage('partitions'):
+                ensure_partitions(conn, cur, to_ts_array(entry.get('ts') for entry in log_data))
+            yield log_data
+
+    async def load_log_batch(writer_conn, log_data):
+        with run_metrics.stage('time'):
+            metrics.count('rows_in', len(log_data))
+            time_batch = list(validate_rows('time', time_rows(log_data)))
+        with run_metrics.stage('users'):
+            metrics.count('rows_in', len(log_data))
+            users.add(log_data)
+        with run_metrics.stage('songplays'):
+            metrics.count('rows_in', len(log_data))
+            if enrich_in_db(cfg):
+                table, insert_query, size = 'songplay_events', None, batch_size or DEF_BATCH_SIZE
+                songplays = list(validate_rows(table, songplay_event_rows(log_data)))
+            else:
+                table, insert_query, size = 'songplays', songplay_table_insert, batch_size
+                songplays = list(validate_rows(table, songplay_rows(log_data, None, song_index)))
+        with run_metrics.stage('time', timed=False):
+            await load_rows(writer_conn, 'time', time_batch, time_table_insert, batch_size)
+        with run_metrics.stage('songplays', timed=False):
+            await load_rows(writer_conn, table, songplays, insert_query, size)
+
+    try:
+        logging.info("Pipeline: streaming log event data (async)")
+        with run_metrics.stage('discover_logs'):
+            log_files, log_entries = discover_files(cfg, conn, cur, "LOG_DATA", incremental)
+        with deferred_indexes(conn, cur, bool(cfg.get("DEFER_INDEXES"))):
+            log_batches = iter_log_data(log_files, stream_batch_size, workers, chunk_size,
+                                        cfg.get("PARSE_CACHE"))
+            await run_queue(conninfo, partitioned(parsed(log_batches, 'parse_logs')),
+                            load_log_batch, writers, in_flight)
+        # users are reduced across all batches, and loaded once
+        with run_metrics.stage('users'):
+            load_user_dimension(users, conn, cur, batch_size,
+                                bool(cfg.get("USER_LEVEL_HISTORY")))
+        if log_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, log_entries)
+    except Exception as e:
+        logging.critical(f"Failed to stream log event data - aborting: {str(e)}")
+        return -1
+
+    return 0
+
+
+def run_concurrent(cfg, batch_size, workers, chunk_size, run_metrics, incremental=False):
+    """Concurrent version of the pipeline: the same stages as main(),
+    run by the stage scheduler, so that stages which don't depend on each
+    other (the song, artist, time and user inserts) run at the same time,
+    each on its own connection from a pool of DB_POOL_SIZE connections.
+    Songplays wait for the song index, which waits for songs and artists.
+    Args:       cfg: ConfigMgr instance
+                batch_size: COPY batch size, or None for row-by-row inserts
+                workers: number of parser processes
+                chunk_size: number of files handed to a parser at a time
+                run_metrics: RunMetrics instance for this run
+                incremental: True to load only new or changed files
+    Returns:    0 for success; -1 for failure.
+    """
+    pool_size = cfg.get("DB_POOL_SIZE") or DEF_DB_POOL_SIZE
+    try:
+        logging.info("Pipeline: connecting to DB")
+        conn_pool = ThreadedConnectionPool(1, pool_size, cfg.get_db_connect_string(),
+                                           connection_factory=metrics.CountingConnection)
+    except Exception as e:
+        logging.critical(f"Failed to connect to DB - aborting: {str(e)}")
+        return -1
+
+    def read_songs(conn, cur, results):
+        with run_metrics.stage('discover_songs'):
+            song_files, song_entries = discover_files(cfg, conn, cur, "SONG_DATA", incremental)
+        with run_metrics.stage('parse_songs'):
+            song_data, artist_data = get_song_and_artist_data(song_files, workers, chunk_size,
+                                                            cfg.get("PARSE_CACHE"))
+        return song_files, song_entries, song_data, artist_data
+
+    def read_logs(conn, cur, results):
+        with run_metrics.stage('discover_logs'):
+            log_files, log_entries = discover_files(cfg, conn, cur, "LOG_DATA", incremental)
+        with run_metrics.stage('parse_logs'):
+            return log_entries, get_all_log_data(log_files, workers, chunk_size,
+                                            cfg.get("PARSE_CACHE"))
+
+    def load_songs(conn, cur, results):
+        with run_metrics.stage('songs'):
+            insert_song_data(results['read_songs'][2], conn, cur, batch_size)
+
+    def load_artists(conn, cur, results):
+        with run_metrics.stage('artists'):
+            insert_artist_data(results['read_songs'][3], conn, cur, batch_size)
+
+    def record_songs(conn, cur, results):
+        if results['read_songs'][1]:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, results['read_songs'][1])
+
+    def song_index(conn, cur, results):
+        song_files, _, song_data, artist_data = results['read_songs']
+        with run_metrics.stage('song_index'):
+            return get_song_index(cfg, song_files,
+                                  lambda: build_song_index(song_data, artist_data), cur,
+                                  incremental)
+
+    def load_time(conn, cur, results):
+        with run_metrics.stage('time'):
+            insert_time_data(results['read_logs'][1], conn, cur, batch_size)
+
+    def load_users(conn, cur, results):
+        with run_metrics.stage('users'):
+            insert_user_data(results['read_logs'][1], conn, cur, batch_size,
+                             bool(cfg.get("USER_LEVEL_HISTORY")))
+
+    def load_songplays(conn, cur, results):
+        with run_metrics.stage('songplays'), \
+                deferred_indexes(conn, cur, bool(cfg.get("DEFER_INDEXES"))):
+            insert_songplay_data(results['read_logs'][1], conn, cur, batch_size,
+                                 results['song_index'], enrich_in_db(cfg))
+
+    def record_logs(conn, cur, results):
+        if results['read_logs'][0]:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, results['read_logs'][0])
+
+    stages = [
+        Stage('read_songs', read_songs, (),
+              "Failed to process song and artist data", needs_db=incremental),
+        Stage('read_logs', read_logs, (),
+              "Failed to process log event data", needs_db=incremental),
+        Stage('songs', load_songs, ('read_songs',), "Failed to insert song data"),
+        Stage('artists', load_artists, ('read_songs',), "Failed to insert artist data"),
+        Stage('record_songs', record_songs, ('songs', 'artists'),
+              "Failed to record song files in manifest"),
+        Stage('song_index', song_index, ('songs', 'artists'), "Failed to build song index"),
+        Stage('time', load_time, ('read_logs',), "Failed to insert time data"),
+        Stage('users', load_users, ('read_logs',), "Failed to insert user data"),
+        Stage('songplays', load_songplays, ('read_logs', 'song_index'),
+              "Failed to insert songplay data"),
+        Stage('record_logs', record_logs, ('time', 'users', 'songplays'),
+              "Failed to record log files in manifest"),
+    ]
+    logging.info("Pipeline: running stages concurrently")
+    results = run_stages(stages, conn_pool, pool_size)
+    conn_pool.closeall()
+    return -1 if results is None else 0
+
+
+def run_pipeline(cfg, run_metrics, incremental=None):
+    """Run all the stages of the ETL pipeline, timing each one.
+    Args:       cfg: ConfigMgr instance
+                run_metrics: RunMetrics instance for this run
+                incremental: True to load only files that are new or
+                changed since the last run (see manifest.py); None to
+                take the INCREMENTAL config setting
     Returns:    0 for success; -1 for failure.
         Processing steps:
             - Read all song and artist data and store in 
-            list of data dicts
+            list of data records
             - Read all log event data and store in list of 
-            data dicts
+            data records
             - Insert song data
             - Insert artist data
+            - Build the song index
             - Insert time data
             - Insert user data
             - Insert songplays data
     """
-    # For now the only way to change the debug environment is statically;
-    # TO DO:  add env variable as argument
-    cfg = ConfigMgr(env='INFO') 
+    # LOAD_MODE "copy" streams rows through COPY in batches;
+    # anything else inserts row by row
+    batch_size = None
+    if cfg.get("LOAD_MODE") == 'copy':
+        batch_size = cfg.get("COPY_BATCH_SIZE") or DEF_BATCH_SIZE
+
+    # PARSE_WORKERS > 1 parses files on a pool of worker processes,
+    # PARSE_CHUNK_SIZE files at a time
+    workers = cfg.get("PARSE_WORKERS") or DEF_PARSE_WORKERS
+    chunk_size = cfg.get("PARSE_CHUNK_SIZE") or DEF_PARSE_CHUNK_SIZE
+
+    if incremental is None:
+        incremental = bool(cfg.get("INCREMENTAL"))
 
     try:
         logging.info("Pipeline: connecting to DB")
-        conn = psycopg2.connect(cfg.get_db_connect_string())
+        # a checkpointed run holds the loaders' commits back, to commit
+        # each batch together with its checkpoint
+        conn = psycopg2.connect(cfg.get_db_connect_string(),
+                                connection_factory=CheckpointConnection if cfg.get("CHECKPOINT")
+                                else metrics.CountingConnection)
         cur = conn.cursor()
     except Exception as e:
         logging.critical(f"Failed to connect to DB - aborting: {str(e)}")
         return -1
 
+    # incremental runs load into the existing tables, so make sure
+    # they (and the manifest) exist - a shard run has already done so,
+    # on the default search path (see configure_shard)
+    if incremental and not cfg.get("SHARD"):
+        try:
+            logging.info("Pipeline: incremental run - creating any missing tables")
+            create_tables.create_tables(cur, conn, bool(cfg.get("PARTITION_SONGPLAYS")))
+        except Exception as e:
+            logging.critical(f"Failed to create tables - aborting: {str(e)}")
+            return -1
+
+    # CONCURRENT_STAGES runs independent stages at the same time,
+    # on a pool of DB connections
+    if cfg.get("CONCURRENT_STAGES"):
+        conn.close()
+        return run_concurrent(cfg, batch_size, workers, chunk_size, run_metrics, incremental)
+
+    # ASYNC_PIPELINE overlaps reading and writing on an asyncio event loop
+    if cfg.get("ASYNC_PIPELINE"):
+        ret_val = run_async(cfg, conn, cur, batch_size, run_metrics, incremental)
+        conn.close()
+        return ret_val
+
+    # CHECKPOINT streams data in batches, committing each batch along
+    # with a checkpoint in the DB, so a run that dies can be resumed
+    if cfg.get("CHECKPOINT"):
+        try:
+            checkpoint = Checkpoint(conn, cur)
+        except Exception as e:
+            logging.critical(f"Failed to read checkpoint - aborting: {str(e)}")
+            return -1
+        ret_val = run_streaming(cfg, conn, cur, batch_size, run_metrics, incremental,
+                                checkpoint)
+        conn.close()
+        return ret_val
+
+    # STREAMING reads and inserts data in fixed-size batches
+    if cfg.get("STREAMING"):
+        ret_val = run_streaming(cfg, conn, cur, batch_size, run_metrics, incremental)
+        conn.close()
+        return ret_val
+
     # Collect song data files and read all song and artist data
     # and insert
     try:
         logging.info("Pipeline: processing song and artist data")
-        song_data, artist_data = get_song_and_artist_data(get_files(cfg.get("SONG_DATA")))
+        with run_metrics.stage('discover_songs'):
+            song_files, song_entries = discover_files(cfg, conn, cur, "SONG_DATA", incremental)
+        with run_metrics.stage('parse_songs'):
+            song_data, artist_data = get_song_and_artist_data(song_files, workers, chunk_size,
+                                                            cfg.get("PARSE_CACHE"))
     except Exception as e:
         logging.critical(f"Failed to process song and artist data - aborting: {str(e)}")
         return -1
         
     # insert song data and artist data
     try:
-        insert_song_data(song_data, conn, cur)
-        insert_artist_data(artist_data, conn, cur)
+        with run_metrics.stage('songs'):
+            insert_song_data(song_data, conn, cur, batch_size)
+        with run_metrics.stage('artists'):
+            insert_artist_data(artist_data, conn, cur, batch_size)
+        if song_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, song_entries)
     except Exception as e:
         logging.critical(f"Failed to insert song and artist data - aborting: {str(e)}")
         return -1
+
+    # build (or load) the song index used to enrich songplays
+    try:
+        logging.info("Pipeline: building song index")
+        with run_metrics.stage('song_index'):
+            song_index = get_song_index(cfg, song_files,
+                                        lambda: build_song_index(song_data, artist_data), cur,
+                                        incremental)
+    except Exception as e:
+        logging.critical(f"Failed to build song index - aborting: {str(e)}")
+        return -1
         
     # Collect all log event data
     try:
         logging.info("Pipeline: processing log even data")
-        all_log_data = get_all_log_data(get_files(cfg.get("LOG_DATA")))
+        with run_metrics.stage('discover_logs'):
+            log_files, log_entries = discover_files(cfg, conn, cur, "LOG_DATA", incremental)
+        with run_metrics.stage('parse_logs'):
+            all_log_data = get_all_log_data(log_files, workers, chunk_size,
+                                            cfg.get("PARSE_CACHE"))
     except Exception as e:
         logging.critical(f"Failed to process log event data - aborting: {str(e)}")
         return -1
     
-    # Insert time data:
+    # Insert time, user and songplay data, in one pass over the log
+    # events (see log_fanout.py)
     try:
-        logging.info("Pipeline: inserting time data")
-        insert_time_data(all_log_data, conn, cur)
+        logging.info("Pipeline: inserting time, user and songplay data")
+        fanout = log_fanout(cfg, conn, cur, batch_size, song_index, run_metrics.stage)
+        with deferred_indexes(conn, cur, bool(cfg.get("DEFER_INDEXES"))):
+            for log_data in batched(all_log_data, fanout.songplays.size):
+                with run_metrics.stage('log_fanout'):
+                    fanout.route(log_data)
+                fanout.flush_full()
+            fanout.close()
+        with run_metrics.stage('users'):
+            load_user_dimension(fanout.users, conn, cur, batch_size,
+                                bool(cfg.get("USER_LEVEL_HISTORY")))
     except Exception as e:
-        logging.critical(f"Failed to insert time data - aborting: {str(e)}")
+        logging.critical(f"Failed to insert log event data - aborting: {str(e)}")
         return -1
 
-    # insert user data:
+    # all log event data is in - record the log files as loaded
     try:
-        logging.info("Pipeline: inserting user data")
-        insert_user_data(all_log_data, conn, cur)
+        if log_entries:
+            with run_metrics.stage('manifest'):
+                record_files(conn, cur, log_entries)
     except Exception as e:
-        logging.critical(f"Failed to insert user data - aborting: {str(e)}")
+        logging.critical(f"Failed to record log files in manifest - aborting: {str(e)}")
         return -1
 
-    # insert songplay data:
+    conn.close()
+    # return success
+    return 0
+
+
+def run_backfill(cfg, run_metrics):
+    """Re-resolve the songplays loaded without a song match that the
+    songs this run loaded now match (see backfill.py).
+    Args:       cfg: ConfigMgr instance
+                run_metrics: RunMetrics instance for this run
+    Returns:    0 for success; -1 for failure.
+    """
     try:
-        logging.info("Pipeline: inserting songplay data")
-        insert_songplay_data(all_log_data, conn, cur)
+        logging.info("Pipeline: backfilling unmatched songplays")
+        with run_metrics.stage('backfill'):
+            conn = psycopg2.connect(cfg.get_db_connect_string(),
+                                    connection_factory=metrics.CountingConnection)
+            cur = conn.cursor()
+            metrics.count('rows_out', backfill_songplays(conn, cur))
+            conn.close()
     except Exception as e:
-        logging.critical(f"Failed to insert songplay data - aborting: {str(e)}")
+        logging.critical(f"Failed to backfill songplays - aborting: {str(e)}")
         return -1
-        
-    # success
-    logging.info("Pipeline: completed processing all data")        
+    return 0
 
-    conn.close()
-    # return success
+
+def run_rollups(cfg, run_metrics):
+    """Refresh the analytics rollups for the days this run added
+    songplays to (see rollups.py).
+    Args:       cfg: ConfigMgr instance
+                run_metrics: RunMetrics instance for this run
+    Returns:    0 for success; -1 for failure.
+    """
+    try:
+        logging.info("Pipeline: refreshing rollups")
+        with run_metrics.stage('rollups'):
+            conn = psycopg2.connect(cfg.get_db_connect_string(),
+                                    connection_factory=metrics.CountingConnection)
+            cur = conn.cursor()
+            # the rollup tables may predate this DB
+            for query in (hourly_rollup_create, user_rollup_create, song_rollup_create,
+                          rollup_state_create, rollup_stale_days_create):
+                cur.execute(query)
+            conn.commit()
+            refresh_rollups(conn, cur)
+            conn.close()
+    except Exception as e:
+        logging.critical(f"Failed to refresh rollups - aborting: {str(e)}")
+        return -1
     return 0
 
 
+def configure_shard(cfg, shard, incremental=False):
+    """Set up a sharded run: point the run's DB connections at the
+    shard's schema, give its local files (metrics reports) a per-shard
+    name, and create the shard's tables - keeping whatever an interrupted
+    attempt left in them if its checkpoint is being resumed.
+    An incremental shard run first creates any missing main tables, while
+    the connection is still on the default search path.
+    Args:       cfg: ConfigMgr instance
+                shard: (i, N) tuple
+                incremental: True for an incremental run
+    Returns:    0 for success; -1 for failure.
+    """
+    cfg.set("SHARD", shard)
+    for label in ("METRICS_JSON", "METRICS_PROM"):
+        if cfg.get(label):
+            cfg.set(label, sharding.shard_path(cfg.get(label), shard))
+    # the shard's songplays has no secondary indexes to defer, and the
+    # unqualified index DDL would drop the main table's
+    cfg.set("DEFER_INDEXES", False)
+    try:
+        conn = psycopg2.connect(cfg.get_db_connect_string())
+        cur = conn.cursor()
+        if incremental:
+            sharding.create_main_tables(conn, cur, bool(cfg.get("PARTITION_SONGPLAYS")))
+        resuming = bool(cfg.get("CHECKPOINT")) and sharding.has_checkpoint(conn, cur, shard[0])
+        sharding.create_shard(conn, cur, shard, fresh=not resuming)
+        conn.close()
+    except Exception as e:
+        logging.critical(f"Failed to create shard tables - aborting: {str(e)}")
+        return -1
+    cfg.set("DB_SEARCH_PATH", f'{sharding.shard_schema(shard[0])},public')
+    return 0
+
+
+def run_merge_shards(cfg, run_metrics, shards):
+    """Merge the tables of a sharded run into the main tables.
+    Args:       cfg: ConfigMgr instance
+                run_metrics: RunMetrics instance for this run
+                shards: number of shards
+    Returns:    0 for success; -1 for failure.
+    """
+    try:
+        logging.info(f"Pipeline: merging {shards} shards")
+        with run_metrics.stage('merge_shards'):
+            conn = psycopg2.connect(cfg.get_db_connect_string(),
+                                    connection_factory=metrics.CountingConnection)
+            cur = conn.cursor()
+            merged = sharding.merge_shards(conn, cur, shards)
+            conn.close()
+        logging.info(f"Pipeline: merged {merged} of {shards} shards")
+    except Exception as e:
+        logging.critical(f"Failed to merge shards - aborting: {str(e)}")
+        return -1
+    return 0
+
+
+def write_run_reports(cfg, run_metrics, ret_val):
+    """Write the run's metrics as a JSON report (METRICS_JSON) and as a
+    Prometheus textfile (METRICS_PROM); either can be switched off by
+    setting it to null.
+    Args:       cfg: ConfigMgr instance
+                run_metrics: RunMetrics instance for the run
+                ret_val: 0 for success; -1 for failure
+    Returns:    None
+    """
+    try:
+        if cfg.get("METRICS_JSON"):
+            run_metrics.write_json(cfg.get("METRICS_JSON"), ret_val)
+        if cfg.get("METRICS_PROM"):
+            run_metrics.write_prometheus(cfg.get("METRICS_PROM"), ret_val)
+    except OSError as e:
+        logging.warning(f"Failed to write run metrics: {str(e)}")
+
+
+def main(incremental=None, shard=None, merge_shards=None):
+    """Main routine to drive all the work for the ETP pipeline: run
+    the pipeline, backfill unmatched songplays, refresh the rollups, then
+    write the run's metrics reports.
+    Args:       incremental: True to load only new or changed files;
+                None to take the INCREMENTAL config setting
+                shard: (i, N) tuple to load only shard i of N, into its
+                own tables (see sharding.py)
+                merge_shards: number of shards to merge into the main
+                tables, instead of running the pipeline
+    Returns:    0 for success; -1 for failure.
+    """
+    # For now the only way to change the debug environment is statically;
+    # TO DO:  add env variable as argument
+    cfg = ConfigMgr(env='INFO') 
+
+    # SHARD ("i/N") in the config works as --shard does
+    if shard is None and cfg.get("SHARD"):
+        shard = sharding.parse_shard(cfg.get("SHARD"))
+    run_metrics = metrics.RunMetrics()
+    if merge_shards:
+        ret_val = run_merge_shards(cfg, run_metrics, merge_shards)
+    else:
+        if incremental is None:
+            incremental = bool(cfg.get("INCREMENTAL"))
+        ret_val = configure_shard(cfg, shard, incremental) if shard else 0
+        if ret_val == 0:
+            # rows are validated before loading; rejects go to REJECTS_FILE
+            validation.configure(cfg)
+            ret_val = run_pipeline(cfg, run_metrics, incremental)
+            validation.close()
+    # BACKFILL_SONGPLAYS re-resolves unmatched songplays against the new
+    # songs, and REFRESH_ROLLUPS brings the analytics rollups up to date -
+    # once the shards have been merged, in a sharded run
+    if ret_val == 0 and cfg.get("BACKFILL_SONGPLAYS") and not shard:
+        ret_val = run_backfill(cfg, run_metrics)
+    if ret_val == 0 and cfg.get("REFRESH_ROLLUPS") and not shard:
+        ret_val = run_rollups(cfg, run_metrics)
+    if ret_val == 0:
+        logging.info("Pipeline: completed processing all data")
+    write_run_reports(cfg, run_metrics, ret_val)
+    return ret_val
+
+
 if __name__ == "__main__":
     sys.stderr.write(f'Running pipeline - check etl.log\n\n')
     sys.stderr.flush()
 
-    ret_val = main()
-    sys.exit(ret_val)
\ No newline at end of file
+    # --incremental loads only new or changed files;
+    # --shard i/N loads shard i of N into its own tables,
+    # and --merge-shards N merges them once all N have been loaded
+    args = sys.argv[1:]
+    shard = sharding.parse_shard(args[args.index('--shard') + 1]) if '--shard' in args else None
+    shards = int(args[args.index('--merge-shards') + 1]) if '--merge-shards' in args else None
+    ret_val = main(incremental=True if '--incremental' in args else None,
+                   shard=shard, merge_shards=shards)
+    sys.exit(ret_val)
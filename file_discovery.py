@@ -0,0 +1,183 @@
+"""
+file_discovery.py
+
+Finds the pipeline's input files. The data tree is walked with
+os.scandir, which gets each entry's type from the directory listing
+itself, so no file is stat'ed; paths are yielded as they are found,
+in the same order as the os.walk/glob walk it replaces.
+
+Directory listings can be cached: a directory's mtime changes whenever
+an entry is added, removed or renamed in it, so a cached listing is
+reused for as long as the directory's mtime is unchanged, and an
+unchanged tree is discovered with one stat per directory and no
+listings at all. The cache is pickled to a file, keyed by data root.
+
+Log files can be restricted to a date range: log_data/YYYY/ and
+log_data/YYYY/MM/ directories outside the range are pruned without
+being listed, and YYYY-MM-DD-* files outside it are skipped.
+
+Input files are .json files, compressed (.json.gz, .json.zst) or not,
+and tar bundles of them (see input_files.py).
+"""
+
+import os
+import re
+import time
+import pickle
+import logging
+import datetime
+import tempfile
+import threading
+from input_files import is_input_file
+
+# listings of directories modified this recently aren't cached, as a
+# change within the same mtime tick wouldn't show up on the next run
+MIN_LISTING_AGE_NS = 2 * 10**9
+
+_YEAR_RE = re.compile(r'^\d{4}$')
+_MONTH_RE = re.compile(r'^(0[1-9]|1[0-2])$')
+_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+
+_cache_lock = threading.Lock()
+
+
+def to_date(value):
+    """Convert a config date ("YYYY-MM-DD") to a date; None stays None."""
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+
+class DateRange:
+    def __init__(self, date_from=None, date_to=None):
+        """
+        Initialize an inclusive date range; either end may be None
+        for an open range.
+        """
+        self.date_from = to_date(date_from)
+        self.date_to = to_date(date_to)
+
+    def keep(self, parts):
+        """Whether a path, given as its parts relative to the log data
+        root, may hold events in the range. Year and month directories
+        are compared at their own granularity; other names are kept.
+        Args:       parts: tuple of path components
+        Returns:    bool
+        """
+        lo = self.date_from or datetime.date.min
+        hi = self.date_to or datetime.date.max
+        name = parts[-1]
+        match = _DATE_RE.match(name)
+        if match:
+            try:
+                return lo <= datetime.date(*map(int, match.groups())) <= hi
+            except ValueError:
+                return True
+        if len(parts) == 1 and _YEAR_RE.match(name):
+            return lo.year <= int(name) <= hi.year
+        if len(parts) == 2 and _YEAR_RE.match(parts[0]) and _MONTH_RE.match(name):
+            month = (int(parts[0]), int(name))
+            return (lo.year, lo.month) <= month <= (hi.year, hi.month)
+        return True
+
+
+def list_dir(path, listing, now_ns):
+    """List a directory - from the cache, if its mtime is unchanged.
+    Args:       path: directory path
+                listing: cache dict of path -> (mtime_ns, files, dirs),
+                updated in place; None to disable caching
+                now_ns: time of this walk, in ns
+    Returns:    list of file names; list of subdirectory names
+    """
+    if listing is not None:
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = listing.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+
+    files, dirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif is_input_file(entry.name):
+                files.append(entry.name)
+
+    if listing is not None:
+        if now_ns - mtime_ns >= MIN_LISTING_AGE_NS:
+            listing[path] = (mtime_ns, files, dirs)
+        else:
+            listing.pop(path, None)
+    return files, dirs
+
+
+def iter_files(root, listing=None, date_range=None):
+    """Lazily yield the absolute paths of all input files (JSON files,
+    compressed or not, and tar bundles of them) under root.
+    Args:       root: data directory
+                listing: cache dict of directory listings (see
+                load_listing), updated as the tree is walked; None to
+                list every directory
+                date_range: DateRange to prune log_data/YYYY/MM/ by, or None
+    Returns:    generator of file paths
+    """
+    root = os.path.abspath(root)
+    now_ns = time.time_ns()
+    stack = [(root, ())]
+    while stack:
+        path, parts = stack.pop()
+        try:
+            files, dirs = list_dir(path, listing, now_ns)
+        except OSError as e:
+            logging.warning(f'Discovery: cannot list {path}: {str(e)}')
+            continue
+        for name in files:
+            if date_range is None or date_range.keep(parts + (name,)):
+                yield os.path.join(path, name)
+        subdirs = [(os.path.join(path, name), parts + (name,)) for name in dirs
+                   if date_range is None or date_range.keep(parts + (name,))]
+        # walk subdirectories in listing order, as os.walk does
+        stack.extend(reversed(subdirs))
+
+
+def load_listing(cache_file, root):
+    """Load the cached directory listings of a data root.
+    Args:       cache_file: path of the pickled listing cache
+                root: data directory
+    Returns:    dict of directory path -> (mtime_ns, files, dirs);
+                empty if there is no usable cache
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logging.warning(f'Discovery: cannot read listing cache {cache_file}: {str(e)}')
+        return {}
+    return cached.get(os.path.abspath(root), {})
+
+
+def save_listing(cache_file, root, listing):
+    """Save the directory listings of a data root to the cache file,
+    keeping the listings cached for other roots.
+    Args:       cache_file: path of the pickled listing cache
+                root: data directory
+                listing: dict of directory listings
+    Returns:    None
+    """
+    # song and log discovery may run at the same time (CONCURRENT_STAGES)
+    with _cache_lock:
+        cached = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                cached = {}
+        cached[os.path.abspath(root)] = listing
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    logging.debug(f'Discovery: saved {len(listing)} directory listings to {cache_file}')
@@ -0,0 +1,238 @@
+"""
+generate_data.py writes synthetic song_data and log_data trees, in the
+same layout and format as the sample data under data/, so the pipeline
+can be exercised at any scale.
+
+The shape of the generated data is derived from the sample files: the
+song file and log event key sets, the mix of log pages, the number of
+users and sessions per event, the average session length, and how often
+a NextSong event matches a known song (overridable with --match-rate).
+Everything is scaled by --scale: a scale of 1 gives roughly as many
+songs and events as the samples, 1000 gives a thousand times as many.
+Files are written as they are generated, so memory use doesn't grow with
+the number of events.
+
+Usage:      python3 generate_data.py --scale 100 --out /tmp/sparkify_data
+"""
+
+import os
+import sys
+import glob
+import json
+import string
+import random
+import datetime
+import argparse
+from collections import Counter
+
+SAMPLE_DIR = './data'
+MS_PER_DAY = 24 * 3600 * 1000
+
+
+def load_profile(sample_dir):
+    """Derive the generation profile from the sample song and log files.
+    Args:       sample_dir: directory holding song_data and log_data
+    Returns:    profile dict
+    """
+    songs = []
+    for path in sorted(glob.glob(os.path.join(sample_dir, 'song_data', '**', '*.json'),
+                                 recursive=True)):
+        with open(path) as f:
+            songs.append(json.load(f))
+
+    log_files = sorted(glob.glob(os.path.join(sample_dir, 'log_data', '**', '*.json'),
+                                 recursive=True))
+    events = []
+    for path in log_files:
+        with open(path) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+
+    templates = {}
+    for event in events:
+        templates.setdefault(event['page'], []).append(event)
+    users = {event['userId']: event for event in events if event['userId']}
+    sessions = {event['sessionId'] for event in events}
+    song_keys = {(s['title'], s['artist_name'], s['duration']) for s in songs}
+    plays = [(e['song'], e['artist'], e['length']) for e in templates.get('NextSong', [])]
+    matched = sum(1 for play in plays if play in song_keys)
+
+    return dict(songs=songs,
+                artists_per_song=len({s['artist_id'] for s in songs}) / len(songs),
+                templates=templates,
+                page_weights=Counter(event['page'] for event in events),
+                users=list(users.values()),
+                events=len(events),
+                users_per_event=len(users) / len(events),
+                session_length=len(events) / len(sessions),
+                plays=plays,
+                match_rate=matched / len(plays) if plays else 0.0,
+                days=max(1, len(log_files)))
+
+
+def random_id(rng, prefix):
+    """Generate an ID shaped like the sample song/artist/track IDs."""
+    chars = string.ascii_uppercase + string.digits
+    return prefix + ''.join(rng.choice(chars) for _ in range(16))
+
+
+def write_songs(profile, scale, out_dir, rng):
+    """Write the song_data tree: one JSON file per song, under
+    song_data/X/Y/Z/ named after the track ID, as in the samples.
+    Args:       profile: generation profile
+                scale: scale factor
+                out_dir: output directory
+                rng: random.Random instance
+    Returns:    list of (title, artist_name, duration) of the songs written
+    """
+    n_songs = max(1, round(len(profile['songs']) * scale))
+    n_artists = max(1, round(n_songs * profile['artists_per_song']))
+    artists = []
+    for i in range(n_artists):
+        template = rng.choice(profile['songs'])
+        artists.append(dict(artist_id=random_id(rng, 'AR'),
+                            artist_name=f"{template['artist_name']} {i}",
+                            artist_location=template['artist_location'],
+                            artist_latitude=template['artist_latitude'],
+                            artist_longitude=template['artist_longitude']))
+
+    song_keys = []
+    for i in range(n_songs):
+        template = rng.choice(profile['songs'])
+        artist = rng.choice(artists)
+        track_id = random_id(rng, 'TR')
+        song = dict(num_songs=1,
+                    artist_id=artist['artist_id'],
+                    artist_latitude=artist['artist_latitude'],
+                    artist_longitude=artist['artist_longitude'],
+                    artist_location=artist['artist_location'],
+                    artist_name=artist['artist_name'],
+                    song_id=random_id(rng, 'SO'),
+                    title=f"{template['title']} {i}",
+                    duration=round(template['duration'] * rng.uniform(0.8, 1.2), 5),
+                    year=template['year'])
+        song_dir = os.path.join(out_dir, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+        song_keys.append((song['title'], song['artist_name'], song['duration']))
+    return song_keys
+
+
+def make_user(profile, user_id, rng):
+    """Generate a user, based on a random sample user."""
+    template = rng.choice(profile['users'])
+    return dict(userId=str(user_id),
+                firstName=template['firstName'],
+                lastName=template['lastName'],
+                gender=template['gender'],
+                level=template['level'],
+                location=template['location'],
+                userAgent=template['userAgent'],
+                registration=template['registration'])
+
+
+def write_logs(profile, scale, out_dir, rng, song_keys, match_rate, days, start_date):
+    """Write the log_data tree: one NDJSON file per day, under
+    log_data/YYYY/MM/, with events in timestamp order.
+    Args:       profile: generation profile
+                scale: scale factor
+                out_dir: output directory
+                rng: random.Random instance
+                song_keys: (title, artist_name, duration) of the generated songs
+                match_rate: fraction of NextSong events playing a generated song
+                days: number of days (files) to spread the events over
+                start_date: date of the first log file
+    Returns:    number of events written
+    """
+    n_events = max(1, round(profile['events'] * scale))
+    n_users = max(1, round(n_events * profile['users_per_event']))
+    users = [make_user(profile, i + 1, rng) for i in range(n_users)]
+    pages = list(profile['page_weights'])
+    weights = [profile['page_weights'][page] for page in pages]
+    end_session = 1 / profile['session_length']
+
+    # a pool of concurrently active sessions, each [session_id, user, item]
+    next_session = 1
+    active = []
+    n_active = max(1, round((n_events / days) ** 0.5))
+
+    written = 0
+    for day in range(days):
+        date = start_date + datetime.timedelta(days=day)
+        day_events = n_events // days + (1 if day < n_events % days else 0)
+        day_start = int(datetime.datetime(date.year, date.month, date.day,
+                                          tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        gap = MS_PER_DAY / max(1, day_events)
+        log_dir = os.path.join(out_dir, 'log_data', f'{date:%Y}', f'{date:%m}')
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, f'{date:%Y-%m-%d}-events.json'), 'w') as f:
+            ts = float(day_start)
+            for _ in range(day_events):
+                ts += rng.expovariate(1 / gap)
+                if len(active) < n_active:
+                    active.append([next_session, rng.choice(users), 0])
+                    next_session += 1
+                session = rng.choice(active)
+
+                page = rng.choices(pages, weights)[0]
+                event = dict(rng.choice(profile['templates'][page]))
+                event['sessionId'] = session[0]
+                event['itemInSession'] = session[2]
+                event['ts'] = min(int(ts), day_start + MS_PER_DAY - 1)
+                if event['userId']:
+                    user = session[1]
+                    event.update(user)
+                    if page == 'Submit Upgrade':
+                        user['level'] = 'paid'
+                    elif page == 'Submit Downgrade':
+                        user['level'] = 'free'
+                if page == 'NextSong':
+                    if song_keys and rng.random() < match_rate:
+                        title, artist, length = rng.choice(song_keys)
+                    else:
+                        title, artist, length = rng.choice(profile['plays'])
+                    event.update(song=title, artist=artist, length=length)
+                f.write(json.dumps(event) + '\n')
+
+                session[2] += 1
+                if rng.random() < end_session:
+                    active.remove(session)
+                written += 1
+    return written
+
+
+def main():
+    """Parse the arguments and generate the data.
+    Args:       None
+    Returns:    0 for success
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic song and log data.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale factor relative to the sample data')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--sample-dir', default=SAMPLE_DIR, help='sample data directory')
+    parser.add_argument('--match-rate', type=float, default=None,
+                        help='fraction of NextSong events matching a generated song '
+                             '(default: the sample rate)')
+    parser.add_argument('--days', type=int, default=None,
+                        help='number of daily log files (default: as in the samples)')
+    parser.add_argument('--start-date', default='2018-11-01', help='date of the first log file')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    profile = load_profile(args.sample_dir)
+    match_rate = profile['match_rate'] if args.match_rate is None else args.match_rate
+    days = args.days or profile['days']
+    start_date = datetime.date.fromisoformat(args.start_date)
+
+    song_keys = write_songs(profile, args.scale, args.out, rng)
+    n_events = write_logs(profile, args.scale, args.out, rng, song_keys,
+                          match_rate, days, start_date)
+    sys.stderr.write(f'Wrote {len(song_keys)} songs and {n_events} events '
+                     f'over {days} days to {args.out}\n')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+input_files.py
+
+Streaming access to compressed and archived input files, so they can
+be read where they are delivered, without being unpacked to disk first.
+Besides plain .json files, the pipeline reads:
+
+    .json.gz, .json.zst     a JSON file (one song, or NDJSON log events)
+                            compressed with gzip or zstd
+    .tar, .tar.gz, .tgz     a bundle of .json files (plain or compressed)
+
+Everything is decompressed on the fly, as it is read: a tar bundle is
+read as a stream, member by member, and no file is ever extracted. Each
+input file is read by a single parser, so with PARSE_WORKERS > 1 files
+are decompressed in parallel, as they are parsed.
+
+zstd needs the zstandard package; without it, .json.zst files can't be
+read, and are rejected as they are read.
+"""
+
+import io
+import gzip
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_SUFFIXES = ('.json', '.json.gz', '.json.zst')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+INPUT_SUFFIXES = JSON_SUFFIXES + ARCHIVE_SUFFIXES
+
+# errors reading a damaged or unreadable compressed file or archive
+READ_ERRORS = (OSError, EOFError, tarfile.TarError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def is_input_file(name):
+    """Whether a file name is that of an input file the pipeline reads."""
+    return name.endswith(INPUT_SUFFIXES) and not name.startswith('.')
+
+
+def is_archive(path):
+    """Whether a path is that of a tar bundle of input files."""
+    return path.endswith(ARCHIVE_SUFFIXES)
+
+
+def decompress(f, name):
+    """Wrap a binary stream in a decompressing reader, by its file name.
+    Args:       f: binary file object
+                name: file (or archive member) name
+    Returns:    binary file object of the decompressed data
+    Raises:     OSError if the data is zstd and zstandard isn't installed
+    """
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise OSError(f'{name}: reading .zst files needs zstandard (pip install zstandard)')
+        # the zstd reader can't be read line by line without a buffer
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    return f
+
+
+def open_input(path):
+    """Open a (possibly compressed) JSON input file for reading.
+    Args:       path: file path
+    Returns:    binary file object of the decompressed data
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    f = open(path, 'rb')
+    try:
+        return decompress(f, path)
+    except Exception:
+        f.close()
+        raise
+
+
+def iter_json_streams(path):
+    """Stream the JSON documents of an input file: the file itself, or,
+    for a tar bundle, each of its JSON members, in archive order.
+    Args:       path: input file path
+    Returns:    generator of (name, binary file object) - each stream is
+                only valid until the next one is yielded
+    """
+    if not is_archive(path):
+        with open_input(path) as f:
+            yield path, f
+        return
+    # 'r|*' reads the archive as a stream, detecting its compression
+    with tarfile.open(path, mode='r|*') as tar:
+        for member in tar:
+            name = member.name.rsplit('/', 1)[-1]
+            # bundles of bundles aren't unpacked
+            if not member.isfile() or not is_input_file(name) or is_archive(name):
+                continue
+            with decompress(tar.extractfile(member), member.name) as f:
+                yield f'{path}/{member.name}', f
@@ -0,0 +1,85 @@
+"""
+log_decoder.py
+
+The decoding layer for log event lines. Most log events aren't
+NextSong events, and the pipeline drops them, so each raw line is first
+checked for the bytes of "NextSong": a line without them can't be a
+NextSong event and is skipped without being parsed. A JSON string can
+spell NextSong with \\u escapes, so lines containing one are always
+parsed, which keeps the filter exact.
+
+Lines that pass are parsed by the fastest JSON backend installed -
+orjson if it is, the standard library otherwise - and projected to the
+12 fields the pipeline uses, as a compact LogEvent record (see
+records.py). Anything the fast backend rejects is re-parsed by the
+standard library, so the results, and the errors raised for bad lines,
+are exactly those of json.loads.
+"""
+
+import json
+from records import LogEvent
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NEXT_SONG = 'NextSong'
+_NEXT_SONG_BYTES = NEXT_SONG.encode()
+_ESCAPE_BYTES = b'\\u'
+
+# log data key -> log event key, in LogEvent field order
+LOG_FIELDS = (('ts', 'ts'),
+              ('user_id', 'userId'),
+              ('first_name', 'firstName'),
+              ('last_name', 'lastName'),
+              ('gender', 'gender'),
+              ('level', 'level'),
+              ('song_title', 'song'),
+              ('artist_name', 'artist'),
+              ('length', 'length'),
+              ('session_id', 'sessionId'),
+              ('location', 'location'),
+              ('user_agent', 'userAgent'))
+
+
+def _orjson_loads(line):
+    """Parse a line with orjson, falling back to json.loads for
+    anything orjson rejects (e.g. NaN, or integers over 64 bits)."""
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return json.loads(line)
+
+
+BACKENDS = {'json': json.loads}
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_loads
+
+DEF_BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def get_loads(backend=None):
+    """Get the parse function of a JSON backend.
+    Args:       backend: backend name (see BACKENDS); None for the fastest installed
+    Returns:    function parsing a str or bytes line
+    """
+    return BACKENDS[backend or DEF_BACKEND]
+
+
+def maybe_next_song(line):
+    """Cheap check of a raw line: False only if the line can't be a
+    NextSong event.
+    Args:       line: raw log line, as bytes
+    Returns:    bool
+    """
+    return _NEXT_SONG_BYTES in line or _ESCAPE_BYTES in line
+
+
+def project_event(data):
+    """Project a parsed NextSong event onto a log data record.
+    Args:       data: parsed log event dict
+    Returns:    LogEvent record
+    Raises:     KeyError if the event lacks one of the fields
+    """
+    return LogEvent(*[data[field] for _, field in LOG_FIELDS])
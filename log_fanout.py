@@ -0,0 +1,129 @@
+"""
+log_fanout.py
+
+The fused log stage. Rather than scanning the whole list of log events
+once per table - for the time rows, then the users, then the songplays,
+each scan repeating the same key lookups - each event is read once and
+fanned out: its timestamp to the time buffer (deduplicated), the event
+to the user dimension builder and to the songplay buffer.
+
+Each buffer is flushed - loaded into its table - on its own as soon as
+it is full, so no more than a buffer's worth of rows is held per table,
+and with streaming input the whole list of events never exists at all.
+The time rows and songplay start times are still formatted a whole
+buffer at a time (see time_dimension.py). Users are reduced across the
+whole stream and loaded once, at the end, as in the other run modes.
+
+A checkpointed run (see checkpoint.py) flushes every buffer at the end
+of each batch instead, each in a transaction with its table's position,
+and may route an event to only some of the tables - those that haven't
+committed it yet.
+"""
+
+import logging
+from contextlib import nullcontext
+import metrics
+
+DEF_FANOUT_BUFFER_SIZE = 5000
+FANOUT_TABLES = ('time', 'users', 'songplays')
+
+
+class Buffer:
+    def __init__(self, name, size, flush):
+        """
+        Initialize an empty buffer of rows bound for a table.
+        Args:       name: table (and metrics stage) name
+                    size: number of rows at which the buffer is full
+                    flush: function loading the rows, taking (rows, events):
+                    the buffered rows and the number of events they came from
+        """
+        self.name = name
+        self.size = size
+        self.flush_func = flush
+        self.rows = []
+        self.events = 0
+
+    def full(self):
+        return len(self.rows) >= self.size
+
+    def flush(self):
+        """Load the buffered rows and empty the buffer."""
+        if self.rows:
+            self.flush_func(self.rows, self.events)
+        self.rows = []
+        self.events = 0
+
+
+class LogFanOut:
+    def __init__(self, flush_time, flush_songplays, users, buffer_size=DEF_FANOUT_BUFFER_SIZE,
+                 stage=None):
+        """
+        Initialize the fan-out.
+        Args:       flush_time: function loading a buffer of distinct
+                    millisecond timestamps into the time table, taking
+                    (timestamps, events)
+                    flush_songplays: function loading a buffer of log
+                    events into the songplays table, taking (events, count)
+                    users: UserDimensionBuilder the events are added to
+                    buffer_size: number of rows at which a buffer is flushed
+                    stage: function taking a stage name and returning the
+                    context manager to flush that table's buffer in (e.g.
+                    RunMetrics.stage), or None
+        """
+        self.time = Buffer('time', buffer_size, flush_time)
+        self.songplays = Buffer('songplays', buffer_size, flush_songplays)
+        self.users = users
+        self.stage = stage or (lambda name: nullcontext())
+        self.time_seen = set()
+
+    def route(self, log_data, tables=FANOUT_TABLES):
+        """Fan a batch of log events out to the buffers, in one pass.
+        Args:       log_data: iterable of log event data records
+                    tables: the tables to route the events to
+        Returns:    None
+        """
+        time_rows, time_seen = self.time.rows, self.time_seen
+        songplay_rows = self.songplays.rows
+        add_user = self.users.add_event
+        to_time, to_users, to_songplays = (table in tables for table in FANOUT_TABLES)
+        events = 0
+        for entry in log_data:
+            events += 1
+            try:
+                ts = entry['ts']
+            except KeyError as e:
+                logging.warning(f'Key Error:  {str(e)}')
+                metrics.count('rows_rejected')
+                continue
+            if to_time and ts and ts not in time_seen:
+                time_seen.add(ts)
+                time_rows.append(ts)
+            if to_users:
+                add_user(entry)
+            if to_songplays:
+                songplay_rows.append(entry)
+        if to_time:
+            self.time.events += events
+        if to_songplays:
+            self.songplays.events += events
+        metrics.count('rows_in', events)
+
+    def flush_full(self):
+        """Flush each buffer that is full."""
+        for buffer in (self.time, self.songplays):
+            if buffer.full():
+                self.flush(buffer)
+
+    def flush(self, buffer):
+        """Flush a buffer, in its table's stage - unless it is empty."""
+        if not buffer.rows:
+            return
+        with self.stage(buffer.name):
+            buffer.flush()
+        if buffer is self.time:
+            self.time_seen = set()
+
+    def close(self):
+        """Flush whatever is left in the buffers."""
+        self.flush(self.time)
+        self.flush(self.songplays)
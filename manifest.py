@@ -0,0 +1,137 @@
+"""
+manifest.py
+
+The manifest records each input file the pipeline has loaded - its
+path, size, mtime and a hash of its contents - in the processed_files
+table, on every run. Incremental runs use it to pick out only the files
+that are new, or whose contents have changed, since the last run.
+
+A song file that has changed is simply reloaded: songs and artists load
+idempotently. Songplays don't, so a log file that has changed is only
+reloaded if it has been appended to - its old contents, as hashed in the
+manifest, are a prefix of the new ones - and then only from where the
+last load stopped (see AppendedFile). A log file changed in any other
+way (or a compressed one, or a bundle, which can't be read from an
+offset) would load its songplays twice; it is skipped, with an error
+logged, until it is reloaded from scratch.
+"""
+
+import os
+import hashlib
+import logging
+from psycopg2.extras import execute_batch
+from sql_queries import manifest_table_insert, manifest_select
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class AppendedFile(str):
+    """Path of a log file that has only been appended to since it was
+    loaded; offset is its size when it was loaded, and only what follows
+    is still to be read. Used wherever the plain path is."""
+    def __new__(cls, path, offset):
+        obj = super().__new__(cls, path)
+        obj.offset = offset
+        return obj
+
+    def __reduce__(self):
+        return AppendedFile, (str(self), self.offset)
+
+
+def file_hash(path, size=None):
+    """Hash the contents of a file.
+    Args:       path: file path
+                size: hash only the first size bytes; None for all of them
+    Returns:    hex SHA-256 digest of the file contents
+    """
+    digest = hashlib.sha256()
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(HASH_BLOCK_SIZE if remaining is None
+                           else min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+def file_entries(files):
+    """Build the manifest entries of a list of files.
+    Args:       files: iterable of file paths
+    Returns:    list of (path, size, mtime, content_hash) tuples
+    """
+    entries = []
+    for path in files:
+        st = os.stat(path)
+        entries.append((str(path), st.st_size, st.st_mtime, file_hash(path)))
+    return entries
+
+
+def appended(path, size, known):
+    """Whether a file has only been appended to since its manifest entry.
+    Args:       path: file path
+                size: current size of the file
+                known: manifest (size, mtime, content_hash) of the file
+    Returns:    bool
+    """
+    return (path.endswith('.json') and size > known[0]
+            and file_hash(path, known[0]) == known[2])
+
+
+def get_new_files(conn, cur, files, append_only=False):
+    """Compare files against the manifest and pick out those to load.
+    Files whose size and mtime match the manifest are skipped without
+    being read; otherwise the contents are hashed, and a file is only
+    reloaded if the hash differs from the recorded one.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                files: iterable of file paths
+                append_only: True to reload changed files only if they have
+                been appended to - as AppendedFile paths - and to skip the rest
+    Returns:    list of new or changed files; list of manifest entries
+                (path, size, mtime, content_hash) to record once they
+                have been loaded
+    """
+    cur.execute(manifest_select)
+    manifest = {path: (size, mtime, content_hash)
+                for path, size, mtime, content_hash in cur}
+    conn.commit()
+
+    new_files = []
+    entries = []
+    for path in files:
+        st = os.stat(path)
+        known = manifest.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime:
+            continue
+        content_hash = file_hash(path)
+        # touched, but not changed: just record the new mtime
+        if known and known[2] == content_hash:
+            entries.append((path, st.st_size, st.st_mtime, content_hash))
+            continue
+        if known and append_only:
+            if not appended(path, st.st_size, known):
+                logging.error(f'Manifest: {path} has changed other than by appending - '
+                              f'skipped, as reloading it would duplicate its songplays')
+                continue
+            path = AppendedFile(path, known[0])
+        entries.append((str(path), st.st_size, st.st_mtime, content_hash))
+        new_files.append(path)
+    logging.info(f'Manifest: {len(new_files)} new or changed files, '
+                 f'{len(manifest)} files already loaded')
+    return new_files, entries
+
+
+def record_files(conn, cur, entries):
+    """Record loaded files in the manifest.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                entries: list of (path, size, mtime, content_hash) tuples
+    Returns:    None
+    """
+    execute_batch(cur, manifest_table_insert, entries)
+    conn.commit()
+    logging.debug(f'Manifest: recorded {len(entries)} files')
@@ -0,0 +1,255 @@
+"""
+metrics.py
+
+Per-stage instrumentation for the pipeline. A RunMetrics instance
+times each stage of a run (file discovery, parsing, each table load)
+and collects its counters: rows in, rows out, rows rejected, bytes read,
+DB round trips and memory. At the end of a run the metrics are written
+as a JSON report and as a Prometheus textfile.
+
+Memory is sampled per stage as the current RSS, at the stage's entry
+and exit - the process's peak RSS is a high-water mark for the whole
+run, so after the largest stage every stage would report the same
+"peak". The peak RSS of the parser worker processes is reported for the
+stage in which they set a new high, as they exit.
+
+Code running inside a stage records its counters with count(); the
+counters go to whichever stage is current on that thread (or asyncio
+task - the current stage is a context variable), so the
+pipeline functions don't need a metrics object passed around. DB round
+trips are counted by connecting with CountingConnection, whose cursors
+count every statement, COPY and commit.
+"""
+
+import os
+import json
+import time
+import resource
+import datetime
+import threading
+import contextvars
+from contextlib import contextmanager
+import psycopg2.extensions
+
+COUNTERS = ('rows_in', 'rows_out', 'rows_rejected', 'bytes_read', 'db_round_trips')
+
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+
+
+class StageMetrics:
+    def __init__(self, name):
+        """
+        Initialize the counters of a stage. A stage can be entered
+        more than once (e.g. once per batch); its metrics accumulate.
+        """
+        self.name = name
+        self.seconds = 0.0
+        self.rss_bytes = 0
+        self.rss_growth_bytes = 0
+        self.worker_peak_rss_bytes = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def as_dict(self):
+        """Return the stage metrics as a dict."""
+        rows = self.counters['rows_in'] or self.counters['rows_out']
+        return dict(stage=self.name,
+                    seconds=round(self.seconds, 6),
+                    rows_per_second=round(rows / self.seconds, 1) if self.seconds else 0.0,
+                    rss_bytes=self.rss_bytes,
+                    rss_growth_bytes=self.rss_growth_bytes,
+                    worker_peak_rss_bytes=self.worker_peak_rss_bytes,
+                    **self.counters)
+
+
+def count(name, n=1):
+    """Add n to a counter of the current stage, if there is one.
+    Args:       name: counter name (one of COUNTERS)
+                n: amount to add
+    Returns:    None
+    """
+    stage = _current_stage.get()
+    if stage is not None:
+        stage.counters[name] += n
+
+
+def merge(counters):
+    """Add a dict of counters (e.g. from a worker process) to the current stage."""
+    for name, n in counters.items():
+        count(name, n)
+
+
+@contextmanager
+def capture():
+    """Collect counters into a standalone dict, rather than a run's
+    stage - used in worker processes, whose counters are merged back
+    into the parent's current stage.
+    Returns:    context manager yielding the counters dict
+    """
+    stage = StageMetrics('capture')
+    token = _current_stage.set(stage)
+    try:
+        yield stage.counters
+    finally:
+        _current_stage.reset(token)
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """Peak resident set size so far, in bytes: of this process, or with
+    RUSAGE_CHILDREN, of the largest of its child processes that have exited."""
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    """Current resident set size of this process, in bytes - from
+    /proc/self/statm, or where there's no /proc, the peak so far."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+class RunMetrics:
+    def __init__(self):
+        """
+        Initialize the metrics of a pipeline run.
+        """
+        self.started = time.time()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, timed=True):
+        """Time a stage, and make it the current stage for count().
+        Args:       name: stage name
+                    timed: False to only make it the current stage - for
+                    work that overlaps other work of the same stage (e.g.
+                    awaited by concurrent tasks), whose times would add up
+                    to more than the wall time
+        Returns:    context manager yielding the StageMetrics
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, StageMetrics(name))
+        token = _current_stage.set(stage)
+        if not timed:
+            try:
+                yield stage
+            finally:
+                _current_stage.reset(token)
+            return
+        rss_in = current_rss_bytes()
+        worker_peak = peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+            rss_out = current_rss_bytes()
+            stage.rss_bytes = max(stage.rss_bytes, rss_in, rss_out)
+            stage.rss_growth_bytes = max(stage.rss_growth_bytes, rss_out - rss_in)
+            # parser workers that exited during the stage, setting a new high
+            if peak_rss_bytes(resource.RUSAGE_CHILDREN) > worker_peak:
+                stage.worker_peak_rss_bytes = peak_rss_bytes(resource.RUSAGE_CHILDREN)
+            _current_stage.reset(token)
+
+    def report(self, status):
+        """Build the run report.
+        Args:       status: 0 for success; -1 for failure
+        Returns:    report dict
+        """
+        return dict(run_started=datetime.datetime.fromtimestamp(self.started).isoformat(),
+                    run_seconds=round(time.time() - self.started, 6),
+                    success=status == 0,
+                    peak_rss_bytes=peak_rss_bytes(),
+                    worker_peak_rss_bytes=peak_rss_bytes(resource.RUSAGE_CHILDREN),
+                    stages=[stage.as_dict() for stage in self.stages.values()])
+
+    def write_json(self, path, status):
+        """Write the run report as JSON.
+        Args:       path: report file path
+                    status: 0 for success; -1 for failure
+        Returns:    None
+        """
+        _write_atomic(path, json.dumps(self.report(status), indent=2) + '\n')
+
+    def write_prometheus(self, path, status):
+        """Write the run report in the Prometheus textfile format, for
+        the node exporter's textfile collector.
+        Args:       path: .prom file path
+                    status: 0 for success; -1 for failure
+        Returns:    None
+        """
+        report = self.report(status)
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{labels} {value}')
+
+        metric('etl_run_success', 'Whether the last ETL run succeeded.',
+               [('', int(report['success']))])
+        metric('etl_run_timestamp_seconds', 'Start time of the last ETL run.',
+               [('', round(self.started, 3))])
+        metric('etl_run_seconds', 'Wall time of the last ETL run.',
+               [('', report['run_seconds'])])
+        stage_metrics = [('seconds', 'Wall time per ETL stage.'),
+                         ('rows_per_second', 'Throughput per ETL stage.'),
+                         ('rows_in', 'Records going into each ETL stage.'),
+                         ('rows_out', 'Records produced or loaded by each ETL stage.'),
+                         ('rows_rejected', 'Records rejected by each ETL stage.'),
+                         ('bytes_read', 'Input bytes read by each ETL stage.'),
+                         ('db_round_trips', 'DB round trips made by each ETL stage.'),
+                         ('rss_bytes', 'Highest process RSS at the entry or exit of each ETL stage.'),
+                         ('rss_growth_bytes', 'Largest RSS growth over one run of each ETL stage.'),
+                         ('worker_peak_rss_bytes',
+                          'Peak RSS of the worker processes that exited in each ETL stage, '
+                          'if they set a new high.')]
+        for key, help_text in stage_metrics:
+            metric(f'etl_stage_{key}', help_text,
+                   [(f'{{stage="{stage["stage"]}"}}', stage[key]) for stage in report['stages']])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomic(path, text):
+    """Write a file via a temporary file, so readers never see it half-written."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts each statement and COPY as a DB round trip."""
+    def execute(self, query, vars=None):
+        count('db_round_trips')
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        count('db_round_trips', len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count('db_round_trips')
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection whose cursors count round trips, and which counts
+    commits and rollbacks too. Pass as psycopg2.connect(connection_factory=...)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+
+    def commit(self):
+        count('db_round_trips')
+        return super().commit()
+
+    def rollback(self):
+        count('db_round_trips')
+        return super().rollback()
@@ -0,0 +1,105 @@
+"""
+parallel_parser.py
+
+Runs file parsing on a pool of worker processes. The input files are
+split into chunks of consecutive files, each chunk is parsed by a
+worker, and the results are handed back in the original file order,
+so the merged output is the same as a single-process run.
+
+Log messages raised while parsing (KeyError, JSONDecodeError, ...) are
+captured in the worker and re-emitted by the parent process, so they
+reach the pipeline log exactly as they would from a single process;
+the worker's metrics counters are merged back the same way.
+"""
+
+import itertools
+import logging
+import metrics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+DEF_PARSE_WORKERS = 1
+DEF_PARSE_CHUNK_SIZE = 64
+
+
+class _RecordCollector(logging.Handler):
+    """Logging handler that keeps the records it is given."""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _parse_chunk(parse_func, files):
+    """Worker entry point: parse a chunk of files, collecting the
+    log records and metrics counters raised along the way.
+    Args:       parse_func: function parsing a list of files
+                files: list of files
+    Returns:    parse result, list of log records, dict of counters
+    """
+    root = logging.getLogger()
+    collector = _RecordCollector()
+    saved_handlers, saved_level = root.handlers, root.level
+    root.handlers = [collector]
+    root.setLevel(logging.DEBUG)
+    try:
+        with metrics.capture() as counters:
+            result = parse_func(files)
+        return result, collector.records, counters
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+
+
+def chunk_files(files, chunk_size):
+    """Split an iterable of files into lists of consecutive files.
+    Args:       files: iterable of file paths
+                chunk_size: number of files per chunk
+    Returns:    generator of lists of file paths
+    """
+    files = iter(files)
+    while True:
+        chunk = list(itertools.islice(files, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_chunks(parse_func, files, workers=DEF_PARSE_WORKERS,
+                 chunk_size=DEF_PARSE_CHUNK_SIZE):
+    """Parse files in chunks, on a pool of worker processes.
+    At most two chunks per worker are in flight at once, so results
+    are consumed as they arrive rather than piling up in memory.
+    Args:       parse_func: module-level function parsing a list of files
+                files: iterable of file paths
+                workers: number of worker processes; 1 parses in-process
+                chunk_size: number of files per chunk
+    Returns:    generator of parse results, one per chunk, in file order
+    """
+    if workers <= 1:
+        for chunk in chunk_files(files, chunk_size):
+            yield parse_func(chunk)
+        return
+
+    root = logging.getLogger()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for chunk in chunk_files(files, chunk_size):
+            in_flight.append(pool.submit(_parse_chunk, parse_func, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield _collect(in_flight.popleft(), root)
+        while in_flight:
+            yield _collect(in_flight.popleft(), root)
+
+
+def _collect(future, root):
+    """Wait for a chunk, re-emit its log records and counters,
+    and return its result."""
+    result, records, counters = future.result()
+    metrics.merge(counters)
+    for record in records:
+        if root.isEnabledFor(record.levelno):
+            root.handle(record)
+    return result
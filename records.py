@@ -0,0 +1,126 @@
+"""
+records.py
+
+Compact records for the parsed songs, artists and log events. A dict
+per record costs several hundred bytes before its values, and every
+record carries its own copy of the strings that repeat across records -
+user agents, locations, levels, names. These records keep their fields
+in __slots__ - a fixed-size object with no per-record dict - and intern
+the string values of their low-cardinality fields (levels, genders,
+locations, user agents), so each distinct user agent is stored once,
+however many events carry it; interning again as records are unpickled
+from a parser process keeps that true across processes. Free-text
+fields - titles, names - are left alone: interning them costs a hash
+and table lookup per value, in the decoding hot path, for strings that
+rarely repeat.
+
+Records are read like the dicts they replace - record['ts'],
+record.get('ts'), iteration over the field names - so the code that
+consumes them works with either.
+"""
+
+from sys import intern
+from collections.abc import Mapping
+
+
+class Record:
+    __slots__ = ()
+    # field names, in order; set by each subclass, whose __init__ takes
+    # the field values in this order
+    _fields = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from a dict of its fields.
+        Raises:     KeyError if the dict lacks one of the fields
+        """
+        return cls(*(data[field] for field in cls._fields))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._fields else default
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self._fields)
+
+    def items(self):
+        return tuple(zip(self._fields, self.values()))
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._fields == other._fields and self.values() == other.values()
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # unpickling goes through __init__, which interns the values again
+        return type(self), self.values()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self.items())!r})'
+
+
+class SongRecord(Record):
+    __slots__ = _fields = ('song_id', 'title', 'artist_id', 'year', 'duration')
+
+    def __init__(self, song_id, title, artist_id, year, duration):
+        self.song_id = song_id
+        self.title = title
+        self.artist_id = artist_id
+        self.year = year
+        self.duration = duration
+
+
+class ArtistRecord(Record):
+    __slots__ = _fields = ('artist_id', 'artist_name', 'artist_location',
+                           'artist_latitude', 'artist_longitude')
+
+    def __init__(self, artist_id, artist_name, artist_location, artist_latitude,
+                 artist_longitude):
+        self.artist_id = artist_id
+        self.artist_name = artist_name
+        self.artist_location = (intern(artist_location) if type(artist_location) is str
+                                else artist_location)
+        self.artist_latitude = artist_latitude
+        self.artist_longitude = artist_longitude
+
+
+class LogEvent(Record):
+    __slots__ = _fields = ('ts', 'user_id', 'first_name', 'last_name', 'gender', 'level',
+                           'song_title', 'artist_name', 'length', 'session_id', 'location',
+                           'user_agent')
+
+    def __init__(self, ts, user_id, first_name, last_name, gender, level, song_title,
+                 artist_name, length, session_id, location, user_agent):
+        self.ts = ts
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.gender = intern(gender) if type(gender) is str else gender
+        self.level = intern(level) if type(level) is str else level
+        self.song_title = song_title
+        self.artist_name = artist_name
+        self.length = length
+        self.session_id = session_id
+        self.location = intern(location) if type(location) is str else location
+        self.user_agent = intern(user_agent) if type(user_agent) is str else user_agent
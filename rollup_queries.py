@@ -0,0 +1,87 @@
+"""
+rollup_queries.py
+
+Dashboard queries served from the analytics rollups (see rollups.py):
+plays per hour, day and level, the most active users, and the top songs
+and artists over a time range.
+
+Results are cached in memory. Rollups only change when they are
+refreshed, and every refresh stamps rollup_state with its time, so each
+cached result is tagged with the state it was computed at, and is
+served for as long as the state hasn't changed - checking it is one
+primary key lookup, however large songplays grows. (The songplay
+watermark alone isn't enough: a refresh of days marked stale by the
+backfill changes the rollups without moving it.)
+"""
+
+from collections import OrderedDict
+from sql_queries import (rollup_version_select, plays_per_hour_select, plays_per_day_select,
+                         plays_per_level_select, plays_per_user_select, top_songs_select,
+                         top_artists_select)
+
+DEF_CACHE_SIZE = 256
+
+
+class RollupQueries:
+    def __init__(self, cur, cache_size=DEF_CACHE_SIZE):
+        """
+        Initialize the query module on a DB cursor, with an LRU cache
+        of up to cache_size results.
+        """
+        self.cur = cur
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def version(self):
+        """The rollups' current version: their songplay watermark and the
+        time of their last refresh (None before the first refresh)."""
+        self.cur.execute(rollup_version_select)
+        row = self.cur.fetchone()
+        return tuple(row) if row else None
+
+    def query(self, query, params):
+        """Run a rollup query, or serve it from the cache.
+        Args:       query: SQL query
+                    params: tuple of query parameters
+        Returns:    list of result rows
+        """
+        key = (query, params)
+        version = self.version()
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        self.cur.execute(query, params)
+        rows = self.cur.fetchall()
+        self.cache[key] = (version, rows)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return rows
+
+    def plays_per_hour(self, start, end):
+        """Plays per hour in [start, end): list of (hour, plays)."""
+        return self.query(plays_per_hour_select, (start, end))
+
+    def plays_per_day(self, start, end):
+        """Plays per day in [start, end): list of (day, plays)."""
+        return self.query(plays_per_day_select, (start, end))
+
+    def plays_per_level(self, start, end):
+        """Plays per level (free/paid) in [start, end): list of (level, plays)."""
+        return self.query(plays_per_level_select, (start, end))
+
+    def plays_per_user(self, start, end, limit=10):
+        """The most active users in [start, end): list of (user_id, level, plays)."""
+        return self.query(plays_per_user_select, (start, end, limit))
+
+    def top_songs(self, start, end, limit=10):
+        """The most played songs in [start, end): list of (song_id, title, artist, plays)."""
+        return self.query(top_songs_select, (start, end, limit))
+
+    def top_artists(self, start, end, limit=10):
+        """The most played artists in [start, end): list of (artist_id, name, plays)."""
+        return self.query(top_artists_select, (start, end, limit))
@@ -0,0 +1,51 @@
+"""
+rollups.py
+
+Incremental refresh of the analytics rollups - plays per hour and level
+(plays_by_hour), per user and level per day (plays_by_user_day), and per
+song per day (plays_by_song_day, which also serves the top artists) -
+so dashboard queries read a few pre-aggregated rows instead of scanning
+songplays.
+
+songplay_ids only grow, so rollup_state records the highest songplay_id
+the rollups have been refreshed up to. A refresh finds the days holding
+songplays added since, along with any days marked stale in
+rollup_stale_days (songplays re-resolved by the backfill, see
+backfill.py), and recomputes the rollup rows of those days - and only
+those - from songplays, all in one transaction. Recomputing whole days,
+rather than adding the new counts on, keeps the rollups exact however
+the songplays got there.
+"""
+
+import logging
+from sql_queries import (rollup_state_select, rollup_max_songplay_select, rollup_days_create,
+                         rollup_refresh_queries, rollup_stale_days_clear, rollup_state_upsert)
+
+
+def refresh_rollups(conn, cur):
+    """Refresh the rollups for the days with songplays added since the
+    last refresh, and the days marked stale.
+    Args:       conn: DB connection
+                cur:  DB cursor
+    Returns:    number of days refreshed
+    """
+    cur.execute(rollup_state_select)
+    row = cur.fetchone()
+    last_id = row[0] if row else 0
+    cur.execute(rollup_max_songplay_select)
+    max_id = max(cur.fetchone()[0] or 0, last_id)
+
+    cur.execute(rollup_days_create, (last_id, max_id))
+    days = cur.rowcount
+    if not days:
+        conn.commit()
+        logging.info('Rollups: no new songplays or stale days - nothing to refresh')
+        return 0
+    for delete_query, insert_query in rollup_refresh_queries:
+        cur.execute(delete_query)
+        cur.execute(insert_query)
+    cur.execute(rollup_stale_days_clear)
+    cur.execute(rollup_state_upsert, (max_id,))
+    conn.commit()
+    logging.info(f'Rollups: refreshed {days} days, songplays {last_id + 1}-{max_id}')
+    return days
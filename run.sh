@@ -5,6 +5,34 @@
 ## First run the create_tables.py script;
 ## Then run the ETL pipeline.
 ##
+## With --incremental, the DB is left in place, and the
+## pipeline only loads files that are new or changed
+## since the last run.
+##
+## With --shards N, the log files are split into N shards,
+## loaded by N pipelines side by side, each into its own
+## tables, which are then merged into the main tables.
+##
 
-python3 ./create_tables.py
-python3 ./etl.py
+if [ "$1" == "--incremental" ]; then
+    python3 ./etl.py --incremental
+elif [ "$1" == "--shards" ]; then
+    python3 ./create_tables.py
+    status=0
+    pids=()
+    for ((i = 0; i < $2; i++)); do
+        python3 ./etl.py --shard "$i/$2" &
+        pids+=($!)
+    done
+    for pid in "${pids[@]}"; do
+        wait "$pid" || status=1
+    done
+    if [ $status -ne 0 ]; then
+        echo "a shard failed - rerun it with: python3 ./etl.py --shard i/$2" >&2
+        exit $status
+    fi
+    python3 ./etl.py --merge-shards "$2"
+else
+    python3 ./create_tables.py
+    python3 ./etl.py
+fi
@@ -0,0 +1,176 @@
+"""
+sharding.py
+
+Deterministic sharding of a run across several processes or hosts.
+`etl.py --shard i/N` loads only the log files whose path - relative to
+the log data root, so every host agrees whatever its mount point -
+hashes to shard i of N. Song files are the small, dimension side of
+the data, and every songplay needs all of them for its enrichment, so
+each shard loads all of them.
+
+Each shard loads into the tables of its own schema, shard_i, which the
+shard run puts first on the DB search path; everything else (the file
+manifest, the rollups) still resolves to the main tables, which are
+created, when missing, on the default search path before the shard's
+are (see create_main_tables). A shard run doesn't defer the songplays
+index builds: the shard's songplays has no secondary indexes, and the
+unqualified index DDL would resolve to the main table's. Once all the
+shards have finished, `etl.py --merge-shards N` folds each shard into
+the main tables - deduplicating songs, artists, time and users, and
+appending songplays - and drops it, all in one transaction, so each
+shard's songplays are appended exactly once, however often the merge
+is rerun.
+"""
+
+import os
+import hashlib
+import logging
+import numpy as np
+from songplay_partitions import ensure_months
+import create_tables
+from sql_queries import (shard_schema_create, shard_schema_drop, shard_schema_exists,
+                         shard_search_path, shard_table_queries, shard_songplay_months_select,
+                         shard_merge_queries, shard_setup_lock, shard_setup_unlock,
+                         shard_checkpoint_exists, shard_checkpoint_select)
+
+
+def parse_shard(spec):
+    """Parse a shard spec, "i/N".
+    Args:       spec: shard spec string
+    Returns:    (i, N) tuple
+    Raises:     ValueError if the spec isn't a valid shard of N
+    """
+    i, n = (int(part) for part in spec.split('/'))
+    if n < 1 or not 0 <= i < n:
+        raise ValueError(f'invalid shard {spec}: need 0 <= i < N')
+    return i, n
+
+
+def shard_schema(i):
+    """Name of the schema shard i loads into."""
+    return f'shard_{i}'
+
+
+def shard_of(path, root, n):
+    """The shard a file belongs to, out of n.
+    Args:       path: file path
+                root: data root the path is under
+                n: number of shards
+    Returns:    shard number
+    """
+    rel_path = os.path.relpath(path, root).replace(os.sep, '/')
+    digest = hashlib.sha1(rel_path.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % n
+
+
+def shard_files(files, root, shard):
+    """Keep only the files of a shard.
+    Args:       files: list of file paths
+                root: data root the paths are under
+                shard: (i, N) tuple
+    Returns:    list of file paths
+    """
+    i, n = shard
+    return [path for path in files if shard_of(path, root, n) == i]
+
+
+def shard_path(path, shard):
+    """Per-shard version of a local file path (e.g. a metrics report),
+    so shards on the same host don't overwrite each other's files."""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{shard_schema(shard[0])}{ext}'
+
+
+def create_main_tables(conn, cur, partitioned=False):
+    """Create any missing main tables (and the manifest, rollup and
+    trigger objects), one shard at a time, as the shards of a run start
+    side by side.
+    Args:       conn: DB connection, on the default search path
+                cur:  DB cursor
+                partitioned: True to create songplays partitioned by month
+    Returns:    None
+    """
+    cur.execute(shard_setup_lock)
+    try:
+        create_tables.create_tables(cur, conn, partitioned)
+    finally:
+        conn.rollback()
+        cur.execute(shard_setup_unlock)
+        conn.commit()
+
+
+def has_checkpoint(conn, cur, i):
+    """Whether shard i holds the checkpoint of an interrupted run.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                i: shard number
+    Returns:    bool
+    """
+    schema = shard_schema(i)
+    cur.execute(shard_checkpoint_exists.format(shard=schema))
+    found = cur.fetchone()[0]
+    if found:
+        cur.execute(shard_checkpoint_select.format(shard=schema))
+        found = cur.fetchone()[0]
+    conn.commit()
+    return found
+
+
+def create_shard(conn, cur, shard, fresh=True):
+    """Create a shard's schema and tables.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                shard: (i, N) tuple
+                fresh: True to drop anything left from an earlier attempt
+    Returns:    None
+    """
+    schema = shard_schema(shard[0])
+    if fresh:
+        cur.execute(shard_schema_drop.format(shard=schema))
+    cur.execute(shard_schema_create.format(shard=schema))
+    cur.execute(shard_search_path.format(shard=schema))
+    for query in shard_table_queries:
+        logging.debug(query)
+        cur.execute(query)
+    conn.commit()
+    logging.info(f'Sharding: created tables for shard {shard[0]}/{shard[1]} in {schema}')
+
+
+def merge_shard(conn, cur, i):
+    """Merge one shard into the main tables and drop it, in one transaction.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                i: shard number
+    Returns:    True if the shard was merged; False if there was no such shard
+    """
+    schema = shard_schema(i)
+    cur.execute(shard_schema_exists, (schema,))
+    if not cur.fetchone()[0]:
+        conn.commit()
+        return False
+    # partitions have to exist before the songplays go in
+    cur.execute(shard_songplay_months_select.format(shard=schema))
+    ensure_months(conn, cur, [np.datetime64(month, 'M') for month, in cur.fetchall()])
+    for query in shard_merge_queries:
+        logging.debug(query)
+        cur.execute(query.format(shard=schema))
+    cur.execute(shard_schema_drop.format(shard=schema))
+    conn.commit()
+    logging.info(f'Sharding: merged {schema}')
+    return True
+
+
+def merge_shards(conn, cur, n):
+    """Merge shards 0 to n-1 into the main tables.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                n: number of shards
+    Returns:    number of shards merged
+    """
+    merged = 0
+    for i in range(n):
+        if merge_shard(conn, cur, i):
+            merged += 1
+        else:
+            logging.warning(f'Sharding: no {shard_schema(i)} to merge')
+    return merged
@@ -0,0 +1,134 @@
+"""
+song_index.py
+
+The song index maps (song title, artist name, duration) to the
+(song_id, artist_id) pair that song_select_qry would return, so that
+songplay enrichment becomes a dictionary probe instead of one
+songs/artists join per log event.
+
+The index is built once per run - either from the parsed song and
+artist data, or with a single bulk fetch from the DB - and can be
+pickled to a cache file, tagged with a fingerprint of the song files
+it was built from, so later runs over the same files skip the build.
+"""
+
+import os
+import pickle
+import hashlib
+import logging
+from sql_queries import song_index_select
+
+
+def song_key(title, artist_name, duration):
+    """Build the index key for a song.
+    Args:       title: song title
+                artist_name: artist name
+                duration: song duration in seconds
+    Returns:    hashable key tuple
+    """
+    return (title, artist_name, float(duration))
+
+
+class SongIndexBuilder:
+    def __init__(self):
+        """
+        Initialize an empty index. Song and artist data can then be
+        added batch by batch, as it is read.
+        """
+        self.index = {}
+        self.artist_names = {}
+        self.seen_songs = set()
+
+    def add(self, song_data, artist_data):
+        """Add a batch of parsed song and artist data to the index.
+        As with the ON CONFLICT DO NOTHING inserts, the first record
+        seen for a song_id or artist_id is the one that counts.
+        Args:       song_data: list of song data dicts
+                    artist_data: list of artist data dicts
+        Returns:    None
+        """
+        for artist in artist_data:
+            if artist['artist_id'] and artist['artist_id'] not in self.artist_names:
+                self.artist_names[artist['artist_id']] = artist['artist_name']
+
+        for song in song_data:
+            song_id = song['song_id']
+            artist_id = song['artist_id']
+            if song_id in self.seen_songs or artist_id not in self.artist_names:
+                continue
+            self.seen_songs.add(song_id)
+            key = song_key(song['title'], self.artist_names[artist_id], song['duration'])
+            self.index.setdefault(key, (song_id, artist_id))
+
+
+def build_song_index(song_data, artist_data):
+    """Build the index from the parsed song and artist data dicts.
+    Args:       song_data: list of song data dicts
+                artist_data: list of artist data dicts
+    Returns:    dict of song key -> (song_id, artist_id)
+    """
+    builder = SongIndexBuilder()
+    builder.add(song_data, artist_data)
+    logging.debug(f'Song index: built {len(builder.index)} entries from song data')
+    return builder.index
+
+
+def fetch_song_index(cur):
+    """Build the index with a single bulk fetch of the songs/artists join.
+    Args:       cur: DB cursor
+    Returns:    dict of song key -> (song_id, artist_id)
+    """
+    cur.execute(song_index_select)
+    index = {}
+    for title, artist_name, duration, song_id, artist_id in cur:
+        index.setdefault(song_key(title, artist_name, duration), (song_id, artist_id))
+    logging.debug(f'Song index: fetched {len(index)} entries from DB')
+    return index
+
+
+def files_fingerprint(files):
+    """Fingerprint a set of input files by path, size and mtime.
+    Args:       files: list of file paths
+    Returns:    hex digest string
+    """
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        st = os.stat(path)
+        digest.update(f'{path}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def load_song_index(cache_file, fingerprint):
+    """Load a cached index, if there is one built from the same files.
+    Args:       cache_file: path of the pickled index
+                fingerprint: fingerprint of the current song files
+    Returns:    the index dict, or None if there is no usable cache
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logging.warning(f'Song index: cannot read cache {cache_file}: {str(e)}')
+        return None
+    if cached.get('fingerprint') != fingerprint:
+        logging.info('Song index: cache is stale - rebuilding')
+        return None
+    logging.info(f'Song index: loaded {len(cached["index"])} entries from {cache_file}')
+    return cached['index']
+
+
+def save_song_index(index, cache_file, fingerprint):
+    """Pickle the index to the cache file, tagged with its fingerprint.
+    Args:       index: the index dict
+                cache_file: path of the pickled index
+                fingerprint: fingerprint of the song files it was built from
+    Returns:    None
+    """
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(dict(fingerprint=fingerprint, index=index), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    logging.debug(f'Song index: saved {len(index)} entries to {cache_file}')
@@ -0,0 +1,130 @@
+"""
+songplay_partitions.py
+
+Support for a songplays table range-partitioned by month on start_time
+(PARTITION_SONGPLAYS in config.json), and for deferring the songplays
+index builds during bulk loads (DEFER_INDEXES).
+
+Partitions are created on demand: before a batch of songplays is
+loaded, the months its start times fall in are worked out - in local
+time, as the start times are formatted - and any missing monthly
+partitions are created. Against an unpartitioned songplays table this
+is a no-op, so the pipeline doesn't need to know which layout the DB
+has.
+
+Dropping the secondary indexes before a bulk load and building them
+once afterwards replaces one index update per row with a single sorted
+build per index.
+"""
+
+import logging
+from contextlib import contextmanager
+import numpy as np
+from sql_queries import (songplay_partitioned_select, songplay_partitions_select,
+                         songplay_partition_create, songplay_index_create_queries,
+                         songplay_index_drop_queries)
+from time_dimension import local_ms
+
+
+def ts_months(ts):
+    """The distinct months (local time) of an array of timestamps.
+    Args:       ts: NumPy int64 array of millisecond timestamps
+    Returns:    sorted NumPy datetime64[M] array
+    """
+    return np.unique(local_ms(ts).astype('datetime64[ms]').astype('datetime64[M]'))
+
+
+def partition_name(month):
+    """Name of the partition holding a month, e.g. songplays_2018_11.
+    Args:       month: NumPy datetime64[M]
+    Returns:    partition table name
+    """
+    return 'songplays_' + str(month).replace('-', '_')
+
+
+def ensure_partitions(conn, cur, ts):
+    """Create any monthly songplays partitions missing for a batch of
+    timestamps. Does nothing if songplays isn't partitioned.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                ts: NumPy int64 array of millisecond timestamps
+    Returns:    list of the partitions created
+    """
+    return ensure_months(conn, cur, ts_months(ts))
+
+
+def ensure_months(conn, cur, months):
+    """Create any monthly songplays partitions missing for a set of
+    months. Does nothing if songplays isn't partitioned.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                months: iterable of NumPy datetime64[M]
+    Returns:    list of the partitions created
+    """
+    cur.execute(songplay_partitioned_select)
+    if not cur.fetchone()[0]:
+        conn.commit()
+        return []
+    cur.execute(songplay_partitions_select)
+    existing = {name for name, in cur}
+
+    created = []
+    for month in months:
+        name = partition_name(month)
+        if name in existing:
+            continue
+        cur.execute(songplay_partition_create.format(name=name,
+                                                     start=f'{month}-01',
+                                                     end=f'{month + 1}-01'))
+        created.append(name)
+    conn.commit()
+    if created:
+        logging.info(f'Partitions: created songplays partitions {created}')
+    return created
+
+
+def drop_indexes(conn, cur):
+    """Drop the songplays secondary indexes ahead of a bulk load.
+    Args:       conn: DB connection
+                cur:  DB cursor
+    Returns:    None
+    """
+    for query in songplay_index_drop_queries:
+        logging.debug(query)
+        cur.execute(query)
+    conn.commit()
+    logging.info('Partitions: dropped songplays indexes for the load')
+
+
+def build_indexes(conn, cur):
+    """(Re)build the songplays secondary indexes after a bulk load.
+    Args:       conn: DB connection
+                cur:  DB cursor
+    Returns:    None
+    """
+    for query in songplay_index_create_queries:
+        logging.debug(query)
+        cur.execute(query)
+    conn.commit()
+    logging.info('Partitions: built songplays indexes')
+
+
+@contextmanager
+def deferred_indexes(conn, cur, defer=True):
+    """Drop the songplays secondary indexes for the duration of a load,
+    and build them again when it ends - whether or not it succeeded.
+    Args:       conn: DB connection
+                cur:  DB cursor
+                defer: False to leave the indexes alone
+    Returns:    context manager
+    """
+    if not defer:
+        yield
+        return
+    drop_indexes(conn, cur)
+    try:
+        yield
+    finally:
+        # a failed load may have left the transaction aborted
+        conn.rollback()
+        build_indexes(conn, cur)
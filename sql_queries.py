@@ -10,6 +10,18 @@ artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
 user_table_drop = "DROP TABLE IF EXISTS users"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
+manifest_table_drop = "DROP TABLE IF EXISTS processed_files"
+songplay_staging_drop = "DROP TABLE IF EXISTS songplays_staging"
+user_level_table_drop = "DROP TABLE IF EXISTS user_levels"
+hourly_rollup_drop = "DROP TABLE IF EXISTS plays_by_hour"
+user_rollup_drop = "DROP TABLE IF EXISTS plays_by_user_day"
+song_rollup_drop = "DROP TABLE IF EXISTS plays_by_song_day"
+rollup_state_drop = "DROP TABLE IF EXISTS rollup_state"
+rollup_stale_days_drop = "DROP TABLE IF EXISTS rollup_stale_days"
+songplay_unmatched_drop = "DROP TABLE IF EXISTS songplays_unmatched"
+songs_pending_drop = "DROP TABLE IF EXISTS songs_pending"
+songs_pending_function_drop = "DROP FUNCTION IF EXISTS record_new_songs() CASCADE"
+checkpoint_table_drop = "DROP TABLE IF EXISTS etl_checkpoint"
 
 
 # CREATE TABLES
@@ -43,6 +55,13 @@ user_table_create = """CREATE TABLE IF NOT EXISTS users(
                             gender char NOT NULL,
                             level varchar NOT NULL)"""
 
+# one row per change of a user's level (USER_LEVEL_HISTORY)
+user_level_table_create = """CREATE TABLE IF NOT EXISTS user_levels(
+                            user_id int NOT NULL,
+                            level varchar NOT NULL,
+                            start_time timestamp NOT NULL,
+                            PRIMARY KEY (user_id, start_time))"""
+
 songplay_table_create = """CREATE TABLE IF NOT EXISTS songplays(
                             songplay_id serial PRIMARY KEY,
                             start_time timestamp NOT NULL,
@@ -54,6 +73,127 @@ songplay_table_create = """CREATE TABLE IF NOT EXISTS songplays(
                             location varchar NOT NULL,
                             user_agent varchar NOT NULL)"""
 
+# songplays range-partitioned by month on start_time (PARTITION_SONGPLAYS);
+# the primary key has to include the partition key. Monthly partitions are
+# created as the data needs them (see songplay_partitions.py).
+songplay_table_create_partitioned = """CREATE TABLE IF NOT EXISTS songplays(
+                            songplay_id serial,
+                            start_time timestamp NOT NULL,
+                            user_id varchar NOT NULL,
+                            level varchar NOT NULL,
+                            song_id varchar,
+                            artist_id varchar,
+                            session_id int NOT NULL,
+                            location varchar NOT NULL,
+                            user_agent varchar NOT NULL,
+                            PRIMARY KEY (songplay_id, start_time))
+                            PARTITION BY RANGE (start_time)"""
+
+songplay_partition_create = """CREATE TABLE IF NOT EXISTS {name} PARTITION OF songplays
+                                FOR VALUES FROM ('{start}') TO ('{end}')"""
+
+# one row per input file loaded, for incremental runs
+manifest_table_create = """CREATE TABLE IF NOT EXISTS processed_files(
+                            path varchar PRIMARY KEY,
+                            size bigint NOT NULL,
+                            mtime double precision NOT NULL,
+                            content_hash varchar NOT NULL,
+                            processed_at timestamp NOT NULL DEFAULT now())"""
+
+
+
+# ANALYTICS ROLLUPS
+# pre-aggregated songplay counts, refreshed after each run for the days
+# the run added songplays to (see rollups.py)
+hourly_rollup_create = """CREATE TABLE IF NOT EXISTS plays_by_hour(
+                            hour timestamp NOT NULL,
+                            level varchar NOT NULL,
+                            plays bigint NOT NULL,
+                            PRIMARY KEY (hour, level))"""
+
+user_rollup_create = """CREATE TABLE IF NOT EXISTS plays_by_user_day(
+                            day date NOT NULL,
+                            user_id varchar NOT NULL,
+                            level varchar NOT NULL,
+                            plays bigint NOT NULL,
+                            PRIMARY KEY (day, user_id, level))"""
+
+song_rollup_create = """CREATE TABLE IF NOT EXISTS plays_by_song_day(
+                            day date NOT NULL,
+                            song_id varchar NOT NULL,
+                            artist_id varchar NOT NULL,
+                            plays bigint NOT NULL,
+                            PRIMARY KEY (day, song_id))"""
+
+# the last songplay_id the rollups have been refreshed up to
+rollup_state_create = """CREATE TABLE IF NOT EXISTS rollup_state(
+                            rollup varchar PRIMARY KEY,
+                            last_songplay_id bigint NOT NULL,
+                            refreshed_at timestamp NOT NULL DEFAULT now())"""
+
+# days whose rollups are out of date for other reasons than new songplays
+# (e.g. songplays re-resolved by the backfill), refreshed with the next run
+rollup_stale_days_create = """CREATE TABLE IF NOT EXISTS rollup_stale_days(
+                            day date PRIMARY KEY)"""
+
+
+# LATE-ARRIVING SONGS
+# the song lookup keys of the songplays loaded without a song match, so
+# the backfill can re-resolve them when the song turns up (see backfill.py)
+songplay_unmatched_create = """CREATE TABLE IF NOT EXISTS songplays_unmatched(
+                            start_time timestamp NOT NULL,
+                            user_id varchar NOT NULL,
+                            session_id int NOT NULL,
+                            song_title varchar NOT NULL,
+                            artist_name varchar NOT NULL,
+                            length decimal NOT NULL)"""
+
+# the songs inserted since the last backfill, recorded by a trigger on
+# songs - so it catches every load path, and only the songs actually
+# inserted, not those skipped as duplicates
+songs_pending_create = """CREATE TABLE IF NOT EXISTS songs_pending(
+                            song_id varchar PRIMARY KEY)"""
+
+songs_pending_function_create = """CREATE OR REPLACE FUNCTION record_new_songs() RETURNS trigger
+                            LANGUAGE plpgsql AS $$
+                            BEGIN
+                                INSERT INTO songs_pending(song_id) SELECT song_id FROM new_songs
+                                ON CONFLICT (song_id) DO NOTHING;
+                                RETURN NULL;
+                            END $$"""
+songs_pending_trigger_drop = "DROP TRIGGER IF EXISTS songs_pending_trigger ON songs"
+songs_pending_trigger_create = """CREATE TRIGGER songs_pending_trigger AFTER INSERT ON songs
+                            REFERENCING NEW TABLE AS new_songs
+                            FOR EACH STATEMENT EXECUTE PROCEDURE record_new_songs()"""
+
+
+# CREATE INDEXES
+# supports the songplay enrichment join on title, artist name and duration
+song_title_index_create = """CREATE INDEX IF NOT EXISTS songs_title_duration_idx
+                                ON songs (title, duration, artist_id) INCLUDE (song_id)"""
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name, artist_id)"
+
+# songplays secondary indexes: BRIN on start_time (rows arrive roughly in
+# time order), B-tree on user_id and song_id. Built on the parent table,
+# they cascade to every partition. Bulk loads can drop them and build them
+# again afterwards (DEFER_INDEXES).
+songplay_start_time_index_create = "CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays USING brin (start_time)"
+songplay_user_index_create = "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id)"
+songplay_song_index_create = "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id)"
+# partial index over just the songplays without a song match, for the
+# backfill to find them by (user_id, session_id, start_time)
+songplay_unmatched_index_create = """CREATE INDEX IF NOT EXISTS songplays_unmatched_idx
+                                        ON songplays (user_id, session_id, start_time) WHERE song_id IS NULL"""
+# the unmatched song lookup keys, probed with the keys of the new songs
+unmatched_key_index_create = """CREATE INDEX IF NOT EXISTS songplays_unmatched_key_idx
+                                    ON songplays_unmatched (song_title, artist_name, length)"""
+
+songplay_start_time_index_drop = "DROP INDEX IF EXISTS songplays_start_time_idx"
+songplay_user_index_drop = "DROP INDEX IF EXISTS songplays_user_id_idx"
+songplay_song_index_drop = "DROP INDEX IF EXISTS songplays_song_id_idx"
+songplay_unmatched_index_drop = "DROP INDEX IF EXISTS songplays_unmatched_idx"
+
+
 # INSERT RECORDS
 song_table_insert = """INSERT INTO songs(song_id, title, artist_id, year, duration)
                         VALUES (%s, %s, %s, %s, %s)
@@ -64,14 +204,34 @@ artist_table_insert = """INSERT INTO artists(artist_id, name, location, latitude
                             ON CONFLICT (artist_id) DO NOTHING"""
 
 time_table_insert = """INSERT INTO time(timestamp, hour, day, week, month, year, weekday) 
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+                            VALUES (%s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (timestamp) DO NOTHING"""
 
 user_table_insert = """INSERT INTO users(user_id, first_name, last_name, gender, level) 
                             VALUES (%s, %s, %s, %s, %s)
                             ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level"""
 
-songplay_table_insert = """INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
+user_level_table_insert = """INSERT INTO user_levels(user_id, level, start_time)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (user_id, start_time) DO NOTHING"""
+
+# a songplay, and - if it has no song match - its song lookup key, kept
+# in songplays_unmatched for the backfill, in the same statement
+songplay_table_insert = """WITH played AS (
+                                INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                                RETURNING start_time, user_id, session_id, song_id)
+                            INSERT INTO songplays_unmatched(start_time, user_id, session_id,
+                                                            song_title, artist_name, length)
+                            SELECT start_time, user_id, session_id, %s, %s, %s::decimal
+                            FROM played WHERE song_id IS NULL"""
+
+manifest_table_insert = """INSERT INTO processed_files(path, size, mtime, content_hash)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size,
+                                mtime = EXCLUDED.mtime,
+                                content_hash = EXCLUDED.content_hash,
+                                processed_at = now()"""
 
 
 # FIND SONGS
@@ -79,7 +239,467 @@ song_select_qry = "SELECT song_id, s.artist_id \
                     FROM songs s JOIN artists a on s.artist_id = a.artist_id \
                     WHERE title = '{}' and a.name = '{}' and duration = {}"
 
+# all songs with their artist names, to build the in-memory song index
+song_index_select = """SELECT s.title, a.name, s.duration, s.song_id, s.artist_id
+                        FROM songs s JOIN artists a ON s.artist_id = a.artist_id"""
+
+
+# enrich the staged NextSong events into songplays in one set-based
+# pass: the staged events are LEFT JOINed to songs and artists on title,
+# duration and artist name - a plain join the planner can hash whole
+# batches through - and reduced to the first song_id per event, as the
+# song index keeps, with a DISTINCT ON over the staged rows only. The
+# LEFT JOIN gives unmatched events NULL song and artist IDs; their song
+# lookup keys are kept in songplays_unmatched for the backfill
+songplay_staging_merge = """WITH matched AS (
+                                SELECT DISTINCT ON (e.event_id)
+                                       e.start_time, e.user_id, e.level, s.song_id, s.artist_id,
+                                       e.session_id, e.location, e.user_agent,
+                                       e.song_title, e.artist_name, e.length
+                                FROM songplays_staging e
+                                LEFT JOIN (songs s JOIN artists a ON a.artist_id = s.artist_id)
+                                    ON s.title = e.song_title
+                                   AND s.duration = e.length
+                                   AND a.name = e.artist_name
+                                ORDER BY e.event_id, s.song_id),
+                            unmatched AS (
+                                INSERT INTO songplays_unmatched(start_time, user_id, session_id,
+                                                                song_title, artist_name, length)
+                                SELECT start_time, user_id, session_id, song_title, artist_name, length
+                                FROM matched WHERE song_id IS NULL)
+                            INSERT INTO songplays(start_time, user_id, level, song_id, artist_id,
+                                                  session_id, location, user_agent)
+                            SELECT start_time, user_id, level, song_id, artist_id,
+                                   session_id, location, user_agent
+                            FROM matched"""
+
+
+# whether songplays is partitioned, and its existing partitions
+songplay_partitioned_select = """SELECT EXISTS (SELECT 1 FROM pg_partitioned_table
+                                                WHERE partrelid = 'songplays'::regclass)"""
+songplay_partitions_select = """SELECT c.relname FROM pg_inherits i
+                                JOIN pg_class c ON c.oid = i.inhrelid
+                                WHERE i.inhparent = 'songplays'::regclass"""
+
+
+# manifest entries for all files already loaded
+manifest_select = "SELECT path, size, mtime, content_hash FROM processed_files"
+
+
+# ROLLUP REFRESH
+rollup_state_select = "SELECT last_songplay_id FROM rollup_state WHERE rollup = 'songplays'"
+# moves with every refresh - including those of stale days only, which
+# leave last_songplay_id where it was
+rollup_version_select = "SELECT last_songplay_id, refreshed_at FROM rollup_state WHERE rollup = 'songplays'"
+rollup_max_songplay_select = "SELECT max(songplay_id) FROM songplays"
+
+# the days holding songplays added since the last refresh, and any days
+# marked stale since
+rollup_days_create = """CREATE TEMP TABLE rollup_days ON COMMIT DROP AS
+                            SELECT start_time::date AS day FROM songplays
+                            WHERE songplay_id > %s AND songplay_id <= %s
+                            UNION
+                            SELECT day FROM rollup_stale_days"""
+rollup_stale_days_clear = "DELETE FROM rollup_stale_days WHERE day IN (SELECT day FROM rollup_days)"
+
+hourly_rollup_delete = """DELETE FROM plays_by_hour r USING rollup_days d
+                            WHERE r.hour >= d.day AND r.hour < d.day + 1"""
+hourly_rollup_insert = """INSERT INTO plays_by_hour(hour, level, plays)
+                            SELECT date_trunc('hour', s.start_time), s.level, count(*)
+                            FROM songplays s JOIN rollup_days d
+                              ON s.start_time >= d.day AND s.start_time < d.day + 1
+                            GROUP BY 1, 2"""
+
+user_rollup_delete = "DELETE FROM plays_by_user_day WHERE day IN (SELECT day FROM rollup_days)"
+user_rollup_insert = """INSERT INTO plays_by_user_day(day, user_id, level, plays)
+                            SELECT d.day, s.user_id, s.level, count(*)
+                            FROM songplays s JOIN rollup_days d
+                              ON s.start_time >= d.day AND s.start_time < d.day + 1
+                            GROUP BY 1, 2, 3"""
+
+song_rollup_delete = "DELETE FROM plays_by_song_day WHERE day IN (SELECT day FROM rollup_days)"
+song_rollup_insert = """INSERT INTO plays_by_song_day(day, song_id, artist_id, plays)
+                            SELECT d.day, s.song_id, min(s.artist_id), count(*)
+                            FROM songplays s JOIN rollup_days d
+                              ON s.start_time >= d.day AND s.start_time < d.day + 1
+                            WHERE s.song_id IS NOT NULL
+                            GROUP BY 1, 2"""
+
+rollup_state_upsert = """INSERT INTO rollup_state(rollup, last_songplay_id)
+                            VALUES ('songplays', %s)
+                            ON CONFLICT (rollup) DO UPDATE SET last_songplay_id = EXCLUDED.last_songplay_id,
+                                refreshed_at = now()"""
+
+rollup_refresh_queries = [(hourly_rollup_delete, hourly_rollup_insert),
+                          (user_rollup_delete, user_rollup_insert),
+                          (song_rollup_delete, song_rollup_insert)]
+
+
+# ROLLUP QUERIES
+# dashboard reads, served from the rollups (see rollup_queries.py);
+# each takes a [start, end) time range
+plays_per_hour_select = """SELECT hour, sum(plays) FROM plays_by_hour
+                            WHERE hour >= %s AND hour < %s
+                            GROUP BY hour ORDER BY hour"""
+
+plays_per_day_select = """SELECT hour::date AS day, sum(plays) FROM plays_by_hour
+                            WHERE hour >= %s AND hour < %s
+                            GROUP BY day ORDER BY day"""
+
+plays_per_level_select = """SELECT level, sum(plays) FROM plays_by_hour
+                            WHERE hour >= %s AND hour < %s
+                            GROUP BY level ORDER BY level"""
+
+plays_per_user_select = """SELECT user_id, level, sum(plays) AS plays FROM plays_by_user_day
+                            WHERE day >= %s AND day < %s
+                            GROUP BY user_id, level ORDER BY plays DESC, user_id LIMIT %s"""
+
+top_songs_select = """SELECT r.song_id, s.title, a.name, sum(r.plays) AS plays
+                        FROM plays_by_song_day r
+                        JOIN songs s ON s.song_id = r.song_id
+                        JOIN artists a ON a.artist_id = r.artist_id
+                        WHERE r.day >= %s AND r.day < %s
+                        GROUP BY r.song_id, s.title, a.name ORDER BY plays DESC, r.song_id LIMIT %s"""
+
+top_artists_select = """SELECT r.artist_id, a.name, sum(r.plays) AS plays
+                        FROM plays_by_song_day r
+                        JOIN artists a ON a.artist_id = r.artist_id
+                        WHERE r.day >= %s AND r.day < %s
+                        GROUP BY r.artist_id, a.name ORDER BY plays DESC, r.artist_id LIMIT %s"""
+
+
+# ANALYTICAL WORKLOAD
+# reads against the star schema itself, not the rollups, benchmarked by
+# bench_queries.py across schema and index variants
+# plays per hour of the day, from the time dimension
+workload_plays_by_hour = """SELECT t.hour, count(*) AS plays
+                            FROM songplays sp JOIN time t ON t.timestamp = sp.start_time
+                            GROUP BY t.hour ORDER BY t.hour"""
+
+# plays per weekday and hour over a start_time range - the range scan the
+# BRIN index and the monthly partitions are there for
+workload_plays_in_range = """SELECT t.weekday, t.hour, count(*) AS plays
+                            FROM songplays sp JOIN time t ON t.timestamp = sp.start_time
+                            WHERE sp.start_time >= %s AND sp.start_time < %s
+                            GROUP BY t.weekday, t.hour ORDER BY t.weekday, t.hour"""
+
+# the most played songs of each level (free/paid)
+workload_top_songs_per_level = """SELECT level, title, name, plays FROM (
+                                SELECT sp.level, s.title, a.name, count(*) AS plays,
+                                       row_number() OVER (PARTITION BY sp.level
+                                                          ORDER BY count(*) DESC, s.song_id) AS rank
+                                FROM songplays sp
+                                JOIN songs s ON s.song_id = sp.song_id
+                                JOIN artists a ON a.artist_id = sp.artist_id
+                                GROUP BY sp.level, s.song_id, s.title, a.name) ranked
+                            WHERE rank <= %s ORDER BY level, rank"""
+
+# per-user session stats: sessions, plays and minutes per session, and
+# how many of the plays and artists are known
+workload_user_sessions = """SELECT u.user_id, u.first_name, u.last_name, u.level,
+                                   count(*) AS sessions, sum(ss.plays) AS plays,
+                                   avg(ss.plays) AS plays_per_session,
+                                   avg(ss.minutes) AS minutes_per_session,
+                                   sum(ss.known_plays) AS known_plays,
+                                   sum(ss.artists) AS session_artists
+                            FROM (SELECT sp.user_id, sp.session_id, count(*) AS plays,
+                                         count(s.song_id) AS known_plays,
+                                         count(DISTINCT a.artist_id) AS artists,
+                                         extract(epoch FROM max(sp.start_time) - min(sp.start_time)) / 60
+                                             AS minutes
+                                  FROM songplays sp
+                                  LEFT JOIN songs s ON s.song_id = sp.song_id
+                                  LEFT JOIN artists a ON a.artist_id = sp.artist_id
+                                  GROUP BY sp.user_id, sp.session_id) ss
+                            JOIN users u ON u.user_id::varchar = ss.user_id
+                            GROUP BY u.user_id, u.first_name, u.last_name, u.level
+                            ORDER BY sessions DESC, u.user_id LIMIT %s"""
+
+# the start_time range covering the last N days of songplays
+workload_range_select = """SELECT max(start_time) - %s * interval '1 day',
+                                   max(start_time) + interval '1 second'
+                            FROM songplays"""
+
+
+# SONGPLAY BACKFILL
+# the songs inserted since the last backfill; the pending rows are
+# deleted in the same transaction, so songs inserted meanwhile wait
+# for the next backfill
+backfill_songs_create = """CREATE TEMP TABLE backfill_songs ON COMMIT DROP AS
+                            SELECT song_id FROM songs_pending"""
+backfill_songs_clear = """DELETE FROM songs_pending p USING backfill_songs b
+                            WHERE p.song_id = b.song_id"""
+
+# the unmatched songplay keys the new songs match: driven by the new
+# songs, probing the unmatched keys by index, so the cost follows the
+# number of new songs rather than the size of songplays. Songs are
+# matched as in the enrichment join - the first song_id of each
+# (title, name, duration)
+backfill_matches_create = """CREATE TEMP TABLE backfill_matches ON COMMIT DROP AS
+                            SELECT u.start_time, u.user_id, u.session_id,
+                                   u.song_title, u.artist_name, u.length, m.song_id, m.artist_id
+                            FROM (SELECT DISTINCT ON (s.title, a.name, s.duration)
+                                         s.title, a.name, s.duration, s.song_id, s.artist_id
+                                  FROM backfill_songs b
+                                  JOIN songs s ON s.song_id = b.song_id
+                                  JOIN artists a ON a.artist_id = s.artist_id
+                                  ORDER BY s.title, a.name, s.duration, s.song_id) m
+                            JOIN songplays_unmatched u
+                              ON u.song_title = m.title
+                             AND u.artist_name = m.name
+                             AND u.length = m.duration"""
+
+# fill in the matched songplays - found through the partial index over
+# the unmatched ones - and mark their days' rollups stale
+backfill_songplay_update = """WITH updated AS (
+                                UPDATE songplays sp SET song_id = b.song_id, artist_id = b.artist_id
+                                FROM backfill_matches b
+                                WHERE sp.song_id IS NULL
+                                  AND sp.user_id = b.user_id
+                                  AND sp.session_id = b.session_id
+                                  AND sp.start_time = b.start_time
+                                RETURNING sp.start_time)
+                            INSERT INTO rollup_stale_days(day)
+                            SELECT DISTINCT start_time::date FROM updated
+                            ON CONFLICT (day) DO NOTHING"""
+backfill_songplay_count = "SELECT count(*) FROM backfill_matches"
+
+backfill_unmatched_clear = """DELETE FROM songplays_unmatched u USING backfill_matches b
+                            WHERE u.song_title = b.song_title
+                              AND u.artist_name = b.artist_name
+                              AND u.length = b.length
+                              AND u.start_time = b.start_time
+                              AND u.user_id = b.user_id
+                              AND u.session_id = b.session_id"""
+
+
+# CHECKPOINTS
+# each stage's position in the input, saved in the same transaction as
+# the batch that brought it there (see checkpoint.py)
+checkpoint_table_create = """CREATE TABLE IF NOT EXISTS etl_checkpoint(
+                                stage varchar PRIMARY KEY,
+                                file varchar NOT NULL,
+                                line int NOT NULL)"""
+checkpoint_select = "SELECT stage, file, line FROM etl_checkpoint"
+checkpoint_upsert = """INSERT INTO etl_checkpoint(stage, file, line) VALUES (%s, %s, %s)
+                        ON CONFLICT (stage) DO UPDATE SET file = EXCLUDED.file, line = EXCLUDED.line"""
+checkpoint_clear = "DELETE FROM etl_checkpoint"
+# the latest level of each user loaded, for a resumed run's level history
+user_level_select = "SELECT user_id, level FROM users"
+
+
+# SHARDS
+# a sharded run (etl.py --shard i/N) loads into the tables of its own
+# schema, shard_i; the merge (etl.py --merge-shards N) folds each shard
+# into the main tables and drops it, in one transaction per shard
+shard_schema_create = "CREATE SCHEMA IF NOT EXISTS {shard}"
+shard_schema_drop = "DROP SCHEMA IF EXISTS {shard} CASCADE"
+shard_schema_exists = "SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = %s)"
+shard_search_path = "SET search_path TO {shard}, public"
+# serializes the shards of a run creating any missing main tables
+shard_setup_lock = "SELECT pg_advisory_lock(hashtext('shard_setup'))"
+shard_setup_unlock = "SELECT pg_advisory_unlock(hashtext('shard_setup'))"
+# whether a shard holds a checkpoint to resume from
+shard_checkpoint_exists = "SELECT to_regclass('{shard}.etl_checkpoint') IS NOT NULL"
+shard_checkpoint_select = "SELECT EXISTS (SELECT 1 FROM {shard}.etl_checkpoint)"
+
+shard_song_merge = """INSERT INTO public.songs(song_id, title, artist_id, year, duration)
+                        SELECT song_id, title, artist_id, year, duration FROM {shard}.songs
+                        ON CONFLICT (song_id) DO NOTHING"""
+
+shard_artist_merge = """INSERT INTO public.artists(artist_id, name, location, latitude, longitude)
+                        SELECT artist_id, name, location, latitude, longitude FROM {shard}.artists
+                        ON CONFLICT (artist_id) DO NOTHING"""
+
+shard_time_merge = """INSERT INTO public.time(timestamp, hour, day, week, month, year, weekday)
+                        SELECT timestamp, hour, day, week, month, year, weekday FROM {shard}.time
+                        ON CONFLICT (timestamp) DO NOTHING"""
+
+shard_songplay_months_select = "SELECT DISTINCT date_trunc('month', start_time) FROM {shard}.songplays"
+
+shard_songplay_merge = """INSERT INTO public.songplays(start_time, user_id, level, song_id, artist_id,
+                                                       session_id, location, user_agent)
+                        SELECT start_time, user_id, level, song_id, artist_id,
+                               session_id, location, user_agent
+                        FROM {shard}.songplays ORDER BY start_time, songplay_id"""
+
+# a user's level is the level of their latest songplay across all the
+# shards merged so far - whichever order the shards are merged in, the
+# last merge of a user sees all of their songplays
+shard_user_merge = """INSERT INTO public.users(user_id, first_name, last_name, gender, level)
+                        SELECT u.user_id, u.first_name, u.last_name, u.gender, coalesce(l.level, u.level)
+                        FROM {shard}.users u
+                        LEFT JOIN (SELECT DISTINCT ON (user_id) user_id, level FROM public.songplays
+                                   WHERE user_id IN (SELECT user_id::varchar FROM {shard}.users)
+                                   ORDER BY user_id, start_time DESC, level) l
+                          ON l.user_id = u.user_id::varchar
+                        ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level"""
+
+shard_user_level_merge = """INSERT INTO public.user_levels(user_id, level, start_time)
+                        SELECT user_id, level, start_time FROM {shard}.user_levels
+                        ON CONFLICT (user_id, start_time) DO NOTHING"""
+
+shard_unmatched_merge = """INSERT INTO public.songplays_unmatched(start_time, user_id, session_id,
+                                                                  song_title, artist_name, length)
+                        SELECT start_time, user_id, session_id, song_title, artist_name, length
+                        FROM {shard}.songplays_unmatched"""
+
+# in merge order: songplays before users, whose levels come from them
+shard_merge_queries = [shard_song_merge, shard_artist_merge, shard_time_merge,
+                       shard_songplay_merge, shard_unmatched_merge, shard_user_merge,
+                       shard_user_level_merge]
+
+
+# BULK LOAD (COPY) STAGING TABLES
+# Temporary staging tables mirror their target table; rows are COPY'd in,
+# merged into the target with the same conflict rules as the inserts above,
+# and cleared again when the batch commits.
+song_staging_create = "CREATE TEMP TABLE IF NOT EXISTS songs_staging (LIKE songs) ON COMMIT DELETE ROWS"
+artist_staging_create = "CREATE TEMP TABLE IF NOT EXISTS artists_staging (LIKE artists) ON COMMIT DELETE ROWS"
+time_staging_create = "CREATE TEMP TABLE IF NOT EXISTS time_staging (LIKE time) ON COMMIT DELETE ROWS"
+user_staging_create = "CREATE TEMP TABLE IF NOT EXISTS users_staging (LIKE users) ON COMMIT DELETE ROWS"
+user_level_staging_create = "CREATE TEMP TABLE IF NOT EXISTS user_levels_staging (LIKE user_levels) ON COMMIT DELETE ROWS"
+# enriched songplays, with their song lookup keys, COPY'd in and merged
+# into songplays and (the unmatched ones' keys) songplays_unmatched in one
+# statement - so a key is only kept for a songplay loaded in the same batch
+songplay_rows_staging_create = """CREATE TEMP TABLE IF NOT EXISTS songplay_rows_staging(
+                            start_time timestamp NOT NULL,
+                            user_id varchar NOT NULL,
+                            level varchar NOT NULL,
+                            song_id varchar,
+                            artist_id varchar,
+                            session_id int NOT NULL,
+                            location varchar NOT NULL,
+                            user_agent varchar NOT NULL,
+                            song_title varchar NOT NULL,
+                            artist_name varchar NOT NULL,
+                            length decimal NOT NULL) ON COMMIT DELETE ROWS"""
+# raw NextSong events, COPY'd in and enriched into songplays with a
+# single join (SONG_INDEX "sql"); per connection, like the other staging
+# tables, so concurrent writers never share (or lock) one. event_id
+# numbers the staged events, for the merge to keep one match per event
+songplay_staging_create = """CREATE TEMP TABLE IF NOT EXISTS songplays_staging(
+                            event_id bigserial,
+                            start_time timestamp NOT NULL,
+                            user_id varchar NOT NULL,
+                            level varchar NOT NULL,
+                            song_title varchar NOT NULL,
+                            artist_name varchar NOT NULL,
+                            length decimal NOT NULL,
+                            session_id int NOT NULL,
+                            location varchar NOT NULL,
+                            user_agent varchar NOT NULL) ON COMMIT DELETE ROWS"""
+
+songplay_rows_staging_merge = """WITH unmatched AS (
+                                INSERT INTO songplays_unmatched(start_time, user_id, session_id,
+                                                                song_title, artist_name, length)
+                                SELECT start_time, user_id, session_id, song_title, artist_name, length
+                                FROM songplay_rows_staging WHERE song_id IS NULL)
+                            INSERT INTO songplays(start_time, user_id, level, song_id, artist_id,
+                                                  session_id, location, user_agent)
+                            SELECT start_time, user_id, level, song_id, artist_id,
+                                   session_id, location, user_agent
+                            FROM songplay_rows_staging"""
+
+song_staging_merge = """INSERT INTO songs(song_id, title, artist_id, year, duration)
+                            SELECT song_id, title, artist_id, year, duration FROM songs_staging
+                            ON CONFLICT (song_id) DO NOTHING"""
+
+artist_staging_merge = """INSERT INTO artists(artist_id, name, location, latitude, longitude)
+                            SELECT artist_id, name, location, latitude, longitude FROM artists_staging
+                            ON CONFLICT (artist_id) DO NOTHING"""
+
+time_staging_merge = """INSERT INTO time(timestamp, hour, day, week, month, year, weekday)
+                            SELECT timestamp, hour, day, week, month, year, weekday FROM time_staging
+                            ON CONFLICT (timestamp) DO NOTHING"""
+
+user_staging_merge = """INSERT INTO users(user_id, first_name, last_name, gender, level)
+                            SELECT user_id, first_name, last_name, gender, level FROM users_staging
+                            ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level"""
+
+
+user_level_staging_merge = """INSERT INTO user_levels(user_id, level, start_time)
+                            SELECT user_id, level, start_time FROM user_levels_staging
+                            ON CONFLICT (user_id, start_time) DO NOTHING"""
+
+
+# BULK LOAD TARGETS
+# For each table: the columns COPY'd, the staging table (None to COPY straight
+# into the target), its create and merge queries, the query emptying a
+# persistent staging table once merged (None for temp tables), and - for
+# upserts - the position of the conflict key, so a batch never carries the
+# same key twice.
+bulk_load_targets = {
+    'songs': dict(columns=('song_id', 'title', 'artist_id', 'year', 'duration'),
+                  staging='songs_staging',
+                  staging_create=song_staging_create,
+                  merge=song_staging_merge,
+                  clear=None,
+                  upsert_key=None),
+    'artists': dict(columns=('artist_id', 'name', 'location', 'latitude', 'longitude'),
+                    staging='artists_staging',
+                    staging_create=artist_staging_create,
+                    merge=artist_staging_merge,
+                    clear=None,
+                    upsert_key=None),
+    'time': dict(columns=('timestamp', 'hour', 'day', 'week', 'month', 'year', 'weekday'),
+                 staging='time_staging',
+                 staging_create=time_staging_create,
+                 merge=time_staging_merge,
+                 clear=None,
+                 upsert_key=None),
+    'users': dict(columns=('user_id', 'first_name', 'last_name', 'gender', 'level'),
+                  staging='users_staging',
+                  staging_create=user_staging_create,
+                  merge=user_staging_merge,
+                  clear=None,
+                  upsert_key=0),
+    'user_levels': dict(columns=('user_id', 'level', 'start_time'),
+                        staging='user_levels_staging',
+                        staging_create=user_level_staging_create,
+                        merge=user_level_staging_merge,
+                        clear=None,
+                        upsert_key=None),
+    # enriched songplays, with their song lookup keys for songplays_unmatched
+    'songplays': dict(columns=('start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                               'session_id', 'location', 'user_agent',
+                               'song_title', 'artist_name', 'length'),
+                      staging='songplay_rows_staging',
+                      staging_create=songplay_rows_staging_create,
+                      merge=songplay_rows_staging_merge,
+                      clear=None,
+                      upsert_key=None),
+    # raw NextSong events, enriched into songplays by the merge (SONG_INDEX "sql")
+    'songplay_events': dict(columns=('start_time', 'user_id', 'level', 'song_title', 'artist_name',
+                                     'length', 'session_id', 'location', 'user_agent'),
+                            staging='songplays_staging',
+                            staging_create=songplay_staging_create,
+                            merge=songplay_staging_merge,
+                            clear=None,
+                            upsert_key=None),
+}
+
 
 # QUERY LISTS
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create,
+                        user_level_table_create,
+                        hourly_rollup_create, user_rollup_create, song_rollup_create, rollup_state_create,
+                        rollup_stale_days_create, songplay_unmatched_create, songs_pending_create,
+                        songs_pending_function_create, songs_pending_trigger_drop, songs_pending_trigger_create,
+                        song_title_index_create, artist_name_index_create, unmatched_key_index_create,
+                        songplay_start_time_index_create, songplay_user_index_create, songplay_song_index_create,
+                        songplay_unmatched_index_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop,
+                      songplay_staging_drop, user_level_table_drop,
+                      hourly_rollup_drop, user_rollup_drop, song_rollup_drop, rollup_state_drop,
+                      rollup_stale_days_drop, songplay_unmatched_drop, songs_pending_drop, songs_pending_function_drop,
+                      checkpoint_table_drop]
+# the tables a shard loads into; anything else (the manifest, the rollups)
+# resolves to the main tables through the search path
+shard_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create,
+                       user_level_table_create, songplay_unmatched_create,
+                       song_title_index_create, artist_name_index_create]
+songplay_index_create_queries = [songplay_start_time_index_create, songplay_user_index_create, songplay_song_index_create,
+                                 songplay_unmatched_index_create]
+songplay_index_drop_queries = [songplay_start_time_index_drop, songplay_user_index_drop, songplay_song_index_drop,
+                               songplay_unmatched_index_drop]
\ No newline at end of file
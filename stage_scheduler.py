@@ -0,0 +1,97 @@
+"""
+stage_scheduler.py
+
+A small scheduler for the pipeline's stages. Each stage names the
+stages it depends on; a stage is started on a worker thread as soon as
+all of its dependencies have finished, and stages that need the DB are
+given their own connection from a psycopg2 connection pool. Independent
+stages (e.g. the song, artist, time and user inserts) therefore run
+concurrently, and a run takes roughly as long as its longest chain of
+dependent stages.
+
+As in the sequential pipeline, the first stage to fail aborts the run:
+its error is logged, no further stages are started, and stages already
+running are allowed to finish.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), error_msg=None, needs_db=True):
+        """
+        Initialize a stage.
+        Args:       name: unique stage name
+                    func: callable taking (conn, cur, results) - where
+                    results maps the names of finished stages to their
+                    return values - and returning this stage's result
+                    deps: names of the stages this one depends on
+                    error_msg: message logged if the stage fails
+                    needs_db: whether to hand the stage a pooled connection
+        """
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.error_msg = error_msg or f'Failed to run stage {name}'
+        self.needs_db = needs_db
+
+
+def _run_stage(stage, conn_pool, results):
+    """Run a single stage, on a pooled connection if it needs one.
+    Returns:    the stage's result
+    """
+    logging.debug(f'Scheduler: starting stage {stage.name}')
+    if not stage.needs_db:
+        return stage.func(None, None, results)
+    conn = conn_pool.getconn()
+    try:
+        cur = conn.cursor()
+        return stage.func(conn, cur, results)
+    finally:
+        # don't hand a connection back mid-transaction
+        conn.rollback()
+        conn_pool.putconn(conn)
+
+
+def run_stages(stages, conn_pool, max_workers):
+    """Run a set of stages, respecting their dependencies.
+    Args:       stages: list of Stage instances
+                conn_pool: psycopg2 connection pool
+                max_workers: maximum number of stages run at once
+    Returns:    dict of stage name -> result; or None if a stage failed
+    """
+    pending = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = [dep for dep in stage.deps if dep not in pending]
+        if unknown:
+            logging.critical(f'Scheduler: stage {stage.name} depends on unknown stages {unknown}')
+            return None
+
+    results = {}
+    running = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while (pending and not failed) or running:
+            if not failed:
+                ready = [stage for stage in pending.values()
+                         if all(dep in results for dep in stage.deps)]
+                for stage in ready:
+                    del pending[stage.name]
+                    future = executor.submit(_run_stage, stage, conn_pool, results)
+                    running[future] = stage
+            if not running:
+                logging.critical(f'Scheduler: cannot run stages {list(pending)} - dependency cycle')
+                return None
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                    logging.debug(f'Scheduler: finished stage {stage.name}')
+                except Exception as e:
+                    logging.critical(f"{stage.error_msg} - aborting: {str(e)}")
+                    failed = True
+
+    return None if failed else results
@@ -0,0 +1,122 @@
+"""
+test_validation.py
+
+Tests for the pre-load row validation (validation.py). Run with pytest.
+"""
+
+import json
+import datetime
+from sql_queries import bulk_load_targets, songplay_staging_create
+from validation import Validator, SCHEMAS, parse_table
+
+# a valid value for each column of the bulk load targets
+SAMPLE_VALUES = dict(song_id='SOUPIRU12A6D4FA1E1', title='Der Kleine Dompfaff',
+                     artist_id='ARJIE2Y1187B994AB7', year=2008, duration=152.92036,
+                     name='Line Renaud', location='Seattle, WA', latitude=None, longitude=None,
+                     timestamp='2018-11-15 07:56:18.796000', hour=7, day=15, week=46, month=11,
+                     weekday=4, user_id=8, first_name='Kaylee', last_name='Summers', gender='F',
+                     level='free', start_time='2018-11-15 07:56:18.796000', session_id=139,
+                     user_agent='Mozilla/5.0', song_title='Der Kleine Dompfaff',
+                     artist_name='Line Renaud', length=152.92036)
+
+
+def sample_row(table):
+    """A valid row for a bulk load target."""
+    return tuple(SAMPLE_VALUES[name] for name in bulk_load_targets[table]['columns'])
+
+
+def test_every_target_validates():
+    validator = Validator()
+    for table in bulk_load_targets:
+        row = sample_row(table)
+        assert list(validator.validate(table, [row])) == [row], table
+
+
+PEOPLE_CREATE = """CREATE TABLE IF NOT EXISTS people(
+                        person_id varchar,
+                        name varchar NOT NULL,
+                        gender char(1),
+                        initials char,
+                        age int,
+                        born timestamp NOT NULL,
+                        PRIMARY KEY (person_id))"""
+
+
+def test_parse_table():
+    table, columns = parse_table(PEOPLE_CREATE)
+    assert table == 'people'
+    assert list(columns) == ['person_id', 'name', 'gender', 'initials', 'age', 'born']
+    assert columns['person_id'].not_null
+    assert columns['name'].not_null
+    assert not columns['gender'].not_null
+    assert columns['gender'].width == 1
+    assert columns['initials'].width == 1
+    assert columns['name'].width is None
+    assert columns['age'].type_name == 'int'
+
+
+def test_parse_temp_and_unlogged_tables():
+    assert parse_table(songplay_staging_create)[0] == 'songplays_staging'
+    assert parse_table('CREATE UNLOGGED TABLE IF NOT EXISTS t (a int NOT NULL)')[0] == 't'
+
+
+def test_not_null():
+    columns = parse_table(PEOPLE_CREATE)[1]
+    validator = Validator()
+    assert validator.check(columns['name'], None) is not None
+    assert validator.check(columns['person_id'], None) is not None
+    assert validator.check(columns['gender'], None) is None
+    assert validator.check(columns['name'], 'Kaylee') is None
+
+
+def test_char_width():
+    columns = parse_table(PEOPLE_CREATE)[1]
+    validator = Validator()
+    assert validator.check(columns['gender'], 'F') is None
+    assert validator.check(columns['gender'], 'FF') is not None
+    assert validator.check(columns['initials'], 'KS') is not None
+
+
+def test_int():
+    columns = parse_table(PEOPLE_CREATE)[1]
+    validator = Validator()
+    assert validator.check(columns['age'], 30) is None
+    assert validator.check(columns['age'], '30') is None
+    assert validator.check(columns['age'], 30.5) is not None
+    assert validator.check(columns['age'], True) is not None
+    assert validator.check(columns['age'], 'thirty') is not None
+
+
+def test_ts_range():
+    columns = parse_table(PEOPLE_CREATE)[1]
+    validator = Validator(ts_from='2018-01-01', ts_to='2018-12-31')
+    assert validator.check(columns['born'], '2018-11-15 07:56:18.796000') is None
+    assert validator.check(columns['born'], datetime.datetime(2018, 6, 1)) is None
+    assert validator.check(columns['born'], '1970-01-01 00:00:00') is not None
+    assert validator.check(columns['born'], '2019-01-02 00:00:00') is not None
+    assert validator.check(columns['born'], 'not a date') is not None
+
+
+def test_schema_lookup_for_every_target():
+    for table, target in bulk_load_targets.items():
+        schema = SCHEMAS.get(target['staging']) or SCHEMAS[table]
+        assert set(target['columns']) <= set(schema), table
+
+
+def test_rejects_file(tmp_path):
+    rejects_file = tmp_path / 'rejects.jsonl'
+    validator = Validator(str(rejects_file))
+    good = sample_row('users')
+    bad = (None,) + good[1:]
+    assert list(validator.validate('users', [good, bad])) == [good]
+    validator.close()
+    records = [json.loads(line) for line in rejects_file.read_text().splitlines()]
+    assert len(records) == 1
+    assert records[0]['table'] == 'users'
+    assert records[0]['row']['user_id'] is None
+    assert 'user_id' in records[0]['reason']
+
+
+def test_disabled_validator_passes_everything():
+    bad = (None,) * len(bulk_load_targets['users']['columns'])
+    assert list(Validator(enabled=False).validate('users', [bad])) == [bad]
@@ -0,0 +1,116 @@
+"""
+time_dimension.py
+
+Vectorized time dimension builder. Instead of one datetime conversion,
+strftime and isocalendar call per log event, the millisecond ts values
+are deduplicated and converted a whole array at a time with NumPy.
+
+As with get_timestamp() in etl.py, timestamps are converted to local
+time. The UTC offset is looked up at the start and end of each distinct
+hour, rather than once per event; an hour whose two offsets differ holds
+a transition, whose exact second is found by bisection - so zones with
+transitions off the hour (e.g. Australia/Lord_Howe's 30-minute DST)
+convert exactly as datetime does.
+"""
+
+import time
+import numpy as np
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+
+
+def to_ts_array(ts_values):
+    """Build a deduplicated, sorted int64 array of millisecond timestamps,
+    dropping missing (None or 0) values.
+    Args:       ts_values: iterable of millisecond timestamps
+    Returns:    NumPy int64 array
+    """
+    ts = np.fromiter((t for t in ts_values if t), dtype=np.int64)
+    return np.unique(ts)
+
+
+def utc_offset(seconds):
+    """The local UTC offset, in seconds, at a UTC time in seconds."""
+    return time.localtime(seconds).tm_gmtoff
+
+
+def offset_transition(start, offset):
+    """The second, within the hour from start, at which the UTC offset
+    changes from offset.
+    Args:       start: UTC time in seconds of the start of the hour,
+                where the offset is offset; it differs by the hour's end
+                offset: UTC offset at start, in seconds
+    Returns:    UTC time in seconds of the first second with the new offset
+    """
+    lo, hi = start, start + 3599
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if utc_offset(mid) == offset:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def local_ms(ts):
+    """Shift UTC millisecond timestamps to local time.
+    Args:       ts: NumPy int64 array of millisecond timestamps
+    Returns:    NumPy int64 array of local-time milliseconds
+    """
+    hours, hour_idx = np.unique(ts // MS_PER_HOUR, return_inverse=True)
+    starts = np.array([utc_offset(int(h) * 3600) for h in hours], dtype=np.int64)
+    ends = np.array([utc_offset(int(h) * 3600 + 3599) for h in hours], dtype=np.int64)
+    # the millisecond each hour's end offset takes over - past the end
+    # of the hour, for the hours without a transition
+    transitions = (hours + 1) * MS_PER_HOUR
+    for i in np.flatnonzero(starts != ends):
+        transitions[i] = offset_transition(int(hours[i]) * 3600, int(starts[i])) * 1000
+    offsets = np.where(ts >= transitions[hour_idx], ends[hour_idx], starts[hour_idx])
+    return ts + offsets * 1000
+
+
+def timestamp_strings(ts):
+    """Format millisecond timestamps the way get_timestamp() does
+    ('%Y-%m-%d %H:%M:%S.%f', local time).
+    Args:       ts: NumPy int64 array of millisecond timestamps
+    Returns:    NumPy array of timestamp strings
+    """
+    local = local_ms(ts).astype('datetime64[ms]').astype('datetime64[us]')
+    return np.char.replace(np.datetime_as_string(local, unit='us'), 'T', ' ')
+
+
+def time_columns(ts):
+    """Derive the time table columns for an array of timestamps.
+    Args:       ts: NumPy int64 array of millisecond timestamps
+    Returns:    dict of column name -> NumPy array, with the time table
+                columns: timestamp, hour, day, week, month, year, weekday
+    """
+    local = local_ms(ts)
+    days = (local // MS_PER_DAY).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+
+    # ISO calendar: Monday is day 1, and a week belongs to the
+    # year its Thursday falls in
+    day_num = days.astype(np.int64)
+    weekday = (day_num + 3) % 7 + 1     # 1970-01-01 was a Thursday
+    thursday = (day_num - weekday + 4).astype('datetime64[D]')
+    iso_year = thursday.astype('datetime64[Y]')
+    week = (thursday - iso_year.astype('datetime64[D]')).astype(np.int64) // 7 + 1
+
+    return dict(timestamp=timestamp_strings(ts),
+                hour=(local // MS_PER_HOUR) % 24,
+                day=(days - months.astype('datetime64[D]')).astype(np.int64) + 1,
+                week=week,
+                month=months.astype(np.int64) % 12 + 1,
+                year=iso_year.astype(np.int64) + 1970,
+                weekday=weekday)
+
+
+def time_column_rows(columns):
+    """Turn time table columns into row tuples for loading.
+    Args:       columns: dict of column arrays from time_columns()
+    Returns:    iterator of time row tuples
+    """
+    return zip(*(columns[name].tolist() for name in
+                 ('timestamp', 'hour', 'day', 'week', 'month', 'year', 'weekday')))
@@ -0,0 +1,119 @@
+"""
+user_dimension.py
+
+The user dimension builder reduces the stream of NextSong events to one
+row per user_id - the user's latest state, by ts - before anything is
+written, so the users table gets a single upsert per user rather than
+one per event, and a user's final level no longer depends on the order
+the log files happen to be read in.
+
+It can also keep a compact history of each user's level changes
+(free <-> paid): one (user_id, level, start_time) row per change, for
+the user_levels table. The history is exact as long as each user's
+events arrive in ts order, as they do from the log files, which are
+read in date order and are sorted within each file.
+"""
+
+import logging
+import metrics
+from time_dimension import to_ts_array, timestamp_strings
+
+
+class UserDimensionBuilder:
+    def __init__(self):
+        """
+        Initialize an empty dimension. Log event data can then be
+        added batch by batch, as it is read.
+        """
+        self.latest = {}
+        self.changes = {}
+        self.last_level = {}
+
+    def add(self, all_log_data):
+        """Add a batch of log event data records, skipping events with
+        missing user attributes.
+        Args:       all_log_data: list of log event data records
+        Returns:    None
+        """
+        for entry in all_log_data:
+            self.add_event(entry)
+
+    def add_event(self, entry):
+        """Add a single log event data record, skipping it if it has
+        missing user attributes.
+        Args:       entry: log event data record
+        Returns:    None
+        """
+        try:
+            user_id = entry['user_id']
+            row = (user_id, entry['first_name'], entry['last_name'],
+                   entry['gender'], entry['level'])
+            ts = entry['ts'] or 0
+        except KeyError as e:
+            logging.warning(f'Key Error:  {str(e)}')
+            metrics.count('rows_rejected')
+            return
+        if not all(row):
+            return
+
+        # the latest event wins; on a tie, the last one read
+        latest = self.latest.get(user_id)
+        if latest is None or ts >= latest[0]:
+            self.latest[user_id] = (ts, row)
+
+        level = row[4]
+        if self.last_level.get(user_id) != level:
+            self.last_level[user_id] = level
+            self.changes.setdefault(user_id, []).append((ts, level))
+
+    def set_levels(self, levels):
+        """Seed the users' last levels, e.g. with those already loaded,
+        so the level history carries on from them.
+        Args:       levels: iterable of (user_id, level) tuples
+        Returns:    None
+        """
+        self.last_level.update(levels)
+
+    def clear_rows(self):
+        """Drop the rows built so far, once they have been loaded, but
+        keep each user's last level, so that the rows of the events
+        added next carry on from those.
+        Returns:    None
+        """
+        self.latest = {}
+        self.changes = {}
+
+    def rows(self):
+        """The user table rows: one per user, with its latest state.
+        Returns:    list of user row tuples
+        """
+        return [row for _, row in self.latest.values()]
+
+    def history_rows(self):
+        """The user_levels table rows: one per level change, in ts
+        order for each user, starting with the user's first level.
+        Returns:    list of (user_id, level, start_time) tuples
+        """
+        changes = []
+        for user_id, points in self.changes.items():
+            last_level = None
+            for ts, level in sorted(points, key=lambda point: point[0]):
+                if level != last_level:
+                    changes.append((user_id, level, ts))
+                    last_level = level
+        ts = to_ts_array(ts for _, _, ts in changes)
+        start_times = dict(zip(ts.tolist(), timestamp_strings(ts).tolist()))
+        return [(user_id, level, start_times[ts])
+                for user_id, level, ts in changes if ts in start_times]
+
+
+def build_user_dimension(all_log_data):
+    """Build the user dimension from a list of log event data records.
+    Args:       all_log_data: list of log event data records
+    Returns:    UserDimensionBuilder instance
+    """
+    builder = UserDimensionBuilder()
+    builder.add(all_log_data)
+    logging.debug(f'User dimension: {len(builder.latest)} users '
+                  f'from {len(all_log_data)} events')
+    return builder
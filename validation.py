@@ -0,0 +1,220 @@
+"""
+validation.py
+
+Pre-load validation of the rows bound for each table. Without it, a bad
+row only shows up when the DB rejects it - and in a row-by-row load,
+that aborts the transaction, so every later row of the load fails with
+it; in a COPY load, the whole batch is lost.
+
+Rows are checked against the table definitions in sql_queries.py, which
+are parsed once: NOT NULL (and primary key) columns must have a value,
+int and decimal columns must hold numbers, char(n) columns at most n
+characters, and timestamp columns a timestamp inside the configured
+VALID_TS_FROM - VALID_TS_TO window. Rows that fail are dropped before
+loading, counted as rejected, and written - with the table and the
+reason - to the rejects file (REJECTS_FILE), a JSON lines dead-letter
+file that can be inspected and replayed.
+"""
+
+import re
+import json
+import logging
+import datetime
+import threading
+import metrics
+from sql_queries import (create_table_queries, songplay_table_create, songplay_staging_create,
+                         songplay_rows_staging_create, bulk_load_targets)
+
+DEF_VALID_TS_FROM = '2000-01-01'
+
+_CREATE_RE = re.compile(r'CREATE (?:UNLOGGED |TEMP )?TABLE IF NOT EXISTS (\w+)\s*\((.*)\)',
+                        re.DOTALL | re.IGNORECASE)
+_CHAR_RE = re.compile(r'^char(?:\((\d+)\))?$')
+
+
+class Column:
+    def __init__(self, name, type_name, not_null):
+        """
+        Initialize a column definition parsed from a CREATE TABLE query.
+        """
+        self.name = name
+        self.type_name = type_name
+        self.not_null = not_null
+        match = _CHAR_RE.match(type_name)
+        self.width = int(match.group(1) or 1) if match else None
+
+
+def _split_columns(body):
+    """Split the body of a CREATE TABLE query on its top-level commas."""
+    parts, depth, current = [], 0, ''
+    for ch in body:
+        if ch == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(ch, 0)
+        current += ch
+    parts.append(current.strip())
+    return [part for part in parts if part]
+
+
+def parse_table(query):
+    """Parse a CREATE TABLE query into its table name and columns.
+    Args:       query: CREATE TABLE query
+    Returns:    table name; dict of column name -> Column
+    """
+    match = _CREATE_RE.search(query)
+    table, body = match.group(1), match.group(2)
+    columns = {}
+    key_columns = []
+    for part in _split_columns(body):
+        key = re.match(r'PRIMARY KEY\s*\((.*)\)', part, re.IGNORECASE)
+        if key:
+            key_columns = [name.strip() for name in key.group(1).split(',')]
+            continue
+        words = part.split()
+        upper = part.upper()
+        columns[words[0]] = Column(words[0], words[1].lower(),
+                                   'NOT NULL' in upper or 'PRIMARY KEY' in upper)
+    for name in key_columns:
+        columns[name].not_null = True
+    return table, columns
+
+
+def _schemas():
+    """Parse all the table definitions in sql_queries.py."""
+    schemas = {}
+    for query in ([songplay_table_create, songplay_staging_create, songplay_rows_staging_create]
+                  + create_table_queries):
+        if _CREATE_RE.search(query):
+            table, columns = parse_table(query)
+            schemas.setdefault(table, columns)
+    return schemas
+
+
+SCHEMAS = _schemas()
+
+
+def to_timestamp(value):
+    """Convert a timestamp value (datetime, or string as formatted for
+    loading) to a datetime."""
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(str(value))
+
+
+class Validator:
+    def __init__(self, rejects_file=None, ts_from=DEF_VALID_TS_FROM, ts_to=None, enabled=True):
+        """
+        Initialize the validator.
+        Args:       rejects_file: JSON lines file rejected rows are appended to, or None
+                    ts_from: earliest valid timestamp ("YYYY-MM-DD"), or None
+                    ts_to: latest valid timestamp, or None for a day from now
+                    enabled: False to pass all rows through unchecked
+        """
+        self.rejects_file = rejects_file
+        self.ts_from = to_timestamp(ts_from) if ts_from else datetime.datetime.min
+        self.ts_to = (to_timestamp(ts_to) if ts_to
+                      else datetime.datetime.now() + datetime.timedelta(days=1))
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.rejects = None
+
+    def check(self, column, value):
+        """Check a single value against its column.
+        Returns:    reason the value is invalid, or None if it is valid
+        """
+        if value is None:
+            return f'{column.name}: null in NOT NULL column' if column.not_null else None
+        type_name = column.type_name
+        try:
+            if type_name in ('int', 'integer', 'bigint', 'serial'):
+                if isinstance(value, bool) or int(value) != float(value):
+                    return f'{column.name}: not an integer: {value!r}'
+            elif type_name in ('decimal', 'numeric', 'double'):
+                float(value)
+            elif type_name == 'timestamp':
+                ts = to_timestamp(value)
+                if not self.ts_from <= ts <= self.ts_to:
+                    return f'{column.name}: timestamp out of range: {value}'
+        except (TypeError, ValueError):
+            return f'{column.name}: not a valid {type_name}: {value!r}'
+        if column.width is not None and len(str(value)) > column.width:
+            return f'{column.name}: longer than {column.width} characters: {value!r}'
+        return None
+
+    def validate(self, table, rows):
+        """Validate the rows bound for a table, passing on the valid ones
+        and sending the rest to the rejects file.
+        Args:       table: target table (a key of bulk_load_targets)
+                    rows: iterable of row tuples, in the target's column order
+        Returns:    generator of valid row tuples
+        """
+        if not self.enabled:
+            yield from rows
+            return
+        target = bulk_load_targets[table]
+        # a target COPY'd through a staging table of its own columns is
+        # checked against that table's definition
+        schema = SCHEMAS.get(target['staging']) or SCHEMAS[table]
+        columns = [schema[name] for name in target['columns']]
+        for row in rows:
+            reasons = [reason for reason in map(self.check, columns, row) if reason]
+            if reasons:
+                self.reject(table, target['columns'], row, '; '.join(reasons))
+                continue
+            yield row
+
+    def reject(self, table, column_names, row, reason):
+        """Log a rejected row, count it, and append it to the rejects file."""
+        logging.warning(f'Validation: rejected {table} row: {reason}')
+        metrics.count('rows_rejected')
+        if not self.rejects_file:
+            return
+        record = dict(table=table, reason=reason,
+                      row=dict(zip(column_names, row)),
+                      rejected_at=datetime.datetime.now().isoformat(timespec='seconds'))
+        with self.lock:
+            if self.rejects is None:
+                self.rejects = open(self.rejects_file, 'a')
+            self.rejects.write(json.dumps(record, default=str) + '\n')
+            self.rejects.flush()
+
+    def close(self):
+        """Close the rejects file."""
+        with self.lock:
+            if self.rejects is not None:
+                self.rejects.close()
+                self.rejects = None
+
+
+# the run's validator - replaced by configure()
+_validator = Validator()
+
+
+def configure(cfg):
+    """Set up the run's validator from the VALIDATE_ROWS, REJECTS_FILE,
+    VALID_TS_FROM and VALID_TS_TO config settings.
+    Args:       cfg: ConfigMgr instance
+    Returns:    None
+    """
+    global _validator
+    _validator.close()
+    _validator = Validator(cfg.get("REJECTS_FILE"),
+                           cfg.get("VALID_TS_FROM") or DEF_VALID_TS_FROM,
+                           cfg.get("VALID_TS_TO"),
+                           cfg.get("VALIDATE_ROWS") is not False)
+
+
+def validate_rows(table, rows):
+    """Validate rows bound for a table with the run's validator.
+    Args:       table: target table (a key of bulk_load_targets)
+                rows: iterable of row tuples
+    Returns:    generator of valid row tuples
+    """
+    return _validator.validate(table, rows)
+
+
+def close():
+    """Close the run's rejects file."""
+    _validator.close()